@@ -0,0 +1,308 @@
+'''
+alevin_matrix.py - load the per cell alevin quantifications as a sparse matrix
+==============================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Load the alevin ``cell/*/quant.sf`` files into a gene x cell
+``scipy.sparse`` CSC matrix. This replaces the loops in the
+Learning_True_CB_alevin notebooks, which parse each file into a dense
+array and add it to a DataFrame one column at a time, copying the
+frame on every append.
+
+The quant.sf files are parsed in parallel and only the non-zero
+counts for each cell are returned, from which the CSC matrix is built
+directly. All the quant.sf files are expected to list the same genes
+in the same order.
+
+The matrix is cached as a ``.npz`` file, along with the gene and cell
+names and the modification time of the ``cell`` directory. The cache
+is used so long as the ``cell`` directory has not been modified since,
+e.g by re-running alevin.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import alevin_matrix
+
+   counts = alevin_matrix.loadMatrix("alevin_run/test/alevin")
+   counts.matrix[:, counts.cells.index("GCTTCCATCTCCTATA")].sum()
+
+or to build the cache, and optionally a MatrixMarket copy, in advance:
+
+.. code-block:: bash
+
+   python alevin_matrix.py --alevin-dir=alevin_run/test/alevin
+   --threads=8 --output-mtx=alevin_run/test/alevin/cell_matrix.mtx
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import scipy.io
+import scipy.sparse
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+CellMatrix = collections.namedtuple(
+    "CellMatrix", ["matrix", "genes", "cells", "no_quant"])
+
+CACHE_NAME = "cell_matrix.npz"
+
+
+def findQuantFiles(alevin_dir):
+    '''return the (cell barcode, quant.sf) pairs for `alevin_dir`.
+
+    Each cell has a subdirectory of ``cell``, so the directory is
+    listed rather than globbing for the quant.sf files, which is very
+    slow for thousands of cells.
+    '''
+
+    cell_dir = os.path.join(alevin_dir, "cell")
+    with os.scandir(cell_dir) as entries:
+        cells = sorted(x.name for x in entries if x.is_dir())
+
+    return [(cell, os.path.join(cell_dir, cell, "quant.sf"))
+            for cell in cells]
+
+
+def readQuantFile(infile):
+    '''return the gene names and counts (the last column) from a
+    quant.sf file'''
+
+    with IOTools.openFile(infile, "r") as inf:
+        next(inf)
+        rows = [line.rstrip("\n").split("\t") for line in inf
+                if line.strip()]
+
+    genes = [x[0] for x in rows]
+    counts = np.array([x[-1] for x in rows], dtype=np.float64)
+
+    return genes, counts
+
+
+def _readNonZero(infile):
+    '''return the row indices and values of the non-zero counts in
+    `infile`, or None if it doesn't exist'''
+
+    if not os.path.exists(infile):
+        return None
+
+    _, counts = readQuantFile(infile)
+    rows = np.flatnonzero(counts).astype(np.int32)
+    return len(counts), rows, counts[rows]
+
+
+def buildMatrix(alevin_dir, threads=1):
+    '''read the quant.sf files for all the cells in `alevin_dir` into a
+    :class:`CellMatrix`. Cells without a quant.sf are listed in
+    ``no_quant`` and are not included in the matrix'''
+
+    quant_files = findQuantFiles(alevin_dir)
+    present = [x for x in quant_files if os.path.exists(x[1])]
+
+    if not present:
+        raise ValueError("no quant.sf files in %s" % alevin_dir)
+
+    genes, _ = readQuantFile(present[0][1])
+    n_genes = len(genes)
+
+    infiles = [x[1] for x in quant_files]
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.map(_readNonZero, infiles,
+                           chunksize=max(1, len(infiles) // (threads * 8)))
+        pool.close()
+        pool.join()
+    else:
+        results = [_readNonZero(x) for x in infiles]
+
+    cells = []
+    no_quant = []
+    indices = []
+    data = []
+    nnz = [0]
+
+    for (cell, infile), result in zip(quant_files, results):
+        if result is None:
+            no_quant.append(cell)
+            continue
+        length, rows, values = result
+        if length != n_genes:
+            raise ValueError(
+                "%s has %i genes, expected %i" % (infile, length, n_genes))
+        cells.append(cell)
+        indices.append(rows)
+        data.append(values)
+        nnz.append(len(rows))
+
+    matrix = scipy.sparse.csc_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.cumsum(nnz)),
+        shape=(n_genes, len(cells)))
+
+    return CellMatrix(matrix, genes, cells, no_quant)
+
+
+def _cacheKey(alevin_dir):
+    '''the modification time of the cell directory, which changes as
+    cell subdirectories are added or removed'''
+    return os.stat(os.path.join(alevin_dir, "cell")).st_mtime_ns
+
+
+def _npzPath(path):
+    '''return `path` with the ``.npz`` extension :func:`numpy.savez`
+    adds to it'''
+
+    if not path.endswith(".npz"):
+        path += ".npz"
+    return path
+
+
+def saveMatrix(counts, outfile, key=None):
+    '''save a :class:`CellMatrix` to a ``.npz`` file. The ``.npz``
+    extension is added to `outfile` if it doesn't have it'''
+
+    matrix = counts.matrix.tocsc()
+    np.savez(_npzPath(outfile),
+             data=matrix.data,
+             indices=matrix.indices,
+             indptr=matrix.indptr,
+             shape=np.array(matrix.shape),
+             genes=np.array(counts.genes),
+             cells=np.array(counts.cells),
+             no_quant=np.array(counts.no_quant, dtype=str),
+             key=np.array(-1 if key is None else key, dtype=np.int64))
+
+
+def readMatrix(infile):
+    '''read a :class:`CellMatrix` and its cache key from a ``.npz``
+    file written by :func:`saveMatrix`'''
+
+    with np.load(_npzPath(infile)) as npz:
+        matrix = scipy.sparse.csc_matrix(
+            (npz["data"], npz["indices"], npz["indptr"]),
+            shape=tuple(npz["shape"]))
+        counts = CellMatrix(matrix, npz["genes"].tolist(),
+                            npz["cells"].tolist(), npz["no_quant"].tolist())
+        key = int(npz["key"])
+
+    return counts, key
+
+
+def loadMatrix(alevin_dir, cache=None, threads=None, rebuild=False):
+    '''return the :class:`CellMatrix` for `alevin_dir`, from the cache
+    file if it is up to date, otherwise from the quant.sf files.
+
+    The cache defaults to ``cell_matrix.npz`` in `alevin_dir` and is
+    (re)written after the matrix is built. The ``.npz`` extension is
+    added to the `cache` if it doesn't have it.
+    '''
+
+    if cache is None:
+        cache = os.path.join(alevin_dir, CACHE_NAME)
+    cache = _npzPath(cache)
+
+    key = _cacheKey(alevin_dir)
+
+    if not rebuild and os.path.exists(cache):
+        counts, cached_key = readMatrix(cache)
+        if cached_key == key:
+            return counts
+        E.info("%s is out of date, rebuilding" % cache)
+
+    counts = buildMatrix(alevin_dir, threads=threads or os.cpu_count() or 1)
+    saveMatrix(counts, cache, key=key)
+
+    return counts
+
+
+def writeMtx(counts, outfile):
+    '''write the matrix in MatrixMarket format, with the gene and cell
+    names in ``.genes.tsv`` and ``.cells.tsv`` files alongside'''
+
+    scipy.io.mmwrite(outfile, counts.matrix)
+    prefix = outfile[:-len(".mtx")] if outfile.endswith(".mtx") else outfile
+
+    with IOTools.openFile(prefix + ".genes.tsv", "w") as outf:
+        outf.write("\n".join(counts.genes) + "\n")
+
+    with IOTools.openFile(prefix + ".cells.tsv", "w") as outf:
+        outf.write("\n".join(counts.cells) + "\n")
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-d", "--alevin-dir", dest="alevin_dir",
+                      type="string",
+                      help="alevin output directory, containing the "
+                      "cell directory [%default]")
+
+    parser.add_option("--cache", dest="cache", type="string",
+                      help="cache file [<alevin-dir>/%s]" % CACHE_NAME)
+
+    parser.add_option("--output-mtx", dest="output_mtx", type="string",
+                      help="also write the matrix to this MatrixMarket "
+                      "file [%default]")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="number of processes reading the quant.sf "
+                      "files [%default]")
+
+    parser.add_option("--rebuild", dest="rebuild", action="store_true",
+                      help="rebuild the cache even if it is up to date "
+                      "[%default]")
+
+    parser.set_defaults(
+        alevin_dir=None,
+        cache=None,
+        output_mtx=None,
+        threads=os.cpu_count() or 1,
+        rebuild=False,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.alevin_dir is None:
+        raise ValueError("--alevin-dir is required")
+
+    counts = loadMatrix(options.alevin_dir, cache=options.cache,
+                        threads=options.threads, rebuild=options.rebuild)
+
+    E.info("%i genes x %i cells, %i non-zero counts, %i cells without "
+           "a quant.sf" % (counts.matrix.shape[0], counts.matrix.shape[1],
+                           counts.matrix.nnz, len(counts.no_quant)))
+
+    if options.output_mtx:
+        writeMtx(counts, options.output_mtx)
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
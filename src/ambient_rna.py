@@ -0,0 +1,447 @@
+'''
+ambient_rna.py - estimate the ambient RNA profile and contamination
+====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Estimate the profile of the ambient RNA in a sample from the gene
+counts of its background barcodes, and score how much of each cell's
+counts could come from it, in a single pass over a gene tagged BAM
+(reads named ``<read>_<cell>_<UMI>`` by ``umi_tools extract``, with the
+gene in the XT tag).
+
+The unique UMIs (or reads) per cell barcode and gene are accumulated
+in chunks of reads into a sparse count table keyed on the packed
+(cell, gene) ids, so the memory used is proportional to the number of
+distinct cell/gene pairs (or molecules) rather than the number of
+reads.
+
+The background must come from barcodes outside the whitelist, i.e
+the empty droplets. The 10X reads are extracted with the whitelist
+(``--filter-cell-barcode``), so the gene tagged BAM only has the
+cells. The reads of the background barcodes are then extracted
+separately (see ``make_whitelist.py --background``), aligned and
+assigned to genes, and given as `background_bamfile`: the barcodes of
+`bamfile` are the cells and the other barcodes of
+`background_bamfile` the background.
+
+Otherwise, `bamfile` should be unfiltered, and the barcodes are split
+using a knee_detection.py threshold on their total counts, with
+`method`:
+
+cells
+   barcodes with at least the threshold count
+background
+   barcodes below the lower bound of the threshold's plausible range,
+   so that barcodes near the threshold are in neither
+
+The threshold count can be set directly with `cutoff`.
+
+The ambient profile is the fraction of the background counts from
+each gene. The ambient genes are the `n_genes` genes (with at least
+`min_gene_counts` background counts) with the highest ratio of their
+fraction of the background counts to their fraction of the cell
+counts, e.g the genes of the other species in a mixed species
+sample. As these genes are expected to be rarely expressed by the
+cells themselves, the contamination of a cell is estimated as the
+fraction of its counts from the ambient genes divided by their
+fraction of the ambient profile (capped at 1). The cosine similarity
+of each cell's counts to the ambient profile is also reported.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python ambient_rna.py --bamfile=mapped/sample.bam.featureCounts.bam
+   --background-bamfile=ambient.dir/sample_background.bam.featureCounts.bam
+   --profile=ambient.dir/sample_ambient_profile.tsv
+   --contamination=ambient.dir/sample_contamination.tsv
+
+Command line options
+--------------------
+
+'''
+
+import array
+import sys
+
+import numpy as np
+import pandas as pd
+import pysam
+
+import CGAT.Experiment as E
+
+import barcode_codec
+import knee_detection
+
+
+_GENE_MASK = np.uint64(0xFFFFFFFF)
+
+
+class GeneCounts(object):
+    '''unique UMIs or reads per cell barcode and gene, accumulated in
+    chunks of reads'''
+
+    def __init__(self, count="umis", chunk_size=1000000):
+        if count not in ("umis", "reads"):
+            raise ValueError("count should be umis or reads: %s" % count)
+
+        self.count = count
+        self.chunk_size = chunk_size
+
+        self.cell2id = {}
+        self.gene2id = {}
+        self.umi_length = None
+        self.invalid_umis = 0
+
+        # keyed on cell id << 32 | gene id (and UMI)
+        if count == "umis":
+            self.table = barcode_codec.PairCountTable()
+        else:
+            self.table = barcode_codec.CountTable()
+
+        self._newChunk()
+
+    def _newChunk(self):
+        self._cells = array.array("q")
+        self._genes = array.array("q")
+        self._umis = []
+
+    def addBam(self, inbam):
+        '''add the primary reads assigned to a gene from `inbam`, an
+        open pysam AlignmentFile. Returns the number of reads added'''
+
+        cell2id = self.cell2id
+        gene2id = self.gene2id
+        n = 0
+
+        for read in inbam.fetch(until_eof=True):
+
+            if read.is_secondary or read.is_unmapped or not read.has_tag(
+                    "XT"):
+                continue
+
+            # reads are named <read>_<cell>_<UMI> by umi_tools extract
+            _, cell, umi = read.query_name.rsplit("_", 2)
+
+            cell_id = cell2id.get(cell)
+            if cell_id is None:
+                cell_id = cell2id[cell] = len(cell2id)
+
+            gene = read.get_tag("XT")
+            gene_id = gene2id.get(gene)
+            if gene_id is None:
+                gene_id = gene2id[gene] = len(gene2id)
+
+            self._cells.append(cell_id)
+            self._genes.append(gene_id)
+            self._umis.append(umi)
+
+            n += 1
+            if len(self._cells) >= self.chunk_size:
+                self.flush()
+                E.debug("processed %i reads" % n)
+
+        self.flush()
+
+        return n
+
+    def flush(self):
+        '''add the current chunk of reads to the count table'''
+
+        if len(self._cells) == 0:
+            return
+
+        keys = ((np.frombuffer(self._cells, dtype=np.int64).astype(
+            np.uint64) << np.uint64(32)) |
+            np.frombuffer(self._genes, dtype=np.int64).astype(np.uint64))
+
+        if self.count == "umis":
+            if self.umi_length is None:
+                self.umi_length = len(self._umis[0])
+            codes, valid = barcode_codec.encode(self._umis, self.umi_length)
+            self.invalid_umis += int((~valid).sum())
+            self.table.update(keys[valid], codes[valid])
+        else:
+            self.table.update(keys)
+
+        self._newChunk()
+
+    def _ids(self, mapping):
+        names = [None] * len(mapping)
+        for name, ix in mapping.items():
+            names[ix] = name
+        return names
+
+    def cells(self):
+        '''return the cell barcodes, in id order'''
+        return self._ids(self.cell2id)
+
+    def genes(self):
+        '''return the genes, in id order'''
+        return self._ids(self.gene2id)
+
+    def entries(self):
+        '''return the cell ids, gene ids and counts of the non-zero
+        cell/gene counts'''
+
+        if self.count == "umis":
+            keys, counts = self.table.uniqueCounts()
+        else:
+            keys, counts = self.table.keys, self.table.counts
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        return ((keys >> np.uint64(32)).astype(np.int64),
+                (keys & _GENE_MASK).astype(np.int64),
+                np.asarray(counts, dtype=np.int64))
+
+
+def splitBarcodes(totals, method="inflection", min_count=10, cutoff=None):
+    '''return boolean arrays flagging the cells and background barcodes
+    from their `totals`, and the count threshold for the cells. The
+    threshold is estimated with knee_detection.py `method`, unless a
+    `cutoff` count is given'''
+
+    if cutoff is not None:
+        return totals >= cutoff, totals < cutoff, cutoff
+
+    threshold = knee_detection.estimateThresholds(totals, min_count)[method]
+    if threshold is None:
+        raise ValueError("could not estimate a %s threshold" % method)
+
+    E.info("%s threshold: %i counts, %i cells, range %i-%i, "
+           "confidence %.2f" % (method, threshold.count, threshold.n_cells,
+                                threshold.lower, threshold.upper,
+                                threshold.confidence))
+
+    return (totals >= threshold.count, totals < threshold.lower,
+            threshold.count)
+
+
+def estimateAmbient(cells, genes, counts, n_cells, n_genes, is_cell,
+                    is_background, n_ambient_genes=20, min_gene_counts=10):
+    '''return the ambient profile table, per gene, and the
+    contamination table, per cell, from the non-zero `counts` of the
+    `cells` and `genes` ids'''
+
+    totals = np.bincount(cells, weights=counts, minlength=n_cells)
+
+    background = is_background[cells]
+    ambient_counts = np.bincount(genes[background], weights=counts[background],
+                                 minlength=n_genes)
+    if ambient_counts.sum() == 0:
+        raise ValueError("there are no counts from background barcodes")
+
+    in_cell = is_cell[cells]
+    cell_counts = np.bincount(genes[in_cell], weights=counts[in_cell],
+                              minlength=n_genes)
+
+    profile = ambient_counts / ambient_counts.sum()
+    # smoothed so genes without cell counts have a finite ratio
+    cell_profile = (cell_counts + 1) / (cell_counts.sum() + n_genes)
+    ratio = profile / cell_profile
+
+    candidates = np.flatnonzero(ambient_counts >= min_gene_counts)
+    ambient_genes = candidates[
+        np.argsort(-ratio[candidates], kind="mergesort")[:n_ambient_genes]]
+    is_ambient_gene = np.zeros(n_genes, dtype=bool)
+    is_ambient_gene[ambient_genes] = True
+
+    profile_table = pd.DataFrame({
+        "gene_id": np.arange(n_genes),
+        "background_counts": ambient_counts.astype(np.int64),
+        "fraction": profile,
+        "cell_fraction": cell_counts / max(cell_counts.sum(), 1),
+        "ambient_gene": is_ambient_gene})
+
+    # per cell sums over the sparse counts of the cells
+    cells, genes, counts = cells[in_cell], genes[in_cell], counts[in_cell]
+    from_ambient_genes = np.bincount(
+        cells, weights=counts * is_ambient_gene[genes], minlength=n_cells)
+    dot = np.bincount(cells, weights=counts * profile[genes],
+                      minlength=n_cells)
+    norm = np.sqrt(np.bincount(cells, weights=counts.astype(float) ** 2,
+                               minlength=n_cells))
+
+    ambient_fraction = profile[ambient_genes].sum()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        contamination = np.minimum(
+            from_ambient_genes / totals / ambient_fraction, 1.0)
+        similarity = dot / (norm * np.sqrt((profile ** 2).sum()))
+
+    cell_ids = np.flatnonzero(is_cell)
+    contamination_table = pd.DataFrame({
+        "cell_id": cell_ids,
+        "counts": totals[cell_ids].astype(np.int64),
+        "genes": np.bincount(cells, minlength=n_cells)[cell_ids],
+        "ambient_gene_counts": from_ambient_genes[cell_ids].astype(
+            np.int64),
+        "contamination": contamination[cell_ids],
+        "ambient_similarity": similarity[cell_ids]})
+
+    return profile_table, contamination_table
+
+
+def ambientProfile(bamfile, background_bamfile=None, count="umis",
+                   method="inflection", min_count=10, cutoff=None,
+                   n_ambient_genes=20, min_gene_counts=10):
+    '''return the ambient profile and contamination tables for
+    `bamfile`, with the background from `background_bamfile` if given
+    (see :func:`estimateAmbient`)'''
+
+    gene_counts = GeneCounts(count)
+    with pysam.AlignmentFile(bamfile) as inbam:
+        n = gene_counts.addBam(inbam)
+
+    # the background barcodes are given ids after those of `bamfile`
+    n_bam_cells = len(gene_counts.cell2id)
+    if background_bamfile is not None:
+        with pysam.AlignmentFile(background_bamfile) as inbam:
+            n += gene_counts.addBam(inbam)
+
+    E.info("counted %i reads assigned to genes, %i cell barcodes, "
+           "%i genes" % (n, len(gene_counts.cell2id),
+                         len(gene_counts.gene2id)))
+    if gene_counts.invalid_umis:
+        E.warn("skipped %i reads with invalid UMIs" %
+               gene_counts.invalid_umis)
+
+    cells, genes, counts = gene_counts.entries()
+    n_cells = len(gene_counts.cell2id)
+    n_genes = len(gene_counts.gene2id)
+
+    if background_bamfile is not None:
+        is_cell = np.arange(n_cells) < n_bam_cells
+        is_background = ~is_cell
+
+        E.info("%i cells, %i background barcodes" % (
+            is_cell.sum(), is_background.sum()))
+
+    else:
+        totals = np.bincount(cells, weights=counts,
+                             minlength=n_cells).astype(np.int64)
+        is_cell, is_background, threshold = splitBarcodes(
+            totals, method, min_count, cutoff)
+
+        E.info("%i cells with >= %i counts, %i background barcodes" % (
+            is_cell.sum(), threshold, is_background.sum()))
+
+    profile, contamination = estimateAmbient(
+        cells, genes, counts, n_cells, n_genes, is_cell, is_background,
+        n_ambient_genes, min_gene_counts)
+
+    gene_names = np.array(gene_counts.genes(), dtype=object)
+    profile.insert(0, "gene", gene_names[profile.pop("gene_id").values])
+    profile = profile.sort_values("fraction", ascending=False)
+
+    cell_names = np.array(gene_counts.cells(), dtype=object)
+    contamination.insert(
+        0, "cell", cell_names[contamination.pop("cell_id").values])
+    contamination = contamination.sort_values("counts", ascending=False)
+
+    return profile, contamination
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="gene tagged BAM [%default]")
+
+    parser.add_option("--background-bamfile", dest="background_bamfile",
+                      type="string",
+                      help="gene tagged BAM of the background barcodes. "
+                      "If given, the barcodes of --bamfile are the cells "
+                      "[%default]")
+
+    parser.add_option("--profile", dest="profile", type="string",
+                      help="output table of the ambient profile "
+                      "[%default]")
+
+    parser.add_option("--contamination", dest="contamination",
+                      type="string",
+                      help="output table of the contamination per cell "
+                      "[%default]")
+
+    parser.add_option("--count", dest="count", type="choice",
+                      choices=("umis", "reads"),
+                      help="count the unique UMIs or reads [%default]")
+
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=knee_detection.METHODS,
+                      help="knee_detection.py threshold separating the "
+                      "cells from the background, without "
+                      "--background-bamfile [%default]")
+
+    parser.add_option("--min-count", dest="min_count", type="int",
+                      help="ignore barcodes with fewer counts when "
+                      "estimating the threshold [%default]")
+
+    parser.add_option("--cutoff", dest="cutoff", type="int",
+                      help="counts separating the cells from the "
+                      "background, in place of the estimated threshold, "
+                      "without --background-bamfile [%default]")
+
+    parser.add_option("--ambient-genes", dest="ambient_genes", type="int",
+                      help="number of ambient genes to estimate the "
+                      "contamination from [%default]")
+
+    parser.add_option("--min-gene-counts", dest="min_gene_counts",
+                      type="int",
+                      help="background counts needed for an ambient gene "
+                      "[%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        background_bamfile=None,
+        profile=None,
+        contamination=None,
+        count="umis",
+        method="inflection",
+        min_count=10,
+        cutoff=None,
+        ambient_genes=20,
+        min_gene_counts=10,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile or not options.profile or \
+       not options.contamination:
+        raise ValueError("--bamfile, --profile and --contamination are "
+                         "required")
+
+    profile, contamination = ambientProfile(
+        options.bamfile, options.background_bamfile,
+        count=options.count, method=options.method,
+        min_count=options.min_count, cutoff=options.cutoff,
+        n_ambient_genes=options.ambient_genes,
+        min_gene_counts=options.min_gene_counts)
+
+    profile.to_csv(options.profile, sep="\t", index=False)
+    contamination.to_csv(options.contamination, sep="\t", index=False)
+
+    E.info("median contamination: %.4f" %
+           contamination["contamination"].median())
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,240 @@
+'''
+bam_state.py - track whether a BAM is coordinate sorted and indexed
+====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Make a coordinate sorted and indexed copy of a BAM for ``umi_tools
+group/dedup``, but only sort it if it isn't already sorted.
+
+The sort order and index state of a BAM are recorded in a sidecar
+manifest, ``<bamfile>.state``, along with the size and modification
+time of the BAM so a manifest for an older version of the BAM is
+ignored. Where there is no valid manifest, the state is verified:
+
+* a BAM with an index newer than itself is sorted, as ``samtools
+  index`` fails on an unsorted BAM
+* a BAM with ``SO:coordinate`` in its header is indexed, which checks
+  it is sorted. The header alone can't be trusted as tools which
+  rewrite a BAM often copy the header as is (e.g ``featureCounts -R
+  BAM``)
+* otherwise, the BAM is unsorted
+
+With `sorted_bam`, a sorted BAM is linked to `sorted_bam` (along with
+its index), while an unsorted BAM is sorted into `sorted_bam` with
+`threads` threads, `memory` per thread and temporary files in
+`tmpdir`, and then indexed.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python bam_state.py --bamfile=mapped/sample.bam.featureCounts.bam
+   --sorted-bam=/tmp/xyz/sample.bam --threads=4 --memory=2G
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import os
+import sys
+
+import pysam
+
+import CGAT.Experiment as E
+
+
+BamState = collections.namedtuple(
+    "BamState", ["size", "mtime_ns", "sort_order", "indexed"])
+
+
+def manifestFile(bamfile):
+    return bamfile + ".state"
+
+
+def _stat(bamfile):
+    stat = os.stat(bamfile)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _indexFile(bamfile):
+    '''return the index of `bamfile` if there is one newer than it'''
+
+    for index in (bamfile + ".bai", bamfile[:-len(".bam")] + ".bai",
+                  bamfile + ".csi"):
+        if (os.path.exists(index) and
+                os.stat(index).st_mtime_ns >= os.stat(bamfile).st_mtime_ns):
+            return index
+    return None
+
+
+def readState(bamfile):
+    '''return the :class:`BamState` recorded for `bamfile`, or None if
+    there is none or it was recorded for a different version of the
+    BAM'''
+
+    if not os.path.exists(manifestFile(bamfile)):
+        return None
+
+    with open(manifestFile(bamfile)) as inf:
+        values = dict(line.rstrip("\n").split("\t") for line in inf)
+
+    state = BamState(int(values["size"]), int(values["mtime_ns"]),
+                     values["sort_order"], values["indexed"] == "1")
+
+    if (state.size, state.mtime_ns) != _stat(bamfile):
+        return None
+
+    if state.indexed and _indexFile(bamfile) is None:
+        return None
+
+    return state
+
+
+def writeState(bamfile, sort_order, indexed):
+    '''record the state of `bamfile`'''
+
+    size, mtime_ns = _stat(bamfile)
+
+    # BAMs may be checked by concurrent tasks, so write to a temporary
+    # file and rename
+    tmpfile = "%s.%i" % (manifestFile(bamfile), os.getpid())
+    with open(tmpfile, "w") as outf:
+        outf.write("size\t%i\nmtime_ns\t%i\nsort_order\t%s\nindexed\t%i\n" % (
+            size, mtime_ns, sort_order, indexed))
+    os.replace(tmpfile, manifestFile(bamfile))
+
+    return BamState(size, mtime_ns, sort_order, indexed)
+
+
+def getState(bamfile):
+    '''return the :class:`BamState` of `bamfile`, verifying and
+    recording it if it hasn't been recorded already'''
+
+    state = readState(bamfile)
+    if state is not None:
+        return state
+
+    if _indexFile(bamfile) is not None:
+        return writeState(bamfile, "coordinate", True)
+
+    with pysam.AlignmentFile(bamfile) as inbam:
+        header_order = inbam.header.to_dict().get("HD", {}).get("SO")
+
+    if header_order != "coordinate":
+        return writeState(bamfile, header_order or "unknown", False)
+
+    tmp_index = "%s.bai.%i" % (bamfile, os.getpid())
+    try:
+        pysam.index(bamfile, tmp_index)
+    except pysam.SamtoolsError:
+        if os.path.exists(tmp_index):
+            os.unlink(tmp_index)
+        E.warn("%s has SO:coordinate in its header but is not sorted" %
+               bamfile)
+        return writeState(bamfile, "unsorted", False)
+
+    os.replace(tmp_index, bamfile + ".bai")
+
+    return writeState(bamfile, "coordinate", True)
+
+
+def _link(source, target):
+    if os.path.lexists(target):
+        os.unlink(target)
+    os.symlink(os.path.abspath(source), target)
+
+
+def sortedBam(bamfile, sorted_bam, threads=1, memory="768M", tmpdir=None):
+    '''make a coordinate sorted and indexed `sorted_bam` from
+    `bamfile`, linking to `bamfile` if it is already sorted.
+
+    Returns True if `bamfile` was sorted.
+    '''
+
+    state = getState(bamfile)
+
+    if state.sort_order == "coordinate" and state.indexed:
+        _link(bamfile, sorted_bam)
+        _link(_indexFile(bamfile), sorted_bam + ".bai")
+        return False
+
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(sorted_bam))
+    prefix = os.path.join(tmpdir, os.path.basename(sorted_bam) + ".tmp")
+
+    pysam.sort("-@", str(threads), "-m", memory, "-T", prefix,
+               "-o", sorted_bam, bamfile)
+    pysam.index(sorted_bam)
+
+    return True
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="BAM to check [%default]")
+
+    parser.add_option("--sorted-bam", dest="sorted_bam", type="string",
+                      help="make a sorted and indexed BAM, or a link to "
+                      "the BAM if it is already sorted [%default]")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="samtools sort threads [%default]")
+
+    parser.add_option("--memory", dest="memory", type="string",
+                      help="samtools sort memory per thread [%default]")
+
+    parser.add_option("--tmpdir", dest="tmpdir", type="string",
+                      help="directory for the samtools sort temporary "
+                      "files, defaults to that of --sorted-bam [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        sorted_bam=None,
+        threads=1,
+        memory="768M",
+        tmpdir=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.bamfile is None:
+        raise ValueError("--bamfile is required")
+
+    if options.sorted_bam:
+        if sortedBam(options.bamfile, options.sorted_bam,
+                     threads=options.threads, memory=options.memory,
+                     tmpdir=options.tmpdir):
+            E.info("sorted %s into %s" % (options.bamfile,
+                                          options.sorted_bam))
+        else:
+            E.info("%s is already sorted and indexed" % options.bamfile)
+    else:
+        state = getState(options.bamfile)
+        options.stdout.write("sort_order\tindexed\n%s\t%i\n" % (
+            state.sort_order, state.indexed))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,600 @@
+'''
+barcode_codec.py - pack barcodes and UMIs into integers
+=========================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Python strings cost ~50 bytes+ each, so keying counters on cell
+barcodes and UMIs (``cell_umi_counts``, ``cell_barcode_counts_all``,
+``counts[cell].add(umi)`` etc in the notebooks) runs out of memory
+with tens of millions of distinct (cell, UMI) pairs. This module
+packs sequences into integers and provides NumPy-backed count tables
+keyed on those integers.
+
+Encoding
+--------
+
+Each base is packed into 2 bits (A=0, C=1, G=2, T=3), with the first
+base in the most significant bits. Positions holding an N are encoded
+as A and flagged in an N mask stored above the bases, i.e::
+
+    code = (n_mask << 2 * length) | bases
+
+Sequences without Ns therefore have the plain 2-bit code. A sequence
+of length L needs 2L bits, or 3L bits if it contains an N, so
+sequences up to 32bp (21bp with Ns) fit in a uint64 and 16bp (10bp
+with Ns) fit in a uint32. See :func:`codeDtype`. The length is not
+stored in the code and must be supplied to decode.
+
+Count tables
+------------
+
+:class:`CountTable` counts integer keys (e.g reads per cell barcode)
+and :class:`PairCountTable` counts pairs of integer keys (e.g reads
+per cell barcode and UMI, from which the unique UMIs per cell can be
+obtained). Both buffer additions and periodically compact them into
+sorted key and count arrays so that single additions from a per-read
+loop are cheap. Each buffer is sorted into a run of its own, and runs
+are only merged with runs of a similar size, so a key is re-sorted a
+logarithmic number of times over the additions rather than the whole
+table being re-sorted on every flush of the buffer.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import barcode_codec
+
+   cell_counts = barcode_codec.CountTable()
+   cell_umi_counts = barcode_codec.PairCountTable()
+
+   for cell, umi in barcodes:
+       cell_code = barcode_codec.encodeOne(cell)
+       cell_counts.add(cell_code)
+       cell_umi_counts.add(cell_code, barcode_codec.encodeOne(umi))
+
+   cells, n_umis = cell_umi_counts.uniqueCounts()
+   cells = barcode_codec.decode(cells, 16)
+
+'''
+
+import array
+
+import numpy as np
+
+
+BASES = "ACGT"
+BASE2CODE = {"A": 0, "C": 1, "G": 2, "T": 3,
+             "a": 0, "c": 1, "g": 2, "t": 3}
+
+MAX_LENGTH = 32
+MAX_LENGTH_N = 21
+
+_LOOKUP = np.full(256, 255, dtype=np.uint8)
+for _base, _code in BASE2CODE.items():
+    _LOOKUP[ord(_base)] = _code
+_LOOKUP[ord("N")] = 4
+_LOOKUP[ord("n")] = 4
+
+
+def codeDtype(length, allow_n=True):
+    '''return the smallest unsigned integer dtype which holds codes
+    for sequences of `length`'''
+
+    bits = 3 * length if allow_n else 2 * length
+
+    if bits <= 32:
+        return np.dtype(np.uint32)
+    elif bits <= 64:
+        return np.dtype(np.uint64)
+    else:
+        raise ValueError(
+            "sequences of length %i can't be packed into 64 bits" % length)
+
+
+def popcount(values):
+    '''count the set bits in an array of uint64 values'''
+
+    values = np.asarray(values, dtype=np.uint64)
+    values = values - ((values >> np.uint64(1)) &
+                       np.uint64(0x5555555555555555))
+    values = ((values & np.uint64(0x3333333333333333)) +
+              ((values >> np.uint64(2)) & np.uint64(0x3333333333333333)))
+    values = (values + (values >> np.uint64(4))) & np.uint64(
+        0x0F0F0F0F0F0F0F0F)
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def encodeOne(seq):
+    '''pack a single sequence into an integer.
+
+    Raises a KeyError for characters other than ACGTN.
+    '''
+
+    if isinstance(seq, bytes):
+        seq = seq.decode()
+
+    code = 0
+    n_mask = 0
+    for base in seq:
+        n_mask <<= 1
+        if base == "N" or base == "n":
+            n_mask |= 1
+            code <<= 2
+        else:
+            code = (code << 2) | BASE2CODE[base]
+
+    if n_mask:
+        if len(seq) > MAX_LENGTH_N:
+            raise ValueError(
+                "sequences with Ns can't be longer than %i" % MAX_LENGTH_N)
+        code |= n_mask << (2 * len(seq))
+    elif len(seq) > MAX_LENGTH:
+        raise ValueError("sequences can't be longer than %i" % MAX_LENGTH)
+
+    return code
+
+
+def decodeOne(code, length):
+    '''unpack an integer code into a sequence of `length`'''
+
+    code = int(code)
+    n_mask = code >> (2 * length)
+
+    seq = []
+    for position in range(length):
+        shift = length - 1 - position
+        if (n_mask >> shift) & 1:
+            seq.append("N")
+        else:
+            seq.append(BASES[(code >> (2 * shift)) & 3])
+
+    return "".join(seq)
+
+
+def encode(seqs, length=None):
+    '''pack `seqs` into an array of uint64 codes.
+
+    All sequences are expected to be of `length` (default: the length
+    of the first sequence). Returns the codes and a boolean array
+    flagging the sequences which could be encoded. Sequences of the
+    wrong length, containing characters other than ACGTN or
+    containing an N and longer than 21bp are given a code of 0 and
+    flagged as not valid.
+    '''
+
+    seqs = [x.decode() if isinstance(x, bytes) else x for x in seqs]
+    n = len(seqs)
+
+    if length is None:
+        length = len(seqs[0]) if n else 0
+
+    if length > MAX_LENGTH:
+        raise ValueError("sequences can't be longer than %i" % MAX_LENGTH)
+
+    if n == 0 or length == 0:
+        return np.zeros(n, dtype=np.uint64), np.ones(n, dtype=bool)
+
+    valid = np.fromiter((len(x) == length for x in seqs), dtype=bool,
+                        count=n)
+    if not valid.all():
+        seqs = [x if ok else "N" * length for x, ok in zip(seqs, valid)]
+
+    chars = np.frombuffer(
+        "".join(seqs).encode("ascii", "replace"),
+        dtype=np.uint8).reshape(n, length)
+
+    codes, chars_valid = encodeChars(chars)
+    valid &= chars_valid
+    codes[~valid] = 0
+
+    return codes, valid
+
+
+def encodeChars(chars):
+    '''pack a 2D uint8 array of ASCII sequences, one sequence per
+    row, into an array of uint64 codes.
+
+    Returns the codes and a boolean array flagging the rows which
+    could be encoded, as per :func:`encode`.
+    '''
+
+    n, length = chars.shape
+
+    if length > MAX_LENGTH:
+        raise ValueError("sequences can't be longer than %i" % MAX_LENGTH)
+
+    values = _LOOKUP[chars]
+
+    valid = (values != 255).all(axis=1)
+    is_n = values == 4
+    has_n = is_n.any(axis=1)
+    if length > MAX_LENGTH_N:
+        valid &= ~has_n
+    values = np.where(values < 4, values, 0)
+
+    codes = np.zeros(n, dtype=np.uint64)
+    n_mask = np.zeros(n, dtype=np.uint64)
+    for position in range(length):
+        codes = (codes << np.uint64(2)) | values[:, position].astype(
+            np.uint64)
+        n_mask = (n_mask << np.uint64(1)) | is_n[:, position].astype(
+            np.uint64)
+
+    if length <= MAX_LENGTH_N:
+        codes |= n_mask << np.uint64(2 * length)
+
+    codes[~valid] = 0
+
+    return codes, valid
+
+
+def decode(codes, length):
+    '''unpack an array of codes into a list of sequences of `length`'''
+
+    codes = np.asarray(codes, dtype=np.uint64)
+    n = len(codes)
+
+    if n == 0:
+        return []
+
+    n_mask = (codes >> np.uint64(2 * length) if length <= MAX_LENGTH_N
+              else np.zeros(n, dtype=np.uint64))
+    chars = np.empty((n, length), dtype=np.uint8)
+    lookup = np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)
+
+    for position in range(length):
+        shift = length - 1 - position
+        bases = (codes >> np.uint64(2 * shift)) & np.uint64(3)
+        is_n = (n_mask >> np.uint64(shift)) & np.uint64(1)
+        chars[:, position] = np.where(is_n, ord("N"), lookup[bases])
+
+    return [x.decode("ascii") for x in chars.view("S%i" % length).ravel()]
+
+
+def splitN(codes, length):
+    '''split codes into the 2-bit bases (Ns encoded as A) and the N
+    mask'''
+
+    codes = np.asarray(codes, dtype=np.uint64)
+
+    if length > MAX_LENGTH_N:
+        return codes, np.zeros(len(codes), dtype=np.uint64)
+
+    bases = codes & np.uint64((1 << (2 * length)) - 1)
+    return bases, codes >> np.uint64(2 * length)
+
+
+def _sumSorted(keys, counts):
+    '''sum the `counts` for each distinct value of the sorted `keys`'''
+
+    if len(keys) == 0:
+        return keys, counts
+
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def _sortRun(keys, counts):
+    '''return the distinct `keys`, sorted, and their summed `counts`.
+    The stable sort (timsort) merges already sorted runs in linear
+    time'''
+
+    order = np.argsort(keys, kind="stable")
+    return _sumSorted(keys[order], counts[order])
+
+
+def _pairOrder(keys1, keys2):
+    '''return the order sorting the pairs of unsigned `keys1` and
+    `keys2`. The pairs are compared as big-endian bytes so that the
+    stable sort merges already sorted runs in linear time, which
+    np.lexsort does not'''
+
+    pairs = np.empty(len(keys1), dtype=[
+        ("key1", keys1.dtype.newbyteorder(">")),
+        ("key2", keys2.dtype.newbyteorder(">"))])
+    pairs["key1"] = keys1
+    pairs["key2"] = keys2
+
+    return np.argsort(pairs.view("S%i" % pairs.dtype.itemsize),
+                      kind="stable")
+
+
+def _sortPairRun(keys1, keys2, counts):
+    '''as :func:`_sortRun`, for pairs of keys'''
+
+    order = _pairOrder(keys1, keys2)
+    keys1 = keys1[order]
+    keys2 = keys2[order]
+    counts = counts[order]
+
+    if len(keys1):
+        starts = np.flatnonzero(np.concatenate(
+            ([True], (keys1[1:] != keys1[:-1]) |
+             (keys2[1:] != keys2[:-1]))))
+        keys1 = keys1[starts]
+        keys2 = keys2[starts]
+        counts = np.add.reduceat(counts, starts)
+
+    return keys1, keys2, counts
+
+
+def _mergeRuns(runs, merge):
+    '''merge the last run in `runs` into the run before it while that
+    is no more than twice its size, using `merge` to combine two runs.
+    The runs are tuples of aligned arrays'''
+
+    while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+        upper = runs.pop()
+        lower = runs.pop()
+        runs.append(merge(*[np.concatenate(x) for x in zip(lower, upper)]))
+
+
+class CountTable(object):
+    '''counts keyed on integer codes.
+
+    Keys are held in a sorted array of `dtype` with an aligned array
+    of counts. Additions are buffered and sorted into a run once
+    `buffer_size` keys have been added, and the runs are merged into
+    the arrays when the table is read.
+    '''
+
+    def __init__(self, dtype=np.uint64, buffer_size=1000000):
+        self.dtype = np.dtype(dtype)
+        self.buffer_size = buffer_size
+        self._keys = np.zeros(0, dtype=self.dtype)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._runs = []
+        self._buffer = array.array("Q")
+        self._pending = []
+        self._n_pending = 0
+
+    def add(self, key):
+        '''increment the count for `key` by one'''
+        self._buffer.append(key)
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def update(self, keys, counts=None):
+        '''add an array of `keys`, with optional aligned `counts`'''
+
+        keys = np.asarray(keys).astype(self.dtype, copy=False)
+        if counts is None:
+            counts = np.ones(len(keys), dtype=np.int64)
+        else:
+            counts = np.asarray(counts, dtype=np.int64)
+
+        self._pending.append((keys, counts))
+        self._n_pending += len(keys)
+        if self._n_pending >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        '''sort the buffered additions into a run'''
+
+        pending = self._pending
+
+        if len(self._buffer):
+            keys = np.frombuffer(self._buffer, dtype=np.uint64).astype(
+                self.dtype)
+            self._buffer = array.array("Q")
+            pending.append((keys, np.ones(len(keys), dtype=np.int64)))
+
+        if pending:
+            self._pending = []
+            self._n_pending = 0
+            self._runs.append(_sortRun(
+                np.concatenate([x[0] for x in pending]),
+                np.concatenate([x[1] for x in pending])))
+            _mergeRuns(self._runs, _sortRun)
+
+    def compact(self):
+        '''merge any buffered additions into the count arrays'''
+
+        self._flush()
+
+        if self._runs:
+            runs = [(self._keys, self._counts)] + self._runs
+            self._runs = []
+            self._keys, self._counts = _sortRun(
+                *[np.concatenate(x) for x in zip(*runs)])
+
+    def merge(self, other):
+        '''add the counts from another CountTable'''
+        other.compact()
+        self.update(other._keys, other._counts)
+
+    def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+    def __getstate__(self):
+        self.compact()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def keys(self):
+        self.compact()
+        return self._keys
+
+    @property
+    def counts(self):
+        self.compact()
+        return self._counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key):
+        keys = self.keys
+        key = self.dtype.type(key)
+        ix = np.searchsorted(keys, key)
+        if ix < len(keys) and keys[ix] == key:
+            return int(self._counts[ix])
+        return 0
+
+    def __contains__(self, key):
+        return self[key] > 0
+
+    def total(self):
+        '''return the sum of all counts'''
+        return int(self.counts.sum())
+
+    def most_common(self, n=None):
+        '''return the `n` keys with the highest counts and their counts
+        as arrays, in descending order of count'''
+
+        counts = self.counts
+        order = np.argsort(-counts, kind="mergesort")
+        if n is not None:
+            order = order[:n]
+        return self._keys[order], counts[order]
+
+
+class PairCountTable(object):
+    '''counts keyed on pairs of integer codes, e.g (cell, UMI).
+
+    Pairs are held in arrays sorted by the first then the second key
+    with an aligned array of counts. Additions are buffered as per
+    :class:`CountTable`.
+    '''
+
+    def __init__(self, dtype1=np.uint64, dtype2=np.uint64,
+                 buffer_size=1000000):
+        self.dtype1 = np.dtype(dtype1)
+        self.dtype2 = np.dtype(dtype2)
+        self.buffer_size = buffer_size
+        self._keys1 = np.zeros(0, dtype=self.dtype1)
+        self._keys2 = np.zeros(0, dtype=self.dtype2)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._runs = []
+        self._buffer1 = array.array("Q")
+        self._buffer2 = array.array("Q")
+        self._pending = []
+        self._n_pending = 0
+
+    def add(self, key1, key2):
+        '''increment the count for (`key1`, `key2`) by one'''
+        self._buffer1.append(key1)
+        self._buffer2.append(key2)
+        if len(self._buffer1) >= self.buffer_size:
+            self._flush()
+
+    def update(self, keys1, keys2, counts=None):
+        '''add aligned arrays of `keys1` and `keys2`, with optional
+        aligned `counts`'''
+
+        keys1 = np.asarray(keys1).astype(self.dtype1, copy=False)
+        keys2 = np.asarray(keys2).astype(self.dtype2, copy=False)
+        if counts is None:
+            counts = np.ones(len(keys1), dtype=np.int64)
+        else:
+            counts = np.asarray(counts, dtype=np.int64)
+
+        self._pending.append((keys1, keys2, counts))
+        self._n_pending += len(keys1)
+        if self._n_pending >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        '''sort the buffered additions into a run'''
+
+        pending = self._pending
+
+        if len(self._buffer1):
+            keys1 = np.frombuffer(self._buffer1, dtype=np.uint64).astype(
+                self.dtype1)
+            keys2 = np.frombuffer(self._buffer2, dtype=np.uint64).astype(
+                self.dtype2)
+            self._buffer1 = array.array("Q")
+            self._buffer2 = array.array("Q")
+            pending.append(
+                (keys1, keys2, np.ones(len(keys1), dtype=np.int64)))
+
+        if pending:
+            self._pending = []
+            self._n_pending = 0
+            self._runs.append(_sortPairRun(
+                np.concatenate([x[0] for x in pending]),
+                np.concatenate([x[1] for x in pending]),
+                np.concatenate([x[2] for x in pending])))
+            _mergeRuns(self._runs, _sortPairRun)
+
+    def compact(self):
+        '''merge any buffered additions into the count arrays'''
+
+        self._flush()
+
+        if self._runs:
+            runs = [(self._keys1, self._keys2, self._counts)] + self._runs
+            self._runs = []
+            self._keys1, self._keys2, self._counts = _sortPairRun(
+                *[np.concatenate(x) for x in zip(*runs)])
+
+    def merge(self, other):
+        '''add the counts from another PairCountTable'''
+        other.compact()
+        self.update(other._keys1, other._keys2, other._counts)
+
+    def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+    def __getstate__(self):
+        self.compact()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def keys(self):
+        '''return the (first, second) key arrays'''
+        self.compact()
+        return self._keys1, self._keys2
+
+    @property
+    def counts(self):
+        self.compact()
+        return self._counts
+
+    def __len__(self):
+        self.compact()
+        return len(self._counts)
+
+    def __getitem__(self, keys):
+        key1, key2 = keys
+        self.compact()
+        start, end = (np.searchsorted(self._keys1, self.dtype1.type(key1)),
+                      np.searchsorted(self._keys1, self.dtype1.type(key1),
+                                      side="right"))
+        ix = start + np.searchsorted(self._keys2[start:end],
+                                     self.dtype2.type(key2))
+        if ix < end and self._keys2[ix] == key2:
+            return int(self._counts[ix])
+        return 0
+
+    def totals(self):
+        '''return the distinct first keys and the total count for each,
+        e.g reads per cell'''
+
+        self.compact()
+        return _sumSorted(self._keys1, self._counts)
+
+    def uniqueCounts(self):
+        '''return the distinct first keys and the number of distinct
+        second keys for each, e.g unique UMIs per cell'''
+
+        self.compact()
+        return _sumSorted(self._keys1,
+                          np.ones(len(self._keys1), dtype=np.int64))
@@ -0,0 +1,416 @@
+'''
+barcode_store.py - memory-mapped counts and metadata per cell barcode
+=====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Store the counts per cell barcode (reads and unique UMIs from
+extract_barcodes.py, alevin ``frequency.txt`` and ``MappedUmi.txt``
+etc) and the whitelist metadata in a directory of ``.npy`` arrays which
+are memory-mapped when the store is opened. The analyses can then look
+up barcodes or take the top cells without parsing the text tables into
+per-cell dictionaries (``CB_counts``, ``whitelist_counts``,
+``error2true`` etc in the notebooks), and the processes reading a
+store share its pages rather than each having a copy.
+
+The store holds:
+
+barcodes.npy
+   the barcodes packed with :mod:`barcode_codec`, in blocks of barcodes
+   of the same length, sorted by code within each block
+<column>.npy
+   a count or metadata column, aligned with the barcodes
+rank.npy
+   the rows in descending order of the `rank_column` counts
+store.tsv
+   the columns, the rank column and the rows of each block of barcodes
+
+With a whitelist, the ``whitelisted`` column flags the whitelisted
+barcodes and the ``corrected_to`` column is the row of the whitelisted
+barcode each barcode is corrected to (itself for the whitelisted
+barcodes), or -1.
+
+Opening a store only reads store.tsv. A barcode is found by a binary
+search of its block, so only the pages touched are read.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   # write a store
+   python barcode_store.py --store=sample_barcodes.store
+   --counts-table=sample_barcode_counts.tsv --whitelist=sample_whitelist.tsv
+
+   # the top 10 barcodes
+   python barcode_store.py --store=sample_barcodes.store --top=10
+
+.. code-block:: python
+
+   store = barcode_store.BarcodeStore("sample_barcodes.store")
+   reads = store.get("AAACCTGAGAAACCAT", "reads")
+   top = store.top(1000)
+   cells = store.barcodes(top)
+   whitelist_reads = store.column("reads")[top]
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+import barcode_codec
+
+
+def _findRows(keys, blocks, barcodes):
+    '''return the rows of `barcodes` in the sorted `keys` with `blocks`
+    of rows for each barcode length, or -1 for missing barcodes'''
+
+    rows = np.full(len(barcodes), -1, dtype=np.int64)
+    lengths = np.fromiter((len(x) for x in barcodes), dtype=np.int64,
+                          count=len(barcodes))
+
+    for length, (start, end) in blocks.items():
+        ix = np.flatnonzero(lengths == length)
+        if len(ix) == 0 or start == end:
+            continue
+
+        codes, valid = barcode_codec.encode([barcodes[x] for x in ix],
+                                            length)
+        block = keys[start:end]
+        positions = np.minimum(np.searchsorted(block, codes), end - start - 1)
+        found = valid & (block[positions] == codes)
+        rows[ix[found]] = start + positions[found]
+
+    return rows
+
+
+class BarcodeStore(object):
+    '''a store written by :func:`writeStore`, with its arrays
+    memory-mapped'''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.columns = []
+        self.rank_column = None
+        self.blocks = collections.OrderedDict()
+
+        with open(os.path.join(store_dir, "store.tsv")) as inf:
+            for line in inf:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] == "columns":
+                    self.columns = fields[1].split(",") if fields[1] else []
+                elif fields[0] == "rank_column":
+                    self.rank_column = fields[1] or None
+                elif fields[0] == "block":
+                    self.blocks[int(fields[1])] = (int(fields[2]),
+                                                   int(fields[3]))
+
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(
+                os.path.join(self.store_dir, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def keys(self):
+        return self._array("barcodes")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def column(self, name):
+        '''return the memory-mapped array of column `name`'''
+
+        if name not in self.columns:
+            raise ValueError("%s has no %s column" % (self.store_dir, name))
+        return self._array(name)
+
+    def rows(self, barcodes):
+        '''return the rows of `barcodes`, -1 where they aren't in the
+        store'''
+
+        return _findRows(self.keys, self.blocks, barcodes)
+
+    def get(self, barcode, column, default=None):
+        '''return the `column` value of `barcode`'''
+
+        row = self.rows([barcode])[0]
+        if row < 0:
+            return default
+        return self.column(column)[row]
+
+    def __contains__(self, barcode):
+        return self.rows([barcode])[0] >= 0
+
+    def barcodes(self, rows):
+        '''return the barcodes in `rows`'''
+
+        rows = np.asarray(rows, dtype=np.int64)
+        barcodes = np.empty(len(rows), dtype=object)
+        for length, (start, end) in self.blocks.items():
+            ix = np.flatnonzero((rows >= start) & (rows < end))
+            if len(ix):
+                barcodes[ix] = barcode_codec.decode(self.keys[rows[ix]],
+                                                    length)
+        return list(barcodes)
+
+    def top(self, n=None):
+        '''return the rows of the top `n` barcodes by the rank column'''
+
+        if self.rank_column is None:
+            raise ValueError("%s has no rank column" % self.store_dir)
+        return self._array("rank")[:n]
+
+    def corrections(self, rows=None):
+        '''return the rows of the barcodes which are corrected to a
+        whitelisted barcode (or all the barcodes in `rows` which are),
+        and the rows of the whitelisted barcodes'''
+
+        corrected_to = self.column("corrected_to")
+        if rows is None:
+            rows = np.flatnonzero(corrected_to >= 0)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            rows = rows[corrected_to[rows] >= 0]
+        return rows, corrected_to[rows]
+
+
+def writeStore(store_dir, barcodes, columns, rank_column=None,
+               corrections=None):
+    '''write a store of `barcodes` with the `columns` (a dictionary of
+    arrays aligned with the barcodes), ranked by `rank_column`.
+
+    `corrections` maps barcodes to the whitelisted barcodes they are
+    corrected to, for the ``corrected_to`` column.
+    '''
+
+    lengths = np.fromiter((len(x) for x in barcodes), dtype=np.int64,
+                          count=len(barcodes))
+
+    keys = []
+    order = []
+    blocks = collections.OrderedDict()
+    start = 0
+    for length in np.unique(lengths):
+        ix = np.flatnonzero(lengths == length)
+        codes, valid = barcode_codec.encode([barcodes[x] for x in ix],
+                                            int(length))
+        if not valid.all():
+            raise ValueError("can't encode the barcode %s" %
+                             barcodes[ix[np.argmin(valid)]])
+
+        sort = np.argsort(codes, kind="mergesort")
+        codes = codes[sort]
+        if (codes[1:] == codes[:-1]).any():
+            raise ValueError("duplicate barcodes of length %i" % length)
+
+        keys.append(codes)
+        order.append(ix[sort])
+        blocks[int(length)] = (start, start + len(ix))
+        start += len(ix)
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+    order = np.concatenate(order) if order else np.zeros(0, dtype=np.int64)
+
+    arrays = collections.OrderedDict(
+        (name, np.asarray(values)[order]) for name, values in columns.items())
+
+    if corrections is not None:
+        whitelisted = set(corrections.values())
+        arrays["whitelisted"] = np.array(
+            [barcodes[x] in whitelisted for x in order], dtype=bool)
+
+        errors = list(corrections)
+        rows = _findRows(keys, blocks, errors)
+        found = rows >= 0
+        corrected_to = np.full(len(keys), -1, dtype=np.int64)
+        corrected_to[rows[found]] = _findRows(
+            keys, blocks, [corrections[x] for x, ok in zip(errors, found)
+                           if ok])
+        arrays["corrected_to"] = corrected_to
+
+    if rank_column is not None:
+        rank = np.argsort(-arrays[rank_column].astype(np.int64),
+                          kind="mergesort")
+    else:
+        rank = None
+
+    # readers keep the old store while the new one is written
+    tmpdir = "%s.%i.tmp" % (store_dir.rstrip("/"), os.getpid())
+    os.makedirs(tmpdir)
+    np.save(os.path.join(tmpdir, "barcodes.npy"), keys)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmpdir, name + ".npy"), values)
+    if rank is not None:
+        np.save(os.path.join(tmpdir, "rank.npy"), rank)
+
+    with open(os.path.join(tmpdir, "store.tsv"), "w") as outf:
+        outf.write("columns\t%s\n" % ",".join(arrays))
+        outf.write("rank_column\t%s\n" % (rank_column or ""))
+        for length, (start, end) in blocks.items():
+            outf.write("block\t%i\t%i\t%i\n" % (length, start, end))
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmpdir, store_dir)
+
+
+def readCountsTable(infile):
+    '''return the barcodes and count columns of an extract_barcodes.py
+    counts table'''
+
+    df = pd.read_csv(infile, sep="\t", dtype={0: str}, index_col=0)
+    return df.index.tolist(), collections.OrderedDict(
+        (x, df[x].values.astype(np.int64)) for x in df.columns)
+
+
+def readFrequencies(infile):
+    '''return the counts per barcode in a tab separated barcode and
+    count file without a header, e.g alevin frequency.txt'''
+
+    df = pd.read_csv(infile, sep="\t", header=None, names=["barcode", "count"],
+                     usecols=[0, 1], dtype={"barcode": str})
+    return df["barcode"].tolist(), df["count"].values.astype(np.int64)
+
+
+def readCorrections(infile):
+    '''return the whitelisted barcode each barcode in an ``umi_tools
+    whitelist`` format whitelist is corrected to'''
+
+    corrections = {}
+    with IOTools.openFile(infile, "r") as inf:
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            corrections[fields[0]] = fields[0]
+            if len(fields) > 1 and fields[1]:
+                for error in fields[1].split(","):
+                    corrections[error] = fields[0]
+    return corrections
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--store", dest="store", type="string",
+                      help="store directory [%default]")
+
+    parser.add_option("--counts-table", dest="counts_table", type="string",
+                      help="extract_barcodes.py counts table to store "
+                      "[%default]")
+
+    parser.add_option("--counts", dest="counts", type="string",
+                      action="append",
+                      help="column:file of barcode and count files to "
+                      "store, e.g mapped_umis:MappedUmi.txt, can be given "
+                      "more than once [%default]")
+
+    parser.add_option("--whitelist", dest="whitelist", type="string",
+                      help="whitelist of the barcodes, to store the "
+                      "whitelisted and corrected barcodes [%default]")
+
+    parser.add_option("--rank-column", dest="rank_column", type="string",
+                      help="column to rank the barcodes by, by default "
+                      "the first column [%default]")
+
+    parser.add_option("--barcode", dest="barcodes", type="string",
+                      action="append",
+                      help="barcode to report from the store, can be "
+                      "given more than once [%default]")
+
+    parser.add_option("--top", dest="top", type="int",
+                      help="report the top N barcodes from the store "
+                      "[%default]")
+
+    parser.set_defaults(
+        store=None,
+        counts_table=None,
+        counts=[],
+        whitelist=None,
+        rank_column=None,
+        barcodes=[],
+        top=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.store:
+        raise ValueError("--store is required")
+
+    if options.counts_table or options.counts:
+        frames = []
+        if options.counts_table:
+            barcodes, columns = readCountsTable(options.counts_table)
+            frames.append(pd.DataFrame(columns, index=barcodes))
+        for counts in options.counts:
+            column, _, infile = counts.partition(":")
+            if not infile:
+                raise ValueError("--counts should be column:file: %s" %
+                                 counts)
+            barcodes, values = readFrequencies(infile)
+            frames.append(pd.DataFrame({column: values}, index=barcodes))
+
+        # barcodes missing from a file have no counts in it
+        df = pd.concat(frames, axis=1).fillna(0).astype(np.int64)
+
+        corrections = None
+        if options.whitelist:
+            corrections = readCorrections(options.whitelist)
+
+        writeStore(options.store, df.index.tolist(),
+                   collections.OrderedDict(
+                       (x, df[x].values) for x in df.columns),
+                   rank_column=options.rank_column or df.columns[0],
+                   corrections=corrections)
+
+        E.info("stored %i barcodes in %s" % (len(df), options.store))
+
+    elif options.barcodes or options.top:
+        store = BarcodeStore(options.store)
+        if options.barcodes:
+            rows = store.rows(options.barcodes)
+            rows = rows[rows >= 0]
+        else:
+            rows = store.top(options.top)
+
+        options.stdout.write("\t".join(["barcode"] + store.columns) + "\n")
+        for barcode, row in zip(store.barcodes(rows), rows):
+            options.stdout.write("\t".join(
+                [barcode] + [str(store.column(x)[row])
+                             for x in store.columns]) + "\n")
+
+    else:
+        raise ValueError("--counts-table or --counts to write a store, or "
+                         "--barcode or --top to read one, are required")
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
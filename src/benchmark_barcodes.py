@@ -0,0 +1,647 @@
+'''
+benchmark_barcodes.py - benchmark the cell barcode and UMI hot paths
+=====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Time and memory profile the cell barcode and UMI processing on
+synthetic data, sweeping the UMI length, saturation and number of
+cells, and write the results as a tab separated table which can be
+appended to from run to run, so performance regressions show up
+between commits.
+
+The synthetic samples have `n_cells` random cell barcodes with
+`molecules_per_cell` random UMIs each. Every molecule is read at least
+once and the remaining reads are spread at random over the molecules,
+so the sequencing saturation (1 - molecules / reads, as per the 10X
+``seq_sat``) is exactly `saturation`. Read 1 is laid out as per the
+10X (``CCCCCCCCCCCCCCCCNNNNNNNNNN``), Drop-seq
+(``CCCCCCCCCCCCNNNNNNNN``) or inDrop (regex) barcode patterns, with
+the UMIs of the sweep length.
+
+The benchmarks are:
+
+adjacency
+   :func:`umi_adjacency.getAdjacency` on random unique UMIs. As per
+   notebooks/adj_list_memory_usage.ipynb, the saturation here is the
+   fraction of the possible UMIs of the length present, and the number
+   of cells is not used
+whitelist_build, whitelist_correct
+   building a :class:`whitelist_index.WhitelistIndex` from the 10X
+   cell barcodes, and correcting the cell barcodes of the reads, of
+   which `error_rate` have a substitution or an N
+extract
+   :meth:`extract_barcodes.BarcodePattern.extract` on the read 1
+   sequences
+count
+   :func:`extract_barcodes.countBarcodes` on a read 1 fastq (a single
+   process)
+dedup
+   :func:`dedup_groups.dedupGroups` on a BAM and ``umi_tools group``
+   table with a group per molecule
+
+Each benchmark is run `repeats` times for the minimum and median run
+times, then once more under :mod:`tracemalloc` for the peak memory
+allocated (numpy arrays included).
+
+With `compare`, the run times are compared with the latest results
+for the same benchmarks and parameters in a previous results table,
+and a warning is logged for each which is more than `tolerance`
+slower.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python benchmark_barcodes.py --benchmarks=adjacency,count
+   --umi-lengths=6,8,10 --saturations=0.25,0.5,0.75
+   --cell-numbers=100,1000 --results=benchmarks.tsv
+   --compare=benchmarks.tsv
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import gzip
+import itertools
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pysam
+
+import CGAT.Experiment as E
+
+import barcode_codec
+import dedup_groups
+import extract_barcodes
+import umi_adjacency
+import whitelist_index
+
+
+BENCHMARKS = ("adjacency", "whitelist", "extract", "count", "dedup")
+
+PATTERNS = ("10X", "dropseq", "indrop")
+
+# the cell barcode lengths of the string patterns
+_CELL_LENGTHS = {"10X": 16, "dropseq": 12}
+
+_INDROP_ADAPTER = b"GAGTGATTGCTTGTGACGCCTT"
+
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+RESULT_COLUMNS = ("benchmark", "pattern", "umi_length", "saturation",
+                  "n_cells", "items", "repeats", "min_seconds",
+                  "median_seconds", "items_per_second", "peak_memory",
+                  "commit", "timestamp", "host", "python", "numpy")
+
+# the columns which identify a benchmark case
+_CASE_COLUMNS = RESULT_COLUMNS[:6]
+
+Sample = collections.namedtuple(
+    "Sample", ["cells", "read_cells", "read_umis", "read_molecules"])
+
+
+##############################################################################
+#  Synthetic data
+##############################################################################
+
+def getRandomUMIs(n, length, rng):
+    '''return `n` unique random sequences of `length`, as bytes'''
+
+    possible = 4 ** length
+    if n > possible:
+        raise ValueError("there are only %i UMIs of length %i" % (
+            possible, length))
+
+    if n < 0.1 * possible:
+        codes = np.zeros(0, dtype=np.uint64)
+        while len(codes) < n:
+            codes = np.unique(np.concatenate(
+                [codes, rng.integers(0, possible, size=n - len(codes),
+                                     dtype=np.uint64)]))
+        rng.shuffle(codes)
+    else:
+        codes = rng.choice(possible, n, replace=False).astype(np.uint64)
+
+    return [x.encode() for x in barcode_codec.decode(codes, length)]
+
+
+def randomChars(n, length, rng):
+    '''return `n` random sequences of `length` as the rows of a uint8
+    array'''
+
+    return _BASES[rng.integers(0, 4, size=(n, length))]
+
+
+def simulateSample(n_cells, umi_length, saturation, molecules_per_cell,
+                   rng, cell_length=16):
+    '''return a :class:`Sample` of `n_cells` cells with
+    `molecules_per_cell` molecules each, sequenced to `saturation`.
+
+    The reads are given as aligned arrays of the cell index, UMI
+    (uint8 rows) and molecule index, in random order.
+    '''
+
+    if not 0 <= saturation < 1:
+        raise ValueError("saturation must be in [0, 1): %s" % saturation)
+
+    cells = getRandomUMIs(n_cells, cell_length, rng)
+
+    n_molecules = n_cells * molecules_per_cell
+    molecule_umis = randomChars(n_molecules, umi_length, rng)
+
+    n_reads = int(round(n_molecules / (1.0 - saturation)))
+    read_molecules = np.concatenate(
+        [np.arange(n_molecules),
+         rng.integers(0, n_molecules, size=n_reads - n_molecules)])
+    rng.shuffle(read_molecules)
+
+    return Sample(cells, read_molecules // molecules_per_cell,
+                  molecule_umis[read_molecules], read_molecules)
+
+
+def barcodePattern(pattern, umi_length):
+    '''return the barcode pattern and extract method for the read 1
+    layout `pattern`, with UMIs of `umi_length`'''
+
+    if pattern in _CELL_LENGTHS:
+        return "C" * _CELL_LENGTHS[pattern] + "N" * umi_length, "string"
+    elif pattern == "indrop":
+        return ("(?P<cell_1>.{8,12})(?P<discard_2>%s)"
+                "(?P<cell_3>.{8})(?P<umi_1>.{%i})T{3}.*" % (
+                    _INDROP_ADAPTER.decode(), umi_length), "regex")
+    raise ValueError("unknown barcode pattern: %s" % pattern)
+
+
+def read1Sequences(sample, pattern, rng):
+    '''return the read 1 sequences (bytes) for the reads of `sample`
+    laid out as per `pattern`'''
+
+    n_reads = len(sample.read_cells)
+    poly_t = np.full((n_reads, 6), ord("T"), dtype=np.uint8)
+
+    if pattern in _CELL_LENGTHS:
+        cell_length = _CELL_LENGTHS[pattern]
+        cells = np.frombuffer(
+            b"".join(x[:cell_length] for x in sample.cells),
+            dtype=np.uint8).reshape(-1, cell_length)
+        chars = np.hstack([cells[sample.read_cells], sample.read_umis,
+                           poly_t])
+        return list(chars.view("S%i" % chars.shape[1]).ravel())
+
+    elif pattern == "indrop":
+        # inDrop cell barcodes are 8-12bp + 8bp, either side of the
+        # adapter
+        splits = rng.integers(8, 13, size=len(sample.cells))
+        prefixes = [x[:split] for x, split in zip(sample.cells, splits)]
+        suffixes = list(randomChars(len(sample.cells), 8, rng).view(
+            "S8").ravel())
+        umis = sample.read_umis.view(
+            "S%i" % sample.read_umis.shape[1]).ravel()
+        return [prefixes[cell] + _INDROP_ADAPTER + suffixes[cell] + umi +
+                b"TTTTTT" for cell, umi in zip(sample.read_cells, umis)]
+
+    raise ValueError("unknown barcode pattern: %s" % pattern)
+
+
+def addErrors(barcodes, error_rate, rng):
+    '''return `barcodes` (bytes) with a random substitution or N in
+    `error_rate` of them'''
+
+    length = len(barcodes[0])
+    chars = np.frombuffer(b"".join(barcodes), dtype=np.uint8).reshape(
+        -1, length).copy()
+
+    errors = np.flatnonzero(rng.random(len(barcodes)) < error_rate)
+    positions = rng.integers(0, length, size=len(errors))
+    # a quarter of the errors are Ns, the rest substitutions
+    bases = rng.integers(0, 4, size=len(errors))
+    replacements = np.where(
+        rng.random(len(errors)) < 0.25, ord("N"),
+        _BASES[(np.searchsorted(_BASES, chars[errors, positions]) +
+                bases % 3 + 1) % 4])
+    chars[errors, positions] = replacements
+
+    return list(chars.view("S%i" % length).ravel())
+
+
+def writeFastq(outfile, seqs):
+    '''write read 1 sequences to a gzipped fastq'''
+
+    with gzip.open(outfile, "wb", compresslevel=1) as outf:
+        for ix, seq in enumerate(seqs):
+            outf.write(b"@read%i\n%s\n+\n%s\n" % (
+                ix, seq, b"I" * len(seq)))
+
+
+def writeGroupedBam(outbam, outtsv, sample):
+    '''write the reads of `sample` as the ``umi_tools group`` BAM and
+    table for :mod:`dedup_groups`, one group per molecule'''
+
+    order = np.argsort(sample.read_molecules, kind="mergesort")
+    header = {"HD": {"VN": "1.0"},
+              "SQ": [{"SN": "chr1", "LN": 100000000}]}
+
+    with pysam.AlignmentFile(outbam, "wb", header=header) as outf, \
+            open(outtsv, "w") as tsv:
+        tsv.write("read_id\tgene\tunique_id\n")
+        for ix, read_ix in enumerate(order):
+            molecule = int(sample.read_molecules[read_ix])
+            read = pysam.AlignedSegment(outf.header)
+            read.query_name = "read%i" % read_ix
+            read.reference_id = 0
+            read.reference_start = molecule % 99999000
+            read.mapping_quality = 60 - ix % 2
+            read.cigarstring = "50M"
+            read.query_sequence = "A" * 50
+            read.set_tag("NH", 1 + ix % 3)
+            read.set_tag("UG", molecule)
+            outf.write(read)
+            tsv.write("read%i\tgene%i\t%i\n" % (
+                read_ix, sample.read_cells[read_ix], molecule))
+
+
+##############################################################################
+#  Benchmarks
+##############################################################################
+
+def timeCall(func, repeats=3):
+    '''return the minimum and median run times of `func` over
+    `repeats` calls, and the peak memory allocated by a further call'''
+
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), float(np.median(times)), peak
+
+
+def _dedup(inbam, intsv, outbam):
+    with pysam.AlignmentFile(inbam) as inf, \
+            pysam.AlignmentFile(outbam, "wb", template=inf) as outf, \
+            open(intsv) as tsv:
+        dedup_groups.dedupGroups(
+            inf, outf, dedup_groups.iterateGroupTable(tsv))
+
+
+class BenchmarkSuite(object):
+    '''run the benchmarks over a sweep of UMI lengths, saturations and
+    cell numbers'''
+
+    def __init__(self, benchmarks=BENCHMARKS, umi_lengths=(6, 8, 10),
+                 saturations=(0.25, 0.5, 0.75), cell_numbers=(100, 1000),
+                 patterns=PATTERNS, molecules_per_cell=50, error_rate=0.05,
+                 repeats=3, seed=1, tmpdir=None):
+
+        unknown = set(benchmarks).difference(BENCHMARKS)
+        if unknown:
+            raise ValueError("unknown benchmarks: %s" % ",".join(
+                sorted(unknown)))
+
+        self.benchmarks = benchmarks
+        self.umi_lengths = umi_lengths
+        self.saturations = saturations
+        self.cell_numbers = cell_numbers
+        self.patterns = patterns
+        self.molecules_per_cell = molecules_per_cell
+        self.error_rate = error_rate
+        self.repeats = repeats
+        self.seed = seed
+        self.tmpdir = tmpdir
+
+    def _rng(self, *case):
+        # each case has its own data, whichever benchmarks are run
+        return np.random.default_rng([self.seed] + [
+            int(x * 1000) for x in case])
+
+    def _row(self, benchmark, pattern, umi_length, saturation, n_cells,
+             items, func):
+        min_seconds, median_seconds, peak = timeCall(func, self.repeats)
+        E.info("%s %s umi_length=%s saturation=%s n_cells=%s: %.3fs" % (
+            benchmark, pattern, umi_length, saturation, n_cells,
+            min_seconds))
+        return collections.OrderedDict((
+            ("benchmark", benchmark),
+            ("pattern", pattern),
+            ("umi_length", umi_length),
+            ("saturation", saturation),
+            ("n_cells", n_cells),
+            ("items", items),
+            ("repeats", self.repeats),
+            ("min_seconds", min_seconds),
+            ("median_seconds", median_seconds),
+            ("items_per_second", items / min_seconds if min_seconds else 0),
+            ("peak_memory", peak)))
+
+    def runAdjacency(self):
+        for umi_length, saturation in itertools.product(
+                self.umi_lengths, self.saturations):
+            rng = self._rng(umi_length, saturation)
+            umis = getRandomUMIs(
+                max(int(round(saturation * 4 ** umi_length)), 1),
+                umi_length, rng)
+            yield self._row(
+                "adjacency", "", umi_length, saturation, "", len(umis),
+                lambda: umi_adjacency.getAdjacency(umis))
+
+    def runSample(self, umi_length, saturation, n_cells, tmpdir):
+        '''run the benchmarks on a synthetic sample'''
+
+        rng = self._rng(umi_length, saturation, n_cells)
+        sample = simulateSample(n_cells, umi_length, saturation,
+                                self.molecules_per_cell, rng)
+        n_reads = len(sample.read_cells)
+        case = (umi_length, saturation, n_cells, n_reads)
+
+        if "whitelist" in self.benchmarks:
+            whitelist = sample.cells
+            queries = addErrors([sample.cells[x] for x in sample.read_cells],
+                                self.error_rate, rng)
+            index = whitelist_index.WhitelistIndex(whitelist)
+            yield self._row(
+                "whitelist_build", "10X", umi_length, saturation, n_cells,
+                len(whitelist),
+                lambda: whitelist_index.WhitelistIndex(whitelist))
+            yield self._row(
+                "whitelist_correct", "10X", umi_length, saturation, n_cells,
+                n_reads, lambda: index.correctIndices(queries))
+
+        for pattern in self.patterns:
+            if not set(("extract", "count")).intersection(self.benchmarks):
+                break
+
+            bc_pattern, method = barcodePattern(pattern, umi_length)
+            barcode_pattern = extract_barcodes.BarcodePattern(
+                bc_pattern, method)
+            seqs = read1Sequences(sample, pattern, rng)
+
+            if "extract" in self.benchmarks:
+                yield self._row(
+                    "extract", pattern, *case,
+                    func=lambda: barcode_pattern.extract(seqs))
+
+            if "count" in self.benchmarks:
+                fastq = os.path.join(tmpdir, "%s.fastq.gz" % pattern)
+                writeFastq(fastq, seqs)
+                yield self._row(
+                    "count", pattern, *case,
+                    func=lambda: extract_barcodes.countBarcodes(
+                        fastq, barcode_pattern))
+
+        if "dedup" in self.benchmarks:
+            inbam = os.path.join(tmpdir, "grouped.bam")
+            intsv = os.path.join(tmpdir, "grouped.tsv")
+            writeGroupedBam(inbam, intsv, sample)
+            yield self._row(
+                "dedup", "", *case,
+                func=lambda: _dedup(inbam, intsv,
+                                    os.path.join(tmpdir, "dedup.bam")))
+
+    def run(self):
+        '''run the benchmarks, yielding a result row for each'''
+
+        if "adjacency" in self.benchmarks:
+            for row in self.runAdjacency():
+                yield row
+
+        if not set(self.benchmarks).difference(["adjacency"]):
+            return
+
+        for umi_length, saturation, n_cells in itertools.product(
+                self.umi_lengths, self.saturations, self.cell_numbers):
+            tmpdir = tempfile.mkdtemp(dir=self.tmpdir)
+            try:
+                for row in self.runSample(umi_length, saturation, n_cells,
+                                          tmpdir):
+                    yield row
+            finally:
+                shutil.rmtree(tmpdir)
+
+
+##############################################################################
+#  Results
+##############################################################################
+
+def runInfo():
+    '''return the commit, time, host and versions the benchmarks were
+    run with'''
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+
+    return collections.OrderedDict((
+        ("commit", commit),
+        ("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("host", platform.node()),
+        ("python", platform.python_version()),
+        ("numpy", np.__version__)))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return "%.6g" % value
+    return str(value)
+
+
+def readResults(infile):
+    '''return the latest result row for each benchmark case in the
+    results table `infile`'''
+
+    results = collections.OrderedDict()
+    with open(infile) as inf:
+        header = next(inf).rstrip("\n").split("\t")
+        for line in inf:
+            if line.startswith("benchmark\t"):
+                continue
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            results[tuple(row[x] for x in _CASE_COLUMNS)] = row
+    return results
+
+
+def compareResults(rows, reference, tolerance=0.1):
+    '''compare the run times of the result `rows` with the
+    `reference` results (see :func:`readResults`).
+
+    Yields (case, reference seconds, seconds, ratio) for each row with
+    a reference and warns of the rows more than `tolerance` slower.
+    '''
+
+    for row in rows:
+        case = tuple(_format(row[x]) for x in _CASE_COLUMNS)
+        if case not in reference:
+            continue
+        reference_seconds = float(reference[case]["min_seconds"])
+        if reference_seconds == 0:
+            continue
+        ratio = row["min_seconds"] / reference_seconds
+        if ratio > 1 + tolerance:
+            E.warn("%s is %.2f times slower than at commit %s" % (
+                " ".join(x for x in case if x), ratio,
+                reference[case]["commit"]))
+        yield case, reference_seconds, row["min_seconds"], ratio
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--benchmarks", dest="benchmarks", type="string",
+                      help="comma separated benchmarks to run, from %s "
+                      "[%%default]" % ",".join(BENCHMARKS))
+
+    parser.add_option("--umi-lengths", dest="umi_lengths", type="string",
+                      help="comma separated UMI lengths [%default]")
+
+    parser.add_option("--saturations", dest="saturations", type="string",
+                      help="comma separated sequencing saturations "
+                      "[%default]")
+
+    parser.add_option("--cell-numbers", dest="cell_numbers", type="string",
+                      help="comma separated numbers of cells [%default]")
+
+    parser.add_option("--patterns", dest="patterns", type="string",
+                      help="comma separated read 1 layouts for the "
+                      "extract and count benchmarks, from %s "
+                      "[%%default]" % ",".join(PATTERNS))
+
+    parser.add_option("--molecules-per-cell", dest="molecules_per_cell",
+                      type="int",
+                      help="molecules per cell in the synthetic samples "
+                      "[%default]")
+
+    parser.add_option("--error-rate", dest="error_rate", type="float",
+                      help="fraction of cell barcodes with an error for "
+                      "the whitelist benchmarks [%default]")
+
+    parser.add_option("--repeats", dest="repeats", type="int",
+                      help="number of timed runs of each benchmark "
+                      "[%default]")
+
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="random seed for the synthetic data [%default]")
+
+    parser.add_option("--results", dest="results", type="string",
+                      help="results table to append to, rather than "
+                      "writing to stdout [%default]")
+
+    parser.add_option("--compare", dest="compare", type="string",
+                      help="previous results table to compare the run "
+                      "times with [%default]")
+
+    parser.add_option("--tolerance", dest="tolerance", type="float",
+                      help="warn of benchmarks this fraction slower than "
+                      "in --compare [%default]")
+
+    parser.add_option("--tmpdir", dest="tmpdir", type="string",
+                      help="directory for the synthetic fastqs and BAMs "
+                      "[%default]")
+
+    parser.set_defaults(
+        benchmarks=",".join(BENCHMARKS),
+        umi_lengths="6,8,10",
+        saturations="0.25,0.5,0.75",
+        cell_numbers="100,1000",
+        patterns=",".join(PATTERNS),
+        molecules_per_cell=50,
+        error_rate=0.05,
+        repeats=3,
+        seed=1,
+        results=None,
+        compare=None,
+        tolerance=0.1,
+        tmpdir=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    suite = BenchmarkSuite(
+        benchmarks=options.benchmarks.split(","),
+        umi_lengths=[int(x) for x in options.umi_lengths.split(",")],
+        saturations=[float(x) for x in options.saturations.split(",")],
+        cell_numbers=[int(x) for x in options.cell_numbers.split(",")],
+        patterns=options.patterns.split(","),
+        molecules_per_cell=options.molecules_per_cell,
+        error_rate=options.error_rate,
+        repeats=options.repeats,
+        seed=options.seed,
+        tmpdir=options.tmpdir)
+
+    # read the reference first, as it may be the results table
+    reference = readResults(options.compare) if options.compare else None
+
+    info = runInfo()
+    rows = []
+
+    if options.results:
+        is_new = not os.path.exists(options.results)
+        outf = open(options.results, "a")
+    else:
+        is_new = True
+        outf = options.stdout
+
+    if is_new:
+        outf.write("\t".join(RESULT_COLUMNS) + "\n")
+
+    for row in suite.run():
+        row.update(info)
+        outf.write("\t".join(_format(row[x]) for x in RESULT_COLUMNS) + "\n")
+        outf.flush()
+        rows.append(row)
+
+    if options.results:
+        outf.close()
+
+    if reference is not None:
+        comparison = list(compareResults(rows, reference, options.tolerance))
+        E.info("compared %i of %i benchmarks with %s" % (
+            len(comparison), len(rows), options.compare))
+        if options.results:
+            options.stdout.write("\t".join(
+                _CASE_COLUMNS + ("reference_seconds", "seconds", "ratio")) +
+                "\n")
+            for case, reference_seconds, seconds, ratio in comparison:
+                options.stdout.write("\t".join(case) + "\t%.6g\t%.6g\t%.3f\n" % (
+                    reference_seconds, seconds, ratio))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,380 @@
+'''
+cb_errors.py - simulate sequencing errors in the cell barcodes
+==============================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Add simulated substitution, insertion and deletion errors to the cell
+barcodes in the read names of an extracted fastq or BAM (as written by
+``umi_tools extract``, i.e ``<read>_<cell>_<UMI>``), to test the
+cell barcode error correction.
+
+Any number of error models can be applied in a single pass over the
+input, each written to its own output. The reads are processed in
+batches, with the errors for each model drawn for the whole batch at
+once from a random number generator seeded from `seed` and the model
+index, so the output for each model is reproducible.
+
+Each model has a per base substitution, insertion and deletion rate.
+As the cell barcode is read from fixed positions in read 1, an
+insertion pushes the last base of the barcode out into the UMI and a
+deletion pulls in a random base at the end, so the barcode length is
+unchanged. The built in models are:
+
+default
+   approximate error rates for the start of an Illumina read
+literature-high
+   the higher end of the reported Illumina error rates
+constant-low
+   substitution 0.001, insertion 0.00002, deletion 0.00001
+constant-high
+   substitution 0.01, insertion 0.002, deletion 0.001
+
+Alternatively, the rates may be given as ``SUB,INS,DEL``.
+
+For each output, a table of the original and erroneous cell barcodes
+and the number of reads is written to ``<output>_table.tsv``.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python cb_errors.py --infile=mapped/sample.bam --seed=1
+   --output=default:sample_added_errors.bam
+   --output=0.01,0.002,0.001:sample_added_errors_custom.bam
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import sys
+
+import numpy as np
+import pysam
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+import barcode_codec
+
+
+ErrorModel = collections.namedtuple(
+    "ErrorModel", ["sub_rate", "insert_rate", "delete_rate"])
+
+MODELS = {
+    "default": ErrorModel(0.002, 0.0001, 0.0001),
+    "literature-high": ErrorModel(0.005, 0.0005, 0.0005),
+    "constant-low": ErrorModel(0.001, 0.00002, 0.00001),
+    "constant-high": ErrorModel(0.01, 0.002, 0.001),
+}
+
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+_CHAR2CODE = np.full(256, 0, dtype=np.uint8)
+_CHAR2CODE[_BASES] = np.arange(4)
+
+# event types
+_NONE, _SUB, _INS, _DEL = range(4)
+
+
+def parseModel(model):
+    '''return the :class:`ErrorModel` for a model name or a
+    ``SUB,INS,DEL`` string of rates'''
+
+    if model in MODELS:
+        return MODELS[model]
+
+    try:
+        rates = [float(x) for x in model.split(",")]
+    except ValueError:
+        raise ValueError("unknown error model: %s" % model)
+
+    if len(rates) != 3 or sum(rates) > 1 or min(rates) < 0:
+        raise ValueError("error rates must be SUB,INS,DEL: %s" % model)
+
+    return ErrorModel(*rates)
+
+
+def addErrors(barcodes, model, rng):
+    '''add errors to a 2D uint8 array of ASCII cell `barcodes`, one
+    per row, under the :class:`ErrorModel` `model`.
+
+    Returns the new barcodes and the number of substitutions,
+    insertions and deletions.
+    '''
+
+    n, length = barcodes.shape
+
+    draws = rng.random_sample((n, length))
+    events = np.select(
+        [draws < model.sub_rate,
+         draws < model.sub_rate + model.insert_rate,
+         draws < model.sub_rate + model.insert_rate + model.delete_rate],
+        [_SUB, _INS, _DEL], _NONE)
+
+    # a substitution is one of the three other bases
+    substituted = _BASES[
+        (_CHAR2CODE[barcodes] + rng.randint(1, 4, size=(n, length))) % 4]
+    bases = np.where(events == _SUB, substituted, barcodes)
+
+    # fast path: substitutions only
+    has_indel = ((events == _INS) | (events == _DEL)).any(axis=1)
+    if not has_indel.any():
+        return bases, [int((events == _SUB).sum()), 0, 0]
+
+    rows = np.flatnonzero(has_indel)
+    row_events = events[rows]
+
+    # each position emits an inserted base (if any) then its own base
+    # (unless deleted). The emitted bases are packed to the left and
+    # any space left at the end is filled with random bases
+    slots = np.empty((len(rows), 2 * length), dtype=np.uint8)
+    slots[:, 0::2] = _BASES[rng.randint(0, 4, size=(len(rows), length))]
+    slots[:, 1::2] = bases[rows]
+
+    emit = np.empty(slots.shape, dtype=bool)
+    emit[:, 0::2] = row_events == _INS
+    emit[:, 1::2] = row_events != _DEL
+
+    position = np.cumsum(emit, axis=1) - 1
+    keep = emit & (position < length)
+
+    shifted = _BASES[rng.randint(0, 4, size=(len(rows), length))]
+    row_ix = np.repeat(np.arange(len(rows)), 2 * length).reshape(slots.shape)
+    shifted[row_ix[keep], position[keep]] = slots[keep]
+    bases[rows] = shifted
+
+    return bases, [int((events == x).sum()) for x in (_SUB, _INS, _DEL)]
+
+
+class ErrorOutput(object):
+    '''an error model, its random number generator, output and the
+    tally of the original and erroneous barcodes'''
+
+    def __init__(self, model, outfile, seed, index):
+        self.model = parseModel(model)
+        self.name = model
+        self.outfile = outfile
+        self.rng = np.random.RandomState([seed, index])
+        self.changes = None
+        self.errors = np.zeros(3, dtype=np.int64)
+        self.reads = 0
+        self.reads_changed = 0
+
+    def apply(self, barcodes):
+        '''add errors to the `barcodes` (a 2D uint8 array) and tally
+        the changes. Returns the new barcodes'''
+
+        if self.changes is None:
+            # the codes of barcodes with Ns carry the N mask
+            length = barcodes.shape[1]
+            dtype = barcode_codec.codeDtype(
+                length, length <= barcode_codec.MAX_LENGTH_N)
+            self.changes = barcode_codec.PairCountTable(dtype, dtype)
+
+        new, errors = addErrors(barcodes, self.model, self.rng)
+        self.errors += errors
+        self.reads += len(barcodes)
+
+        changed = (new != barcodes).any(axis=1)
+        self.reads_changed += int(changed.sum())
+        if changed.any():
+            original, valid1 = barcode_codec.encodeChars(barcodes[changed])
+            erroneous, valid2 = barcode_codec.encodeChars(new[changed])
+            valid = valid1 & valid2
+            self.changes.update(original[valid], erroneous[valid])
+
+        return new
+
+    def writeTable(self, length):
+        '''write the (original, erroneous, reads) table'''
+
+        with IOTools.openFile(self.outfile + "_table.tsv", "w") as outf:
+            outf.write("original\terroneous\treads\n")
+            if self.changes is None:
+                return
+            (original, erroneous), counts = (self.changes.keys,
+                                             self.changes.counts)
+            for cb1, cb2, count in zip(
+                    barcode_codec.decode(original, length),
+                    barcode_codec.decode(erroneous, length), counts):
+                outf.write("%s\t%s\t%i\n" % (cb1, cb2, count))
+
+
+def _splitNames(names):
+    '''split read names into (read id, cell barcode, UMI and
+    anything after the name)'''
+
+    read_ids = []
+    cells = []
+    rests = []
+    for name in names:
+        read_id, cell, rest = name.split("_", 2)
+        read_ids.append(read_id)
+        cells.append(cell)
+        rests.append(rest)
+
+    length = len(cells[0])
+    if any(len(x) != length for x in cells):
+        raise ValueError("cell barcodes must all be the same length")
+
+    cells = np.frombuffer("".join(cells).encode("ascii"),
+                          dtype=np.uint8).reshape(len(cells), length)
+
+    return read_ids, cells, rests
+
+
+def _joinNames(read_ids, cells, rests):
+    length = cells.shape[1]
+    cells = cells.tobytes().decode("ascii")
+    return ["%s_%s_%s" % (read_id, cells[ix * length:(ix + 1) * length],
+                          rest)
+            for ix, (read_id, rest) in enumerate(zip(read_ids, rests))]
+
+
+def _iterateFastqBatches(infile, batch_size):
+    '''iterate over lists of fastq records, as lists of 4 lines'''
+
+    batch = []
+    with IOTools.openFile(infile, "r") as inf:
+        while True:
+            record = [inf.readline() for x in range(4)]
+            if not record[0]:
+                break
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def simulateFastq(infile, outputs, batch_size=100000):
+    '''add errors to the cell barcodes in the fastq `infile` for each
+    :class:`ErrorOutput`'''
+
+    outfiles = [IOTools.openFile(x.outfile, "w") for x in outputs]
+    length = None
+
+    for batch in _iterateFastqBatches(infile, batch_size):
+        read_ids, cells, rests = _splitNames(
+            [record[0][1:] for record in batch])
+        length = cells.shape[1]
+
+        for output, outf in zip(outputs, outfiles):
+            names = _joinNames(read_ids, output.apply(cells), rests)
+            outf.write("".join(
+                "@%s%s%s%s" % (name, record[1], record[2], record[3])
+                for name, record in zip(names, batch)))
+
+    for outf in outfiles:
+        outf.close()
+
+    return length
+
+
+def simulateBam(infile, outputs, batch_size=100000):
+    '''add errors to the cell barcodes in the BAM `infile` for each
+    :class:`ErrorOutput`'''
+
+    inbam = pysam.AlignmentFile(infile)
+    outbams = [pysam.AlignmentFile(x.outfile, "wb", template=inbam)
+               for x in outputs]
+    length = None
+
+    def flush(batch):
+        read_ids, cells, rests = _splitNames(
+            [read.query_name for read in batch])
+        for output, outbam in zip(outputs, outbams):
+            names = _joinNames(read_ids, output.apply(cells), rests)
+            for name, read in zip(names, batch):
+                read.query_name = name
+                outbam.write(read)
+        return cells.shape[1]
+
+    batch = []
+    for read in inbam.fetch(until_eof=True):
+        batch.append(read)
+        if len(batch) >= batch_size:
+            length = flush(batch)
+            batch = []
+    if batch:
+        length = flush(batch)
+
+    inbam.close()
+    for outbam in outbams:
+        outbam.close()
+
+    return length
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-i", "--infile", dest="infile", type="string",
+                      help="extracted fastq or BAM [%default]")
+
+    parser.add_option("--output", dest="outputs", type="string",
+                      action="append",
+                      help="MODEL:OUTFILE, where MODEL is the name of an "
+                      "error model or SUB,INS,DEL rates. May be given "
+                      "more than once [%default]")
+
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="random seed [%default]")
+
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      help="number of reads per batch [%default]")
+
+    parser.set_defaults(
+        infile=None,
+        outputs=[],
+        seed=1,
+        batch_size=100000,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.infile is None or not options.outputs:
+        raise ValueError("--infile and at least one --output are required")
+
+    outputs = []
+    for ix, output in enumerate(options.outputs):
+        model, _, outfile = output.partition(":")
+        if not outfile:
+            raise ValueError("--output should be MODEL:OUTFILE: %s" % output)
+        outputs.append(ErrorOutput(model, outfile, options.seed, ix))
+
+    if options.infile.endswith(".bam"):
+        length = simulateBam(options.infile, outputs, options.batch_size)
+    else:
+        length = simulateFastq(options.infile, outputs, options.batch_size)
+
+    for output in outputs:
+        output.writeTable(length)
+        E.info("%s: %i/%i reads with errors, %i substitutions, "
+               "%i insertions, %i deletions" % (
+                   (output.name, output.reads_changed, output.reads) +
+                   tuple(output.errors)))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
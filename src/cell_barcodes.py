@@ -94,7 +94,10 @@ Code
 # import standard modules
 import sys
 import os
+import glob
+import re
 import sqlite3
+import shutil
 import pysam
 import time
 import collections
@@ -112,6 +115,11 @@ import CGATPipelines.Pipeline as P
 import CGATPipelines.PipelineMapping as PipelineMapping
 
 # Import utility function from pipeline module file
+import job_sizing
+import knee_detection
+import run_ledger
+import sample_stats
+import task_cache
 
 # load options from the config file
 PARAMS = P.getParameters(
@@ -138,6 +146,27 @@ PARAMS.update(P.peekParameters(
     prefix="mmx_annotations_",
     update_interface=True))
 
+# bespoke scripts used by the pipeline tasks live alongside this file
+PARAMS["src_dir"] = os.path.dirname(os.path.abspath(__file__))
+
+# the long running tasks are rerun when the content of their inputs,
+# their code or the parameters they use change, rather than when their
+# inputs are newer than their outputs (see task_cache.py)
+CACHE = task_cache.TaskCache(PARAMS["cache_dir"], PARAMS,
+                             enabled=PARAMS["cache_enabled"],
+                             resources=PARAMS["cache_resources"].split(","))
+
+# the alignment and index jobs are sized from the resources used by
+# previous jobs (see job_sizing.py)
+SIZING = job_sizing.SizingModel(
+    PARAMS["sizing_run_log"],
+    min_runs=PARAMS["sizing_min_runs"],
+    headroom=PARAMS["sizing_headroom"],
+    target_hours=PARAMS["sizing_target_hours"],
+    min_threads=PARAMS["sizing_min_threads"],
+    max_threads=PARAMS["sizing_max_threads"],
+    max_memory=job_sizing.parseMemory(PARAMS["sizing_max_memory"]))
+
 
 # if necessary, update the PARAMS dictionary in any modules file.
 # e.g.:
@@ -168,6 +197,27 @@ def connect():
 
     return dbh
 
+
+def sampleName(job):
+    '''return the 10X sample a job's output is for, or None. The
+    sample may be in the output's name or directory (e.g the shards or
+    a stats.dir partition)'''
+
+    samples = [x for x in TENX_DATASETS
+               if re.search(r"(^|[._/=])%s([._/]|$)" % re.escape(x), job)]
+
+    return max(samples, key=len) if samples else None
+
+
+# the jobs are run through LEDGER.run(), which records the resources
+# they use and the counters reported by their tools in the pipeline
+# database (see run_ledger.py)
+LEDGER = run_ledger.RunLedger(connect, PARAMS, P.run, PARAMS["ledger_dir"],
+                              interval=PARAMS["ledger_interval"],
+                              enabled=PARAMS["ledger_enabled"],
+                              sample=sampleName)
+
+
 # ---------------------------------------------------
 # Specific pipeline tasks
 
@@ -175,6 +225,17 @@ def connect():
 #  Download raw data
 ##############################################################################
 
+def downloadOptions():
+    '''return the download.py options from the [download] section'''
+
+    options = ("--threads=%(download_threads)s "
+               "--retries=%(download_retries)s" % PARAMS)
+    if PARAMS["download_checksums"]:
+        options += " --checksums=%(download_checksums)s" % PARAMS
+
+    return options
+
+
 @mkdir('raw')
 @originate('raw/dropseq_mixed_species.fastq.1.gz')
 def downloadDropSeq(outfile):
@@ -188,12 +249,18 @@ def downloadDropSeq(outfile):
 
     sample_id = name2ID[os.path.basename(sample_basename)]
 
+    download_options = downloadOptions()
+
     statement = '''
-    wget %(url_prefix)s/%(sample_id)s/%(sample_id)s_1.fastq.gz -O %(outfile)s; 
-    wget %(url_prefix)s/%(sample_id)s/%(sample_id)s_2.fastq.gz -O %(outfile2)s
+    python %(src_dir)s/download.py %(download_options)s
+    --url=%(url_prefix)s/%(sample_id)s/%(sample_id)s_1.fastq.gz
+    --outfile=%(outfile)s -L %(outfile)s.log; checkpoint ;
+    python %(src_dir)s/download.py %(download_options)s
+    --url=%(url_prefix)s/%(sample_id)s/%(sample_id)s_2.fastq.gz
+    --outfile=%(outfile2)s -L %(outfile2)s.log
     '''
 
-    P.run()
+    LEDGER.run()
 
 @mkdir('raw')
 @originate('raw/indrop_es_1.fastq.1.gz')
@@ -208,12 +275,18 @@ def downloadInDrop(outfile):
 
     sample_id = name2ID[os.path.basename(sample_basename)]
 
+    download_options = downloadOptions()
+
     statement = '''
-    wget %(url_prefix)s/%(sample_id)s/%(sample_id)s_1.fastq.gz -O %(outfile)s; 
-    wget %(url_prefix)s/%(sample_id)s/%(sample_id)s_2.fastq.gz -O %(outfile2)s
+    python %(src_dir)s/download.py %(download_options)s
+    --url=%(url_prefix)s/%(sample_id)s/%(sample_id)s_1.fastq.gz
+    --outfile=%(outfile)s -L %(outfile)s.log; checkpoint ;
+    python %(src_dir)s/download.py %(download_options)s
+    --url=%(url_prefix)s/%(sample_id)s/%(sample_id)s_2.fastq.gz
+    --outfile=%(outfile2)s -L %(outfile2)s.log
     '''
 
-    P.run()
+    LEDGER.run()
 
 
 
@@ -221,6 +294,7 @@ def downloadInDrop(outfile):
 # * cell ranger version - determine download url
 # * number of cells - whitelisting
 # * species - alignment and gene assignment tasks
+# * number of cells & sequencing saturation - job sizing
 # this info is stored in sample_info in pipeline src dir.
 
 TENX2INFO = collections.defaultdict(lambda: collections.defaultdict())
@@ -234,6 +308,7 @@ with IOTools.openFile(PARAMS['sample_info'], "r") as inf:
             TENX2INFO[sample_name]["version"] = r_version
             TENX2INFO[sample_name]["n_cells"] = n_cells
             TENX2INFO[sample_name]["species"] = species
+            TENX2INFO[sample_name]["seq_sat"] = seq_sat
             TENX2INFO[sample_name]["chem"] = chem
 
 # restrict for testing (pbmc8k has >700M reads! = 75GB fastqs!!)
@@ -243,8 +318,8 @@ with IOTools.openFile(PARAMS['sample_info'], "r") as inf:
 @mkdir('raw', 'raw/10X_fastqs/')
 @originate(['raw/10X_fastqs/%s.fastq.1.gz' % x for x in TENX_DATASETS])
 def download10x(outfile):
-    ''' Download the 10X data, untar, cat the fastqs and delete
-    the unwanted files'''
+    ''' Download the 10X data and stream the read 1 and read 2
+    fastqs for each lane from the tar into a single fastq each'''
 
     sample_name = os.path.basename(outfile).replace(".fastq.1.gz", "")
     
@@ -255,21 +330,21 @@ def download10x(outfile):
     url = "http://s3-us-west-2.amazonaws.com/10x.files/samples/cell-exp/%s/%s/%s" % (
         ranger_version, sample_name, tar_file)
 
-    tmp_dir = "10x_%s_fastqs" % sample_name
     outfile2 = outfile.replace(".fastq.1.gz", ".fastq.2.gz")
 
-    statement = '''
-    mkdir %(tmp_dir)s; checkpoint ;
-    wget %(url)s; checkpoint ;
-    tar -xf %(tar_file)s -C %(tmp_dir)s; checkpoint ;
-    cat %(tmp_dir)s/*/%(sample_name)s_S1_*_R1_001.fastq.gz
-    > %(outfile)s; checkpoint ;
-    cat %(tmp_dir)s/*/%(sample_name)s_S1_*_R2_001.fastq.gz
-    > %(outfile2)s; checkpoint ;
-    rm -rf %(tmp_dir)s %(tar_file)s
+    download_options = downloadOptions()
+    if PARAMS["download_stream_tar"]:
+        download_options += " --stream"
 
+    statement = '''
+    python %(src_dir)s/download.py %(download_options)s
+    --url=%(url)s
+    --outfile=%(tar_file)s
+    --member="*/%(sample_name)s_S1_*_R1_001.fastq.gz:%(outfile)s"
+    --member="*/%(sample_name)s_S1_*_R2_001.fastq.gz:%(outfile2)s"
+    -L %(outfile)s.log
     '''
-    P.run()
+    LEDGER.run()
 
 
 
@@ -284,21 +359,192 @@ def DownloadData():
 #  Extract barcodes
 ##############################################################################
 
+DROPSEQ_BC_PATTERN = "CCCCCCCCCCCCNNNNNNNN"
+INDROP_BC_PATTERN = ("(?P<cell_1>.{8,12})(?P<discard_2>GAGTGATTGCTTGTGACGCCTT)"
+                     "(?P<cell_3>.{8})(?P<umi_1>.{6})T{3}.*")
+TENX_BC_PATTERN = "CCCCCCCCCCCCCCCCNNNNNNNNNN"
+
+
+def countBarcodesStatement(infile, outfile, bc_pattern, extract_method):
+    '''return the statement to count the reads and unique UMIs per cell
+    barcode in the first reads of `infile`. The counts are cached in
+    whitelist_cache_dir, keyed on the fastq, pattern and number of
+    reads, so they are only made once per input. With the task cache,
+    the fastq is identified by the content hash it records, which is
+    kept once the fastq is zapped'''
+
+    if PARAMS["cache_enabled"]:
+        hash_file = "--hash-file=%s" % os.path.join(
+            PARAMS["cache_dir"], "file_hashes.tsv")
+    else:
+        hash_file = ""
+
+    return '''
+    python %%(src_dir)s/extract_barcodes.py
+    --fastq=%(infile)s
+    --bc-pattern="%(bc_pattern)s"
+    --extract-method=%(extract_method)s
+    --subset-reads=%%(whitelist_subset_reads)s
+    --threads=%%(whitelist_threads)s
+    --cache-dir=%%(whitelist_cache_dir)s
+    %(hash_file)s
+    -L %(outfile)s.log
+    -S %(outfile)s
+    ''' % locals()
+
+
+def cellNumberMethod(default="inflection"):
+    '''return how to set the number of cells, where this is not taken
+    from sample_info: a knee_detection.py threshold or umi_tools (the
+    umi_tools whitelist estimate). Samples without n_cells in
+    sample_info use `default`'''
+
+    method = PARAMS["whitelist_cell_number"]
+    if method == "sample_info":
+        method = default
+    return method
+
+
+def barcodeStoreStatement(counts, outfile):
+    '''return the statement to write the barcode `counts` and the
+    whitelist `outfile` to a barcode_store.py store alongside the
+    whitelist, e.g whitelist/10X_pbmc4k_barcodes.store'''
+
+    store = outfile.replace("_whitelist.tsv", "_barcodes.store")
+
+    return '''
+    python %%(src_dir)s/barcode_store.py
+    --store=%(store)s
+    --counts-table=%(counts)s
+    --whitelist=%(outfile)s
+    --rank-column=%%(whitelist_count_column)s
+    -L %(store)s.log
+    ''' % locals()
+
+
+def makeWhitelistStatement(counts, outfile, n_cells=None,
+                           cell_number_table=None, method=None):
+    '''return the statement to make a whitelist from the barcode
+    `counts`, with the top `n_cells` or the number of cells from the
+    knee_detection.py `cell_number_table` with `method`, and write
+    them to a barcode store'''
+
+    if n_cells is not None:
+        cell_number = "--cell-number=%s" % n_cells
+    else:
+        cell_number = "--cell-number-table=%s --method=%s" % (
+            cell_number_table, method)
+
+    statement = '''
+    python %%(src_dir)s/make_whitelist.py
+    --counts=%(counts)s
+    --count-column=%%(whitelist_count_column)s
+    %(cell_number)s
+    --plot-prefix=%(outfile)s
+    -L %(outfile)s.log
+    -S %(outfile)s''' % locals()
+
+    return statement + "; checkpoint ;" + barcodeStoreStatement(
+        counts, outfile)
+
+
+def estimatedWhitelistStatement(infiles, outfile, bc_pattern,
+                                extract_method):
+    '''return the statement to make a whitelist for a sample without
+    n_cells in sample_info, from the barcode counts, the
+    knee_detection.py cell number table and the read 1 fastq in
+    `infiles`.
+
+    By default, the number of cells is estimated by ``umi_tools
+    whitelist`` from the fastq, as it was before the counts were
+    cached. With a knee_detection.py whitelist_cell_number, the
+    whitelist is made from the cached counts.
+    '''
+
+    counts, cell_number_table, fastq = infiles
+
+    method = cellNumberMethod(default="umi_tools")
+    if method != "umi_tools":
+        return makeWhitelistStatement(
+            counts, outfile, cell_number_table=cell_number_table,
+            method=method)
+
+    statement = '''
+    umi_tools whitelist
+    --bc-pattern="%(bc_pattern)s"
+    --extract-method=%(extract_method)s
+    --plot-prefix=%(outfile)s
+    -I %(fastq)s
+    -L %(outfile)s.log
+    --subset-reads=%%(whitelist_subset_reads)s
+    -S %(outfile)s''' % locals()
+
+    return statement + "; checkpoint ;" + barcodeStoreStatement(
+        counts, outfile)
+
+
 @mkdir(("whitelist"))
 @transform(downloadDropSeq,
            regex("raw/(\S+).fastq.1.gz"),
-           r"whitelist/\1_whitelist.tsv")
-def MakeDropSeqWhitelist(infile, outfile):
-    'make a whitelist of "true" cell barcodes'
+           r"whitelist/\1_barcode_counts.tsv")
+def CountDropSeqBarcodes(infile, outfile):
+    'count the reads and unique UMIs per cell barcode'
+
+    job_threads = PARAMS["whitelist_threads"]
+
+    statement = countBarcodesStatement(
+        infile, outfile, DROPSEQ_BC_PATTERN, "string")
+
+    LEDGER.run()
+
+
+@mkdir(("whitelist"))
+@transform(downloadInDrop,
+           regex("raw/(\S+).fastq.1.gz"),
+           r"whitelist/\1_barcode_counts.tsv")
+def CountInDropBarcodes(infile, outfile):
+    'count the reads and unique UMIs per cell barcode'
+
+    job_threads = PARAMS["whitelist_threads"]
+
+    statement = countBarcodesStatement(
+        infile, outfile, INDROP_BC_PATTERN, "regex")
+
+    LEDGER.run()
+
+
+@transform((CountDropSeqBarcodes, CountInDropBarcodes),
+           suffix("_barcode_counts.tsv"),
+           "_cell_number.tsv")
+def EstimateCellNumber(infile, outfile):
+    'estimate the number of cells from the barcode counts'
 
     statement = '''
-    umi_tools whitelist  --bc-pattern=CCCCCCCCCCCCNNNNNNNN
-    --extract-method=string --plot-prefix=%(outfile)s
-    -I %(infile)s -L %(outfile)s.log --subset-reads=10000000
+    python %(src_dir)s/knee_detection.py
+    --counts=%(infile)s
+    --count-column=%(whitelist_count_column)s
+    -L %(outfile)s.log
     -S %(outfile)s
     '''
 
-    P.run()
+    LEDGER.run()
+
+
+@follows(EstimateCellNumber)
+@transform(CountDropSeqBarcodes,
+           regex("whitelist/(\S+)_barcode_counts.tsv"),
+           add_inputs(r"whitelist/\1_cell_number.tsv",
+                      r"raw/\1.fastq.1.gz"),
+           r"whitelist/\1_whitelist.tsv")
+def MakeDropSeqWhitelist(infiles, outfile):
+    '''make a whitelist of "true" cell barcodes. The number of cells is
+    estimated by umi_tools whitelist, unless whitelist_cell_number is
+    a knee_detection.py method'''
+
+    statement = estimatedWhitelistStatement(
+        infiles, outfile, DROPSEQ_BC_PATTERN, "string")
+
+    LEDGER.run()
 
 @mkdir("extract")
 @transform(downloadDropSeq,
@@ -320,24 +566,23 @@ def ExtractDropSeq(infile, outfile):
     -S %(outfile)s
     '''
 
-    P.run()
+    LEDGER.run()
 
-@mkdir(("whitelist"))
-@transform(downloadInDrop,
-           regex("raw/(\S+).fastq.1.gz"),
+@follows(EstimateCellNumber)
+@transform(CountInDropBarcodes,
+           regex("whitelist/(\S+)_barcode_counts.tsv"),
+           add_inputs(r"whitelist/\1_cell_number.tsv",
+                      r"raw/\1.fastq.1.gz"),
            r"whitelist/\1_whitelist.tsv")
-def MakeInDropWhitelist(infile, outfile):
-    'make a whitelist of "true" cell barcodes'
+def MakeInDropWhitelist(infiles, outfile):
+    '''make a whitelist of "true" cell barcodes. The number of cells is
+    estimated by umi_tools whitelist, unless whitelist_cell_number is
+    a knee_detection.py method'''
 
-    statement = '''
-    umi_tools whitelist --extract-method=regex -I %(infile)s 
-    --bc-pattern="(?P<cell_1>.{8,12})(?P<discard_2>GAGTGATTGCTTGTGACGCCTT)(?P<cell_3>.{8})(?P<umi_1>.{6})T{3}.*"
-    --plot-prefix=%(outfile)s -L %(outfile)s.log
-    --subset-reads=10000000
-    -S %(outfile)s
-    '''
+    statement = estimatedWhitelistStatement(
+        infiles, outfile, INDROP_BC_PATTERN, "regex")
 
-    P.run()
+    LEDGER.run()
 
 @mkdir("extract")
 @transform(downloadInDrop,
@@ -359,41 +604,173 @@ def ExtractInDrop(infile, outfile):
     -S %(outfile)s
     '''
 
-    P.run()
+    LEDGER.run()
 
 
 @mkdir(("whitelist"))
 @transform(download10x,
            regex("raw/10X_fastqs/(\S+).fastq.1.gz"),
+           r"whitelist/10X_\1_barcode_counts.tsv")
+def Count10XBarcodes(infile, outfile):
+    'count the reads and unique UMIs per cell barcode'
+
+    job_threads = PARAMS["whitelist_threads"]
+
+    statement = countBarcodesStatement(
+        infile, outfile, TENX_BC_PATTERN, "string")
+
+    LEDGER.run()
+
+
+@transform(Count10XBarcodes,
+           suffix("_barcode_counts.tsv"),
+           "_cell_number.tsv")
+def Estimate10XCellNumber(infile, outfile):
+    'estimate the number of cells from the barcode counts'
+
+    statement = '''
+    python %(src_dir)s/knee_detection.py
+    --counts=%(infile)s
+    --count-column=%(whitelist_count_column)s
+    -L %(outfile)s.log
+    -S %(outfile)s
+    '''
+
+    LEDGER.run()
+
+
+@follows(Estimate10XCellNumber)
+@transform(Count10XBarcodes,
+           regex("whitelist/10X_(\S+)_barcode_counts.tsv"),
+           add_inputs(r"whitelist/10X_\1_cell_number.tsv"),
            r"whitelist/10X_\1_whitelist.tsv")
-def Make10XWhitelist(infile, outfile):
-    'make a whitelist of "true" cell barcodes'
+def Make10XWhitelist(infiles, outfile):
+    '''make a whitelist of "true" cell barcodes from the cached barcode
+    counts. The number of cells is taken from sample_info or estimated
+    from the barcode counts'''
+
+    counts, cell_number_table = infiles
 
-    sample_name = os.path.basename(infile).replace(".fastq.1.gz", "")
+    sample_name = os.path.basename(counts).replace(
+        "_barcode_counts.tsv", "")[len("10X_"):]
 
     n_cells = TENX2INFO[sample_name]["n_cells"]
-    
+
+    if PARAMS["whitelist_cell_number"] != "sample_info" or not n_cells:
+        method = cellNumberMethod()
+        if method == "umi_tools":
+            # the raw 10X fastqs are zapped once they are extracted
+            raise ValueError("the umi_tools cell number is only for the "
+                             "Drop-seq and inDrop samples")
+        threshold = knee_detection.readThreshold(cell_number_table, method)
+        if threshold is None:
+            raise ValueError("could not estimate the number of cells for "
+                             "%s using the %s" % (sample_name, method))
+
+        n_cells = threshold.n_cells
+        E.info("%s: %i cells estimated using the %s (confidence %.2f)" % (
+            sample_name, n_cells, method, threshold.confidence))
+
+    statement = makeWhitelistStatement(counts, outfile, n_cells=n_cells)
+
+    LEDGER.run()
+
+
+@follows(Make10XWhitelist)
+@transform(Count10XBarcodes,
+           regex("whitelist/10X_(\S+)_barcode_counts.tsv"),
+           add_inputs(r"whitelist/10X_\1_cell_number.tsv",
+                      r"whitelist/10X_\1_whitelist.tsv"),
+           r"whitelist/10X_\1_background.tsv")
+def Make10XBackgroundWhitelist(infiles, outfile):
+    '''list the barcodes of the empty droplets of each 10X sample,
+    outside the whitelist and below the lower bound of the
+    ambient_method threshold, to extract the ambient RNA background
+    from'''
+
+    counts, cell_number_table, whitelist = infiles
+
+    # the whitelist is the top barcodes of the same counts
+    with IOTools.openFile(whitelist, "r") as inf:
+        n_cells = sum(1 for line in inf)
+
+    if PARAMS["ambient_cutoff"]:
+        max_count = "--background-max-count=%s" % PARAMS["ambient_cutoff"]
+    else:
+        max_count = ""
+
     statement = '''
-    umi_tools whitelist 
+    python %(src_dir)s/make_whitelist.py
+    --counts=%(counts)s
+    --count-column=%(whitelist_count_column)s
+    --cell-number=%(n_cells)i
+    --cell-number-table=%(cell_number_table)s
+    --method=%(ambient_method)s
+    --background
+    %(max_count)s
+    --background-min-count=%(ambient_min_count)s
+    -L %(outfile)s.log
+    -S %(outfile)s
+    '''
+
+    LEDGER.run()
+
+
+def extract10XStatement(infile, whitelist):
+    '''return the umi_tools extract statement for the 10X read 1 fastq
+    `infile`, writing the read 2 reads to stdout'''
+
+    infile2 = infile.replace("fastq.1.gz", "fastq.2.gz")
+
+    return '''
+    umi_tools extract
     --bc-pattern=CCCCCCCCCCCCCCCCNNNNNNNNNN
     --extract-method=string
-    --plot-prefix=%(outfile)s
     -I %(infile)s
+    --read2-in=%(infile2)s
+    --filter-cell-barcode
+    --whitelist=%(whitelist)s
+    --read2-stdout
+    ''' % locals()
+
+
+@mkdir("ambient.dir")
+@follows(Make10XBackgroundWhitelist)
+@transform(download10x,
+           regex("raw/10X_fastqs/(\S+).fastq.1.gz"),
+           add_inputs(r"whitelist/10X_\1_background.tsv"),
+           r"ambient.dir/\1_background_extracted.fastq.gz")
+@CACHE.cached
+def ExtractBackground10X(infiles, outfile):
+    '''extract the reads of the background barcodes (see
+    Make10XBackgroundWhitelist) for the ambient RNA profile. These are
+    filtered out of the extraction of the cells'''
+
+    infile, background = infiles
+
+    statement = extract10XStatement(infile, background) + '''
     -L %(outfile)s.log
-    --subset-reads=10000000
-    --set-cell-number=%(n_cells)s
     -S %(outfile)s
     '''
 
-    P.run()
+    LEDGER.run()
+
+
+# the raw 10X fastqs are zapped once the cells are extracted, so the
+# background must be extracted first
+if PARAMS["ambient_background"]:
+    EXTRACT_10X_FOLLOWS = (Make10XWhitelist, ExtractBackground10X)
+else:
+    EXTRACT_10X_FOLLOWS = (Make10XWhitelist,)
 
 
 @mkdir("extract")
-@follows(Make10XWhitelist)
+@follows(*EXTRACT_10X_FOLLOWS)
 @transform(download10x,
            regex("raw/10X_fastqs/(\S+).fastq.1.gz"),
            add_inputs(r"whitelist/10X_\1_whitelist.tsv"),
            r"extract/\1_extracted.fastq")
+@CACHE.cached
 def Extract10X(infiles, outfile):
     '''extract the umi and cell barcodes using the whitelist defined
     using a manual threshold'''
@@ -402,22 +779,14 @@ def Extract10X(infiles, outfile):
 
     infile2 = infile.replace("fastq.1.gz", "fastq.2.gz")
 
-    statement = '''
-    umi_tools extract 
-    --bc-pattern=CCCCCCCCCCCCCCCCNNNNNNNNNN
-    --extract-method=string
-    -I %(infile)s
-    --read2-in=%(infile2)s
+    statement = extract10XStatement(infile, whitelist) + '''
     -L %(outfile)s.log
-    --filter-cell-barcode
-    --whitelist=%(whitelist)s
-    --read2-stdout
     -S %(outfile)s
     '''
 
-    P.run()
-    IOTools.zapFile(infile)
-    IOTools.zapFile(infile2)
+    LEDGER.run()
+    CACHE.zapFile(infile)
+    CACHE.zapFile(infile2)
     P.touch(outfile)
 
 @follows(MakeDropSeqWhitelist, MakeInDropWhitelist,
@@ -452,23 +821,84 @@ def MakeMergedGenomes(outfile):
     samtools faidx %(outfile)s
     '''
     
-    P.run()
+    LEDGER.run()
+
+
+def checkContigPrefixes(gtf, genome):
+    '''check the contigs in the merged `gtf` have the same species
+    prefixes as the contigs in the faidx indexed merged `genome`'''
+
+    with IOTools.openFile(genome + ".fai", "r") as inf:
+        genome_contigs = set(line.split("\t", 1)[0] for line in inf)
+
+    with IOTools.openFile(gtf, "r") as inf:
+        gtf_contigs = set(line.split("\t", 1)[0] for line in inf
+                          if not line.startswith("#"))
+
+    def prefixes(contigs):
+        return set(x.split("_", 1)[0] for x in contigs)
+
+    if prefixes(gtf_contigs) != prefixes(genome_contigs):
+        raise ValueError(
+            "contig prefixes in %s (%s) don't match those in %s (%s)" % (
+                gtf, ",".join(sorted(prefixes(gtf_contigs))),
+                genome, ",".join(sorted(prefixes(genome_contigs)))))
+
+    missing = gtf_contigs - genome_contigs
+    if missing == gtf_contigs:
+        raise ValueError("none of the contigs in %s are in %s" % (
+            gtf, genome))
+    elif missing:
+        E.warn("%i contigs in %s are not in %s: %s" % (
+            len(missing), gtf, genome, ",".join(sorted(missing))))
 
 
 @mkdir("references.dir")
+@follows(MakeMergedGenomes)
 @merge((PARAMS['geneset_hg'], PARAMS['geneset_mm']),
        "references.dir/merged_hg_mm_transcriptome.gtf.gz")
 def MakeMergedGTF(infiles, outfile):
+    '''merge the hg and mm exons, with the contigs prefixed as per
+    MakeMergedGenomes'''
 
     hg_infile, mm_infile = infiles
 
     statement = '''
     zcat %(hg_infile)s | awk '$3=="exon"' | sed 's/^chr/hg_chr/g' |
     gzip > %(outfile)s; checkpoint; 
-    zcat %(mm_infile)s | awk '$3=="exon"' | sed 's/^chr/hg_chr/g' |
+    zcat %(mm_infile)s | awk '$3=="exon"' | sed 's/^chr/mm_chr/g' |
     gzip >> %(outfile)s; '''
     
-    P.run()
+    LEDGER.run()
+
+    try:
+        checkContigPrefixes(outfile, "references.dir/merged_hg_mm_genome.fasta")
+    except ValueError:
+        os.unlink(outfile)
+        raise
+
+
+@mkdir("references.dir")
+@transform((PARAMS['geneset_hg'], PARAMS['geneset_mm']),
+           regex("(?:\S+/)?(\S+).gtf.gz"),
+           r"references.dir/\1.gtf.gz")
+def MakeSpeciesGTFs(infile, outfile):
+    '''extract the exons of the individual hg and mm genesets'''
+
+    statement = '''
+    zcat %(infile)s | awk '$3=="exon"' | gzip > %(outfile)s
+    '''
+
+    LEDGER.run()
+
+
+def getGenesets():
+    '''return the prebuilt hg, mm and merged hg/mm exon GTFs'''
+
+    return tuple(
+        os.path.join("references.dir", os.path.basename(PARAMS[x]))
+        for x in ("geneset_hg", "geneset_mm")) + (
+            "references.dir/merged_hg_mm_transcriptome.gtf.gz",)
 
 # not currently req.
 @mkdir("references.dir")
@@ -500,7 +930,51 @@ def MakeMergedTranscriptome(infiles, outfile):
     samtools faidx %(outfile)s
     '''
 
-    P.run()
+    LEDGER.run()
+
+
+##############################################################################
+#  Size jobs
+##############################################################################
+
+def sizeJob(kind, name, infiles, sample_name=None, threads=1, memory=None,
+            scratch=None):
+    '''return the job_sizing.Job for a job of `kind` on `infiles`, with
+    its threads, memory and scratch predicted from the logged runs of
+    `kind`, the input size and the sample's n_cells and seq_sat. Until
+    there are enough runs, the job has the configured `threads` and
+    `memory`.
+
+    `name` identifies the job in the run log and `scratch` is a glob of
+    its temporary files. Pass the job to LEDGER.run() to log its
+    usage.
+    '''
+
+    if sample_name in TENX2INFO:
+        n_cells = TENX2INFO[sample_name]["n_cells"]
+        seq_sat = TENX2INFO[sample_name]["seq_sat"]
+    else:
+        n_cells = seq_sat = None
+
+    if memory is not None:
+        memory = job_sizing.parseMemory(memory)
+
+    job_size = job_sizing.Job(
+        SIZING, kind, name, infiles, n_cells=n_cells, seq_sat=seq_sat,
+        default=job_sizing.Resources(threads, memory, None),
+        scratch=scratch)
+
+    if job_size.resources.scratch and scratch:
+        free = shutil.disk_usage(os.path.dirname(scratch)).free
+        if free < job_size.resources.scratch:
+            E.warn("%s may need %s of scratch space in %s but only %s "
+                   "is free" % (name,
+                                job_sizing.formatMemory(
+                                    job_size.resources.scratch),
+                                os.path.dirname(scratch),
+                                job_sizing.formatMemory(free)))
+
+    return job_size
 
 
 ##############################################################################
@@ -513,11 +987,17 @@ def IndexMergedGenomes(infile, outfile):
 
     outfile_base = outfile.replace(".1.ht2l", "")
 
+    job_size = sizeJob("hisat2_index", outfile_base, [infile])
+    job_threads = job_size.threads
+    if job_size.resources.memory is not None:
+        job_memory = job_size.jobMemory(job_threads, None)
+
     statement = '''
-    hisat2-build %(infile)s %(outfile_base)s >%(outfile)s.log
+    hisat2-build -p %(job_threads)s %(infile)s %(outfile_base)s
+    >%(outfile)s.log
     '''
 
-    P.run()
+    LEDGER.run(job_size)
 
 @transform(MakeMergedGenomes, 
            regex("(\S+).fasta"),
@@ -530,69 +1010,242 @@ def STARIndexMergedGenomes(infiles, outfile):
     outfile_base = outfile.replace(".1.ht2l", "")
     strIndexPath = os.path.dirname(outfile)
 
-    job_memory = "60G"
+    # STAR writes its temporary files to <outFileNamePrefix>_STARtmp
+    job_size = sizeJob("star_index", strIndexPath, [genome, gtf],
+                       threads=PARAMS["star_threads"], memory="60G",
+                       scratch=strIndexPath + "_STARtmp")
+    job_threads = job_size.threads
+    job_memory = job_size.jobMemory(job_threads, "60G")
+    limit_ram = job_size.resources.memory
 
     statement = '''
     mkdir %(strIndexPath)s; checkpoint; 
     STAR --runMode genomeGenerate
-    --runThreadN %(star_threads)s
+    --runThreadN %(job_threads)s
     --genomeDir %(strIndexPath)s
     --outFileNamePrefix %(strIndexPath)s
     --genomeFastaFiles %(genome)s
-    --limitGenomeGenerateRAM 60000000000
+    --limitGenomeGenerateRAM %(limit_ram)i
     --genomeChrBinNbits 12
     --sjdbGTFfile %(gtf)s
     --sjdbOverhang %(star_tx_overhang)s'''
 
-    P.run()
+    LEDGER.run(job_size)
 
 ##############################################################################
 #  Align to genomes
 ##############################################################################
 
-@mkdir("mapped")
-@transform(Extract10X,
-           regex("extract/(\S+)_extracted.fastq"),
-           add_inputs(IndexMergedGenomes),
-           r"mapped/\1.bam")
-def AlignToHumanMouse(infiles, outfile):
-    '''
-    align 10X data to individual or combined hg38 & mm10 genome
-    retain only the mapped, primary reads
-    '''
-
-    # combined_genome only req. for subset of infiles
-    infile, combined_genome = infiles
+def getReferenceGenome(sample_name, combined_genome):
+    '''return the hisat2 index for the 10X sample: the individual hg38
+    or mm10 genome, or the combined genome'''
 
-    sample_name = os.path.basename(infile).replace("_extracted.fastq", "")
     species = TENX2INFO[sample_name]["species"]
-    
-    if species in ["mm", "hg"]:
-        if species == "mm":
-            species = "mm10"
-        elif species == "hg":
-            species = "hg38"
-        ref_genome = os.path.join(PARAMS["hisat_dir"], species)
+
+    if species == "mm":
+        return os.path.join(PARAMS["hisat_dir"], "mm10")
+    elif species == "hg":
+        return os.path.join(PARAMS["hisat_dir"], "hg38")
     else:
-        ref_genome = combined_genome.replace(".1.ht2l", "")  
+        return combined_genome.replace(".1.ht2l", "")
 
-    unsorted_bam = P.getTempFilename()
 
-    job_threads = 12
-    job_memory = "3.9G"
+def alignAndSortStatement(reads, ref_genome, outfile, align_threads=None,
+                          tmp_prefix=None):
+    '''return the statement to align `reads` (a fastq or "-" for
+    stdin) and sort the mapped, primary alignments to `outfile`,
+    without an unsorted intermediate BAM. samtools sort spills to
+    compressed temporary files, `tmp_prefix`*, if it exceeds its
+    memory limit'''
 
-    statement = '''
-    hisat2 -x %(ref_genome)s -U %(infile)s -k1 --threads %(job_threads)s
+    align_threads = align_threads or PARAMS["align_threads"]
+    sort_threads = PARAMS["align_sort_threads"]
+    sort_memory = PARAMS["align_sort_memory"]
+    tmp_prefix = tmp_prefix or P.getTempFilename()
+
+    return '''
+    hisat2 -x %(ref_genome)s -U %(reads)s -k1 --threads %(align_threads)s
     2>%(outfile)s.log |
-    samtools view -bS -F 4 -F 256 - > %(unsorted_bam)s; checkpoint ;
-    samtools sort %(unsorted_bam)s -o %(outfile)s; checkpoint ; 
-    samtools index %(outfile)s; checkpoint; 
-    rm -f %(unsorted_bam)s'''
+    samtools view -u -F 4 -F 256 - |
+    samtools sort -@ %(sort_threads)s -m %(sort_memory)s
+    -T %(tmp_prefix)s -o %(outfile)s - ; checkpoint ;
+    samtools index %(outfile)s ; checkpoint ;
+    rm -f %(tmp_prefix)s''' % locals()
 
-    P.run()
 
-    IOTools.zapFile(infile)
-    P.touch(outfile)
+def mergeBamsStatement(infiles, outfile, index=True):
+    '''return the statement to merge the sorted BAMs `infiles`'''
+
+    infiles = " ".join(sorted(infiles))
+    merge_threads = PARAMS["shard_threads"]
+
+    statement = '''
+    samtools merge -f -@ %(merge_threads)s %(outfile)s %(infiles)s''' % locals()
+
+    if index:
+        statement += "; checkpoint ; samtools index %s" % outfile
+
+    return statement
+
+
+if PARAMS["shard_lanes"]:
+
+    # split the samples into their lanes, which are extracted, aligned
+    # and assigned to genes as independent jobs and merged at the end
+    @follows(*EXTRACT_10X_FOLLOWS)
+    @subdivide(download10x,
+               regex("raw/10X_fastqs/(\S+).fastq.1.gz"),
+               r"shards/\1/\1_shard*.fastq.1.gz",
+               r"shards/\1/\1_shard%03i.fastq.1.gz")
+    def Split10XFastqs(infile, outfiles, output_pattern):
+        '''split the 10X fastqs into a shard per lane. The lanes are
+        copied out of the downloaded fastqs as they are, without
+        decompressing them'''
+
+        for outfile in outfiles:
+            os.unlink(outfile)
+            os.unlink(outfile.replace(".fastq.1.gz", ".fastq.2.gz"))
+
+        if not os.path.exists(os.path.dirname(output_pattern)):
+            os.makedirs(os.path.dirname(output_pattern))
+
+        infile2 = infile.replace(".fastq.1.gz", ".fastq.2.gz")
+        output_pattern2 = output_pattern.replace(".fastq.1.gz", ".fastq.2.gz")
+        logfile = os.path.join(os.path.dirname(output_pattern), "split.log")
+
+        statement = '''
+        python %(src_dir)s/split_fastq.py
+        --fastq=%(infile)s
+        --output-pattern=%(output_pattern)s -L %(logfile)s ; checkpoint ;
+        python %(src_dir)s/split_fastq.py
+        --fastq=%(infile2)s
+        --output-pattern=%(output_pattern2)s -L %(logfile)s.2
+        '''
+
+        LEDGER.run()
+
+        CACHE.zapFile(infile)
+        CACHE.zapFile(infile2)
+
+    @transform(Split10XFastqs,
+               regex("shards/(\S+)/(\S+).fastq.1.gz"),
+               add_inputs(r"whitelist/10X_\1_whitelist.tsv",
+                          IndexMergedGenomes),
+               r"shards/\1/\2.bam")
+    @CACHE.cached
+    def AlignShards(infiles, outfile):
+        '''
+        extract the cell barcodes and UMIs from a shard of a 10X sample
+        and stream the reads into the alignment. Retain only the
+        mapped, primary reads
+        '''
+
+        infile, whitelist, combined_genome = infiles
+        infile2 = infile.replace("fastq.1.gz", "fastq.2.gz")
+
+        sample_name = os.path.basename(os.path.dirname(infile))
+        ref_genome = getReferenceGenome(sample_name, combined_genome)
+
+        tmp_prefix = P.getTempFilename()
+        job_size = sizeJob("align_shard", outfile, [infile, infile2],
+                           sample_name, threads=PARAMS["shard_threads"],
+                           scratch=tmp_prefix + "*")
+        job_threads = job_size.threads + PARAMS["align_sort_threads"] + 1
+        job_memory = job_size.jobMemory(job_threads, "3.9G")
+
+        statement = (extract10XStatement(infile, whitelist) +
+                     "-L %(outfile)s.extract.log |" +
+                     alignAndSortStatement("-", ref_genome, outfile,
+                                           job_size.threads, tmp_prefix))
+
+        LEDGER.run(job_size)
+
+        CACHE.zapFile(infile)
+        CACHE.zapFile(infile2)
+        P.touch(outfile)
+
+    # the aligned shards are assigned to genes before they are merged
+    # (AssignGenes10X)
+    AlignToHumanMouse = AlignShards
+
+elif PARAMS["align_stream_extract"]:
+
+    # extract, align and sort in a single stream so the extracted
+    # fastq and unsorted BAM are never written to disk
+    @mkdir("mapped")
+    @follows(*EXTRACT_10X_FOLLOWS)
+    @transform(download10x,
+               regex("raw/10X_fastqs/(\S+).fastq.1.gz"),
+               add_inputs(r"whitelist/10X_\1_whitelist.tsv",
+                          IndexMergedGenomes),
+               r"mapped/\1.bam")
+    @CACHE.cached
+    def AlignToHumanMouse(infiles, outfile):
+        '''
+        extract the cell barcodes and UMIs and stream the reads
+        straight into the alignment to the individual or combined hg38
+        & mm10 genome. Retain only the mapped, primary reads
+        '''
+
+        infile, whitelist, combined_genome = infiles
+        infile2 = infile.replace("fastq.1.gz", "fastq.2.gz")
+
+        sample_name = os.path.basename(infile).replace(".fastq.1.gz", "")
+        ref_genome = getReferenceGenome(sample_name, combined_genome)
+
+        tmp_prefix = P.getTempFilename()
+        job_size = sizeJob("align_stream", outfile, [infile, infile2],
+                           sample_name, threads=PARAMS["align_threads"],
+                           scratch=tmp_prefix + "*")
+        job_threads = job_size.threads + PARAMS["align_sort_threads"] + 1
+        job_memory = job_size.jobMemory(job_threads, "3.9G")
+
+        statement = (extract10XStatement(infile, whitelist) +
+                     "-L %(outfile)s.extract.log |" +
+                     alignAndSortStatement("-", ref_genome, outfile,
+                                           job_size.threads, tmp_prefix))
+
+        LEDGER.run(job_size)
+
+        CACHE.zapFile(infile)
+        CACHE.zapFile(infile2)
+        P.touch(outfile)
+
+else:
+
+    @mkdir("mapped")
+    @transform(Extract10X,
+               regex("extract/(\S+)_extracted.fastq"),
+               add_inputs(IndexMergedGenomes),
+               r"mapped/\1.bam")
+    @CACHE.cached
+    def AlignToHumanMouse(infiles, outfile):
+        '''
+        align 10X data to individual or combined hg38 & mm10 genome
+        retain only the mapped, primary reads
+        '''
+
+        # combined_genome only req. for subset of infiles
+        infile, combined_genome = infiles
+
+        sample_name = os.path.basename(infile).replace(
+            "_extracted.fastq", "")
+        ref_genome = getReferenceGenome(sample_name, combined_genome)
+
+        tmp_prefix = P.getTempFilename()
+        job_size = sizeJob("align_extracted", outfile, [infile], sample_name,
+                           threads=PARAMS["align_threads"],
+                           scratch=tmp_prefix + "*")
+        job_threads = job_size.threads + PARAMS["align_sort_threads"]
+        job_memory = job_size.jobMemory(job_threads, "3.9G")
+
+        statement = alignAndSortStatement(infile, ref_genome, outfile,
+                                          job_size.threads, tmp_prefix)
+
+        LEDGER.run(job_size)
+
+        CACHE.zapFile(infile)
+        P.touch(outfile)
 
 @follows(AlignToHumanMouse)
 def Align():
@@ -603,37 +1256,24 @@ def Align():
 #  Assign genes
 ##############################################################################
 
-@transform(AlignToHumanMouse,
-           regex("(\S+).bam"),
-           add_inputs((PARAMS['geneset_hg'], PARAMS['geneset_mm'])),
-           r"\1.bam.featureCounts.bam")
-def AssignGenes10X(infiles, outfile):
-    '''
-    '''
-
-    infile, genesets = infiles
-    hg_geneset, mm_geneset = genesets
+def assignGenesStatement(infile, outfile, sample_name, genesets):
+    '''return the statement to tag the reads in `infile` with their
+    gene assignments, using the prebuilt `genesets` (see
+    :func:`getGenesets`), with featureCounts or gene_tagger.py as per
+    assign_method'''
 
-    tmpgeneset = P.getTempFilename()
+    hg_geneset, mm_geneset, hgmm_geneset = genesets
 
-    sample_name = os.path.basename(infile).replace(".bam", "")
     species = TENX2INFO[sample_name]["species"]
 
     if species == "hg":
-        statement = '''
-        zcat %(hg_geneset)s  > %(tmpgeneset)s; checkpoint ;
-        '''
+        geneset = hg_geneset
 
     elif species == "mm":
-        statement = '''
-        zcat %(mm_geneset)s  > %(tmpgeneset)s; checkpoint ;
-        '''
+        geneset = mm_geneset
 
     elif species == "hgmm":
-        statement = '''
-        zcat %(hg_geneset)s | sed 's/^chr/hg_chr/g' > %(tmpgeneset)s; checkpoint ;
-        zcat %(mm_geneset)s | sed 's/^chr/mm_chr/g' >> %(tmpgeneset)s; checkpoint ;
-        '''
+        geneset = hgmm_geneset
     
     elif species == "ercc":
         raise ValueError("pipeline can't handle ercc yet: %s" % sample_name)
@@ -641,19 +1281,233 @@ def AssignGenes10X(infiles, outfile):
     else:
         raise ValueError("species not recognised for sample: %s" % sample_name)
 
+    if PARAMS["assign_method"] == "tagger":
+        # keeps the coordinate sort order of `infile` and indexes the
+        # output, so it needn't be sorted again for umi_tools
+        statement = '''
+        python %%(src_dir)s/gene_tagger.py
+        --bamfile=%(infile)s
+        --geneset=%(geneset)s
+        --output-bam=%(outfile)s
+        -L %(outfile)s.log; '''
+
+    elif PARAMS["assign_method"] == "featurecounts":
+        # -M assigns multimapped reads too
+        # -R BAM outputs tagged BAM to "[INFILENAME].featurecounts.bam"
+        statement = '''
+        featureCounts -a %(geneset)s -M -R BAM -o %(outfile)s.txt %(infile)s
+        > %(outfile)s.log; '''
+
+    else:
+        raise ValueError("assign_method should be featurecounts or "
+                         "tagger: %s" % PARAMS["assign_method"])
+
+    return statement % locals()
+
+
+def sortForUMIToolsStatement(infile, tmpdir, logfile):
+    '''return the statement to make a coordinate sorted and indexed
+    copy of the gene tagged `infile` in `tmpdir` for umi_tools, and the
+    BAM to pass to umi_tools. `infile` is only sorted if bam_state.py
+    finds it isn't already sorted (e.g with assign_method=tagger),
+    otherwise the copy is a link to `infile`'''
+
+    sorted_bam = os.path.join(tmpdir, os.path.basename(infile))
+
+    if PARAMS["sort_tmpdir"]:
+        sort_tmpdir = "--tmpdir=%s" % PARAMS["sort_tmpdir"]
+    else:
+        sort_tmpdir = ""
+
+    statement = '''
+    python %%(src_dir)s/bam_state.py
+    --bamfile=%(infile)s
+    --sorted-bam=%(sorted_bam)s
+    --threads=%%(sort_threads)s
+    --memory=%%(sort_memory)s
+    %(sort_tmpdir)s
+    -L %(logfile)s; checkpoint ;''' % locals()
+
+    return statement, sorted_bam
+
+
+if PARAMS["shard_lanes"]:
+
+    @follows(MakeSpeciesGTFs, MakeMergedGTF)
+    @transform(AlignShards,
+               regex("(\S+).bam"),
+               add_inputs(getGenesets()),
+               r"\1.bam.featureCounts.bam")
+    @CACHE.cached
+    def AssignGenesShards(infiles, outfile):
+        '''
+        assign the reads in each shard of a 10X sample to genes
+        '''
+
+        infile, genesets = infiles
+        sample_name = os.path.basename(os.path.dirname(infile))
+
+        statement = assignGenesStatement(
+            infile, outfile, sample_name, genesets)
+
+        LEDGER.run()
+        CACHE.zapFile(infile)
+        P.touch(outfile)
+
+    @mkdir("mapped")
+    @collate(AssignGenesShards,
+             regex("shards/(\S+)/\S+_shard\d+.bam.featureCounts.bam"),
+             r"mapped/\1.bam.featureCounts.bam")
+    @CACHE.cached
+    def AssignGenes10X(infiles, outfile):
+        '''
+        merge the gene assigned shards for each 10X sample
+        '''
+
+        job_threads = PARAMS["shard_threads"]
+
+        # gene_tagger.py output stays sorted, so index it for umi_tools
+        statement = mergeBamsStatement(
+            infiles, outfile, index=PARAMS["assign_method"] == "tagger")
+
+        LEDGER.run()
+        for shard in infiles:
+            CACHE.zapFile(shard)
+        P.touch(outfile)
+
+else:
+
+    @follows(MakeSpeciesGTFs, MakeMergedGTF)
+    @transform(AlignToHumanMouse,
+               regex("(\S+).bam"),
+               add_inputs(getGenesets()),
+               r"\1.bam.featureCounts.bam")
+    @CACHE.cached
+    def AssignGenes10X(infiles, outfile):
+        '''
+        assign the reads to genes
+        '''
+
+        infile, genesets = infiles
+        sample_name = os.path.basename(infile).replace(".bam", "")
+
+        statement = assignGenesStatement(
+            infile, outfile, sample_name, genesets)
+
+        LEDGER.run()
+        CACHE.zapFile(infile)
+        P.touch(outfile)
+
+
+@mkdir("features.dir")
+@transform(AssignGenes10X,
+           regex("mapped/(\S+).bam.featureCounts.bam"),
+           r"features.dir/\1_cell_features.%s" % PARAMS["features_format"])
+def CellFeatures10X(infile, outfile):
+    '''
+    tally the per cell barcode QC features (aligned, assigned & Mt
+    fractions, duplication rate, base qualities etc) used to classify
+    the real cell barcodes, in a single pass over the gene tagged BAM
+    '''
+
+    statement = '''
+    python %(src_dir)s/cell_features.py
+    --bamfile=%(infile)s
+    --output-table=%(outfile)s
+    --min-reads=%(features_min_reads)s
+    -L %(outfile)s.log
+    '''
+
+    LEDGER.run()
+
+
+@transform(ExtractBackground10X,
+           regex("ambient.dir/(\S+)_background_extracted.fastq.gz"),
+           add_inputs(IndexMergedGenomes),
+           r"ambient.dir/\1_background.bam")
+@CACHE.cached
+def AlignBackground10X(infiles, outfile):
+    '''
+    align the reads of the background barcodes of each 10X sample,
+    retaining only the mapped, primary reads
+    '''
+
+    infile, combined_genome = infiles
+
+    sample_name = os.path.basename(infile).replace(
+        "_background_extracted.fastq.gz", "")
+    ref_genome = getReferenceGenome(sample_name, combined_genome)
+
+    tmp_prefix = P.getTempFilename()
+    job_size = sizeJob("align_extracted", outfile, [infile], sample_name,
+                       threads=PARAMS["align_threads"],
+                       scratch=tmp_prefix + "*")
+    job_threads = job_size.threads + PARAMS["align_sort_threads"]
+    job_memory = job_size.jobMemory(job_threads, "3.9G")
+
+    statement = alignAndSortStatement(infile, ref_genome, outfile,
+                                      job_size.threads, tmp_prefix)
+
+    LEDGER.run(job_size)
+
+    CACHE.zapFile(infile)
+    P.touch(outfile)
+
+
+@follows(MakeSpeciesGTFs, MakeMergedGTF)
+@transform(AlignBackground10X,
+           regex("(\S+).bam"),
+           add_inputs(getGenesets()),
+           r"\1.bam.featureCounts.bam")
+@CACHE.cached
+def AssignGenesBackground10X(infiles, outfile):
+    '''
+    assign the reads of the background barcodes to genes
+    '''
+
+    infile, genesets = infiles
+    sample_name = os.path.basename(infile).replace("_background.bam", "")
 
-    # -M assigns multimapped reads too
-    # -R BAM outputs tagged BAM to "[INFILENAME].featurecounts.bam"
-    statement += '''
-    featureCounts -a %(tmpgeneset)s -M -R BAM -o %(outfile)s.txt %(infile)s
-    > %(outfile)s.log; checkpoint; 
-    rm -f %(tmpgeneset)s; '''
+    statement = assignGenesStatement(
+        infile, outfile, sample_name, genesets)
 
-    P.run()
-    IOTools.zapFile(infile)
+    LEDGER.run()
+    CACHE.zapFile(infile)
     P.touch(outfile)
 
 
+@follows(AssignGenesBackground10X)
+@transform(AssignGenes10X,
+           regex("mapped/(\S+).bam.featureCounts.bam"),
+           add_inputs(r"ambient.dir/\1_background.bam.featureCounts.bam"),
+           [r"ambient.dir/\1_ambient_profile.tsv",
+            r"ambient.dir/\1_contamination.tsv"])
+def AmbientRNA10X(infiles, outfiles):
+    '''
+    estimate the ambient RNA profile from the background barcodes,
+    outside the whitelist, and the contamination of each whitelisted
+    cell, in a single pass over the gene tagged BAMs. Only for the 10X
+    samples, as the Drop-seq and inDrop samples are not aligned
+    '''
+
+    infile, background = infiles
+    profile, contamination = outfiles
+
+    statement = '''
+    python %(src_dir)s/ambient_rna.py
+    --bamfile=%(infile)s
+    --background-bamfile=%(background)s
+    --profile=%(profile)s
+    --contamination=%(contamination)s
+    --count=%(ambient_count)s
+    --ambient-genes=%(ambient_genes)s
+    --min-gene-counts=%(ambient_min_gene_counts)s
+    -L %(profile)s.log
+    '''
+
+    LEDGER.run()
+
+
 ##############################################################################
 #  Group
 ##############################################################################
@@ -670,12 +1524,12 @@ def group10X(infile, outfile):
     '''
 
     tmpfile = P.getTempDir()
-    outfile_base = os.path.basename(outfile)
+    job_threads = PARAMS["sort_threads"]
+    sort_statement, sorted_bam = sortForUMIToolsStatement(
+        infile, tmpfile, outfile + ".sort.log")
 
-    statement = '''
-    samtools sort %(infile)s -o %(tmpfile)s/%(outfile_base)s; checkpoint ;
-    samtools index %(tmpfile)s/%(outfile_base)s; checkpoint ;
-    umi_tools group -I %(tmpfile)s/%(outfile_base)s
+    statement = sort_statement + '''
+    umi_tools group -I %(sorted_bam)s
     --per-cell --per-gene --gene-tag=XT
     --group-out=%(outfile)s.tsv --output-bam
     --log=%(outfile)s.log
@@ -685,7 +1539,28 @@ def group10X(infile, outfile):
     rm -r %(tmpfile)s ;
     '''
 
-    P.run()
+    LEDGER.run()
+
+
+@transform(group10X,
+           regex("(\S+)_hg_mm_grouped.bam"),
+           r"\1_hg_mm_set_cover_genes.tsv")
+def geneSetCover10X(infile, outfile):
+    '''
+    greedily select the minimal set of genes explaining the
+    multimapped (featureCounts -M) reads
+    '''
+
+    statement = '''
+    python %(src_dir)s/gene_set_cover.py
+    --bamfile=%(infile)s
+    --gene-tag=XT
+    -L %(outfile)s.log
+    > %(outfile)s
+    '''
+
+    LEDGER.run()
+
 
 @transform(AssignGenes10X,
            regex("(\S+).bam.featureCounts.bam"),
@@ -696,21 +1571,36 @@ def UMIToolsDedup10X(infile, outfile):
     '''
 
     tmpfile = P.getTempDir(shared=True)
-    outfile_base = os.path.basename(outfile)
+    job_threads = max(PARAMS["sort_threads"], PARAMS["dedup_threads"])
+    sort_statement, sorted_bam = sortForUMIToolsStatement(
+        infile, tmpfile, outfile + ".sort.log")
+
+    if PARAMS["dedup_threads"] > 1:
+        # one umi_tools process per contig
+        statement = sort_statement + '''
+        python %(src_dir)s/parallel_dedup.py
+        --bamfile=%(sorted_bam)s
+        --output-bam=%(outfile)s
+        --output-stats=%(outfile)s_stats
+        --threads=%(dedup_threads)s
+        --tmpdir=%(tmpfile)s
+        --umi-tools-options="--per-cell --per-gene --gene-tag=XT --no-sort-output"
+        -L %(outfile)s.log; checkpoint;
+        rm -r %(tmpfile)s ;
+        '''
 
-    statement = '''
-    samtools sort %(infile)s -o %(tmpfile)s/%(outfile_base)s; checkpoint ;
-    samtools index %(tmpfile)s/%(outfile_base)s; checkpoint ;
-    umi_tools dedup -I %(tmpfile)s/%(outfile_base)s
-    --per-cell --per-gene --gene-tag=XT
-    --log=%(outfile)s.log
-    --no-sort-output
-    --output-stats=%(outfile)s_stats
-    > %(outfile)s; checkpoint; 
-    rm -r %(tmpfile)s ;
-    '''
+    else:
+        statement = sort_statement + '''
+        umi_tools dedup -I %(sorted_bam)s
+        --per-cell --per-gene --gene-tag=XT
+        --log=%(outfile)s.log
+        --no-sort-output
+        --output-stats=%(outfile)s_stats
+        > %(outfile)s; checkpoint; 
+        rm -r %(tmpfile)s ;
+        '''
 
-    P.run()
+    LEDGER.run()
 
 
 ##############################################################################
@@ -721,85 +1611,113 @@ def UMIToolsDedup10X(infile, outfile):
            r"\1_hg_mm_deduped.bam")
 def dedup10X(infile, outfile):
     '''
-    remove duplicate reads using UMI groups
+    remove duplicate reads using UMI groups. Streams the grouped BAM
+    and the group tsv together, retaining one read per UMI group
     '''
 
-    # need to write some bespoke code to take in output of UMI-tools
-    # group and remove duplicate reads
-    pass
+    statement = '''
+    python %(src_dir)s/dedup_groups.py
+    --bamfile=%(infile)s
+    --group-tsv=%(infile)s.tsv
+    --output-bam=%(outfile)s
+    -L %(outfile)s.log
+    '''
+
+    LEDGER.run()
 
 ##############################################################################
-#  Add CB errors (Post alignment)
+#  Sample stats
 ##############################################################################
 
+def assignLogs(sample_name):
+    '''return the featureCounts summaries or gene_tagger.py logs of the
+    gene assignment of a 10X sample, one per shard with shard_lanes'''
 
-# these could take in all extracted data (e.g indrop and dropset too)
-@mkdir("add_cb_errors.dir")
-@transform(AlignToHumanMouse,
-           regex("mapped/(\S+)_hg_mm.bam"),
-           r"add_cb_errors.dir/\1_added_errors.bam")
-def Add10XCBErrors(infile, outfile): 
-    '''add errors to the CBs for the 10X data'''
-    
-    statement = '''
-    python %(script_dir)s/add_cb_errors.py --infile %(infile)s
-    --log=%(outfile)s.log --error-table=%(outfile)s_table.tsv
-    --outfile %(outfile)s'''
+    if PARAMS["assign_method"] == "featurecounts":
+        suffix = ".bam.featureCounts.bam.txt.summary"
+    else:
+        suffix = ".bam.featureCounts.bam.log"
 
-    P.run()
+    if PARAMS["shard_lanes"]:
+        return sorted(glob.glob("shards/%s/*_shard*%s" % (
+            sample_name, suffix)))
+    return ["mapped/%s%s" % (sample_name, suffix)]
 
 
-@mkdir("add_cb_errors.dir")
-@transform(Extract10X,
-           regex("extract/(\S+)_extracted_set.fastq.gz"),
-           r"add_cb_errors.dir/\1_added_errors_high.fastq.gz")
-def Add10XCBErrorsHigh(infile, outfile): 
-    '''add errors to the CBs for the 10X data'''
-    
+@mkdir("stats.dir")
+@transform(UMIToolsDedup10X,
+           regex("mapped/(\S+)_dedup.bam"),
+           add_inputs(r"whitelist/10X_\1_whitelist.tsv"),
+           [sample_stats.partitionFile("stats.dir", x, r"\1")
+            for x in sample_stats.TABLES])
+def SampleStats10X(infiles, outfiles):
+    '''
+    collect the deduplication, whitelist and gene assignment stats of
+    each 10X sample, with its sample_info metadata, into the tables of
+    the stats.dir dataset, partitioned by sample. Read all the samples
+    with e.g pd.read_parquet("stats.dir/edit_distance")
+    '''
+
+    infile, whitelist = infiles
+    sample_name = os.path.basename(infile)[:-len("_dedup.bam")]
+    assign_logs = " ".join(
+        "--assign-log=%s" % x for x in assignLogs(sample_name))
+
     statement = '''
-    python %(script_dir)s/add_cb_errors.py --infile %(infile)s
-    --log=%(outfile)s.log --error-table=%(outfile)s_table.tsv
-    --error_method=literature-high
-    --outfile %(outfile)s'''
+    python %(src_dir)s/sample_stats.py
+    --sample=%(sample_name)s
+    --sample-info=%(sample_info)s
+    --dedup-log=%(infile)s.log
+    --dedup-stats=%(infile)s_stats
+    --whitelist=%(whitelist)s
+    %(assign_logs)s
+    --output-dir=stats.dir
+    -L stats.dir/%(sample_name)s.log
+    '''
 
-    P.run()
+    LEDGER.run()
 
 
-@mkdir("add_cb_errors.dir")
-@transform(Extract10X,
-           regex("extract/(\S+)_extracted_set.fastq.gz"),
-           r"add_cb_errors.dir/\1_added_errors_constant_low.fastq.gz")
-def Add10XCBErrorsConstantLow(infile, outfile): 
-    '''add errors to the CBs for the 10X data'''
-    
-    statement = '''
-    python %(script_dir)s/add_cb_errors.py --infile %(infile)s
-    --log=%(outfile)s.log --error-table=%(outfile)s_table.tsv
-    --error_method=constant
-    --sub-rate=0.001 --insert-rate=0.00002 --delete-rate=0.00001
-    --outfile %(outfile)s'''
+##############################################################################
+#  Add CB errors (Post alignment)
+##############################################################################
+
 
-    P.run()
+# with shard_lanes, the aligned reads are only merged once they have
+# been assigned to genes
+if PARAMS["shard_lanes"]:
+    CB_ERRORS_INPUT = (AssignGenes10X,
+                       "mapped/(\S+)_hg_mm.bam.featureCounts.bam")
+else:
+    CB_ERRORS_INPUT = (AlignToHumanMouse, "mapped/(\S+)_hg_mm.bam")
 
 
-@transform(Extract10X,
-           regex("extract/(\S+)_extracted_set.fastq.gz"),
-           r"add_cb_errors.dir/\1_added_errors_constant_low.fastq.gz")
-def Add10XCBErrorsConstantHigh(infile, outfile): 
-    '''add errors to the CBs for the 10X data'''
+# these could take in all extracted data (e.g indrop and dropset too)
+@mkdir("add_cb_errors.dir")
+@transform(CB_ERRORS_INPUT[0],
+           regex(CB_ERRORS_INPUT[1]),
+           [r"add_cb_errors.dir/\1_added_errors%s.bam" % (
+               "" if model == "default" else "_" + model.replace("-", "_"))
+            for model in P.asList(PARAMS["cb_errors_models"])])
+def Add10XCBErrors(infile, outfiles):
+    '''add errors to the CBs for the 10X data. All the error models
+    are applied in a single pass over the input'''
+
+    models = P.asList(PARAMS["cb_errors_models"])
+    outputs = " ".join("--output=%s:%s" % (model, outfile)
+                       for model, outfile in zip(models, outfiles))
+    logfile = outfiles[0] + ".log"
 
     statement = '''
-    python %(script_dir)s/add_cb_errors.py --infile %(infile)s
-    --log=%(outfile)s.log --error-table=%(outfile)s_table.tsv
-    --error_method=constant
-    --sub-rate=0.01 --insert-rate=0.002 --delete-rate=0.001
-    --outfile %(outfile)s'''
+    python %(src_dir)s/cb_errors.py --infile=%(infile)s
+    --seed=%(cb_errors_seed)s
+    %(outputs)s
+    -L %(logfile)s'''
 
-    P.run()
+    LEDGER.run()
 
 
-@follows(Add10XCBErrors, Add10XCBErrorsHigh,
-         Add10XCBErrorsConstantLow, Add10XCBErrorsConstantHigh)
+@follows(Add10XCBErrors)
 def addErrors():
     pass
 
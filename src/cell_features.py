@@ -0,0 +1,450 @@
+'''
+cell_features.py - per cell barcode QC features from a gene tagged BAM
+======================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Tally the per cell barcode QC features used to classify real cell
+barcodes from the ``featureCounts -R BAM`` output of
+``AssignGenes10X``, in a single pass over the BAM. This replaces the
+nested ``defaultdict`` / ``Counter`` loop in the
+Learning_real_CBs_slim notebook.
+
+The per read work is limited to pulling out the fields required (cell
+barcode and UMI from the read name, flag, contig, XT tag and base
+qualities) into flat arrays. The cell barcodes and genes are mapped
+to integer ids as they are seen. Every `chunk_size` reads, the arrays
+are reduced to per cell totals with ``np.bincount`` and the (cell,
+gene, UMI) triples are added to a :mod:`barcode_codec` count table,
+from which the UMI based features are derived once the BAM has been
+read.
+
+The features are as per the notebook:
+
+reads
+   primary reads for the cell barcode
+aligned
+   fraction of reads which are mapped
+assigned
+   fraction of mapped reads assigned to a gene
+mt
+   fraction of mapped reads on the mitochondrial contig
+dup_rate
+   1 - (unique gene/UMI pairs / mapped reads)
+mean_reads_umi, ratio_mean_max
+   mean reads per gene/UMI pair and the ratio of this mean to the
+   maximum
+mean_qual
+   mean base error probability from the Phred base qualities
+mean_exp, over_mean_exp
+   mean reads per gene and the fraction of genes above this mean
+genes
+   number of genes detected
+specificity
+   fraction of the reads from the species with the most reads, where
+   the contig names are prefixed with the species (e.g hg_chr1)
+
+along with the underlying counts. Cell barcodes with fewer than
+`min_reads` reads or no mapped reads are not reported.
+
+The table is written in parquet or feather format (requires
+``pyarrow``) according to the output file extension, otherwise as a
+tab-separated table.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python cell_features.py --bamfile=mapped/sample.bam.featureCounts.bam
+   --output-table=features.dir/sample_cell_features.parquet
+
+Command line options
+--------------------
+
+'''
+
+import array
+import sys
+
+import numpy as np
+import pandas as pd
+import pysam
+
+import CGAT.Experiment as E
+
+import barcode_codec
+
+
+# the features used to classify the cell barcodes
+FEATURE_COLUMNS = ["reads", "aligned", "assigned", "mt", "dup_rate",
+                   "mean_reads_umi", "ratio_mean_max", "mean_qual",
+                   "over_mean_exp", "mean_exp", "genes", "specificity"]
+
+# error probability for each Phred score
+_PHRED2PROB = 10 ** (np.arange(256) / -10.0)
+
+
+class CellTallies(object):
+    '''per cell barcode tallies accumulated in chunks of reads'''
+
+    def __init__(self, contigs, species=("hg", "mm"), mito_contig="chrM",
+                 chunk_size=1000000):
+
+        self.chunk_size = chunk_size
+        self.species = list(species)
+
+        # per contig lookups for the species and mitochondrial reads
+        species_ix = []
+        is_mt = []
+        for contig in contigs:
+            prefix, _, name = contig.partition("_")
+            if prefix in self.species and name:
+                species_ix.append(self.species.index(prefix))
+            else:
+                species_ix.append(len(self.species))
+                name = contig
+            is_mt.append(name.startswith(mito_contig))
+
+        self.contig2species = np.array(species_ix, dtype=np.int64)
+        self.contig2mt = np.array(is_mt, dtype=bool)
+
+        self.cell2id = {}
+        self.gene2id = {}
+        self.umi_length = None
+        self.invalid_umis = 0
+
+        n_species = len(self.species) + 1
+        self.reads = np.zeros(0, dtype=np.int64)
+        self.mapped = np.zeros(0, dtype=np.int64)
+        self.mt = np.zeros(0, dtype=np.int64)
+        self.species_reads = np.zeros((0, n_species), dtype=np.int64)
+        self.error_sum = np.zeros(0, dtype=np.float64)
+        self.bases = np.zeros(0, dtype=np.int64)
+
+        # keyed on (cell id << 32 | gene id, UMI)
+        self.umi_counts = barcode_codec.PairCountTable()
+
+        self._newChunk()
+
+    def _newChunk(self):
+        self._cells = array.array("q")
+        self._contigs = array.array("q")
+        self._genes = array.array("q")
+        self._umis = []
+        self._quals = bytearray()
+        self._lengths = array.array("q")
+
+    def _grow(self, n):
+        '''extend the per cell arrays to `n` cells'''
+
+        extra = n - len(self.reads)
+        if extra <= 0:
+            return
+
+        def pad(values):
+            return np.concatenate(
+                [values, np.zeros((extra,) + values.shape[1:],
+                                  dtype=values.dtype)])
+
+        self.reads = pad(self.reads)
+        self.mapped = pad(self.mapped)
+        self.mt = pad(self.mt)
+        self.species_reads = pad(self.species_reads)
+        self.error_sum = pad(self.error_sum)
+        self.bases = pad(self.bases)
+
+    def addBam(self, inbam):
+        '''add the primary reads from `inbam`, an open pysam
+        AlignmentFile. Returns the number of reads added'''
+
+        cell2id = self.cell2id
+        gene2id = self.gene2id
+        n = 0
+
+        for read in inbam.fetch(until_eof=True):
+
+            if read.is_secondary:
+                continue
+
+            # reads are named <read>_<cell>_<UMI> by umi_tools extract
+            _, cell, umi = read.query_name.rsplit("_", 2)
+
+            cell_id = cell2id.get(cell)
+            if cell_id is None:
+                cell_id = cell2id[cell] = len(cell2id)
+            self._cells.append(cell_id)
+
+            if read.is_unmapped:
+                self._contigs.append(-1)
+                self._genes.append(-1)
+            else:
+                self._contigs.append(read.reference_id)
+                if read.has_tag("XT"):
+                    gene = read.get_tag("XT")
+                    gene_id = gene2id.get(gene)
+                    if gene_id is None:
+                        gene_id = gene2id[gene] = len(gene2id)
+                    self._genes.append(gene_id)
+                else:
+                    self._genes.append(-1)
+
+            self._umis.append(umi)
+
+            quals = read.query_qualities
+            if quals is None:
+                self._lengths.append(0)
+            else:
+                self._quals += quals
+                self._lengths.append(len(quals))
+
+            n += 1
+            if len(self._cells) >= self.chunk_size:
+                self.flush()
+                E.debug("processed %i reads" % n)
+
+        self.flush()
+
+        return n
+
+    def flush(self):
+        '''reduce the current chunk of reads into the per cell tallies'''
+
+        if len(self._cells) == 0:
+            return
+
+        cells = np.frombuffer(self._cells, dtype=np.int64)
+        contigs = np.frombuffer(self._contigs, dtype=np.int64)
+        genes = np.frombuffer(self._genes, dtype=np.int64)
+        lengths = np.frombuffer(self._lengths, dtype=np.int64)
+
+        n_cells = len(self.cell2id)
+        self._grow(n_cells)
+
+        self.reads += np.bincount(cells, minlength=n_cells)
+
+        mapped = contigs >= 0
+        self.mapped += np.bincount(cells[mapped], minlength=n_cells)
+        self.mt += np.bincount(cells[mapped][self.contig2mt[contigs[mapped]]],
+                               minlength=n_cells)
+
+        n_species = self.species_reads.shape[1]
+        species_keys = (cells[mapped] * n_species +
+                        self.contig2species[contigs[mapped]])
+        self.species_reads += np.bincount(
+            species_keys, minlength=n_cells * n_species).reshape(
+                n_cells, n_species)
+
+        # sum the base error probabilities per read, then per cell
+        quals = np.frombuffer(bytes(self._quals), dtype=np.uint8)
+        has_quals = lengths > 0
+        if has_quals.any():
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            read_errors = np.add.reduceat(_PHRED2PROB[quals],
+                                          starts[has_quals])
+            self.error_sum += np.bincount(cells[has_quals],
+                                          weights=read_errors,
+                                          minlength=n_cells)
+        self.bases += np.bincount(cells, weights=lengths,
+                                  minlength=n_cells).astype(np.int64)
+
+        assigned = genes >= 0
+        if assigned.any():
+            umis = [umi for umi, ok in zip(self._umis, assigned) if ok]
+            if self.umi_length is None:
+                self.umi_length = len(umis[0])
+            codes, valid = barcode_codec.encode(umis, self.umi_length)
+            self.invalid_umis += int((~valid).sum())
+
+            keys = ((cells[assigned].astype(np.uint64) << np.uint64(32)) |
+                    genes[assigned].astype(np.uint64))
+            self.umi_counts.update(keys[valid], codes[valid])
+
+        self._newChunk()
+
+    def cells(self):
+        '''return the cell barcodes, in id order'''
+        cells = [None] * len(self.cell2id)
+        for cell, cell_id in self.cell2id.items():
+            cells[cell_id] = cell
+        return cells
+
+    def genome2reads(self):
+        '''return a dictionary of mapped reads per species'''
+        totals = self.species_reads.sum(axis=0)
+        return dict(zip(self.species + ["other"], totals.tolist()))
+
+    def getFeatures(self, min_reads=100):
+        '''return a dataframe of the counts and features per cell
+        barcode, indexed by cell barcode'''
+
+        n_cells = len(self.cell2id)
+        self._grow(n_cells)
+
+        (keys1, _), umi_counts = self.umi_counts.keys, self.umi_counts.counts
+        umi_cells = (keys1 >> np.uint64(32)).astype(np.int64)
+
+        # keys are sorted, so each cell's gene/UMI pairs are contiguous
+        assigned = np.bincount(umi_cells, weights=umi_counts,
+                               minlength=n_cells).astype(np.int64)
+        unique_umis = np.bincount(umi_cells, minlength=n_cells)
+        max_reads_umi = np.zeros(n_cells, dtype=np.int64)
+        if len(umi_cells):
+            starts = np.flatnonzero(np.concatenate(
+                ([True], umi_cells[1:] != umi_cells[:-1])))
+            max_reads_umi[umi_cells[starts]] = np.maximum.reduceat(
+                umi_counts, starts)
+
+        gene_keys, gene_counts = self.umi_counts.totals()
+        gene_cells = (gene_keys >> np.uint64(32)).astype(np.int64)
+        genes = np.bincount(gene_cells, minlength=n_cells)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_exp = np.where(genes > 0, assigned / genes, 0.0)
+            over_mean_exp = np.bincount(
+                gene_cells, weights=(gene_counts > mean_exp[gene_cells]).astype(float),
+                minlength=n_cells)
+            over_mean_exp = np.where(genes > 0, over_mean_exp / genes, 0.0)
+
+            mean_reads_umi = np.where(unique_umis > 0,
+                                      assigned / unique_umis, 0.0)
+            ratio_mean_max = np.where(max_reads_umi > 0,
+                                      mean_reads_umi / max_reads_umi, 0.0)
+
+            species_mapped = self.species_reads[:, :-1]
+            specificity = (species_mapped.max(axis=1) /
+                           species_mapped.sum(axis=1))
+
+            table = pd.DataFrame({
+                "cell": self.cells(),
+                "reads": self.reads,
+                "mapped_reads": self.mapped,
+                "unmapped_reads": self.reads - self.mapped,
+                "mt_reads": self.mt,
+                "assigned_reads": assigned,
+                "unique_umis": unique_umis,
+                "max_reads_umi": max_reads_umi,
+                "gene_count": genes,
+                "aligned": self.mapped / self.reads,
+                "assigned": assigned / self.mapped,
+                "mt": self.mt / self.mapped,
+                "dup_rate": 1 - unique_umis / self.mapped,
+                "mean_reads_umi": mean_reads_umi,
+                "ratio_mean_max": ratio_mean_max,
+                "mean_qual": self.error_sum / self.bases,
+                "over_mean_exp": over_mean_exp,
+                "mean_exp": mean_exp,
+                "genes": genes,
+                "specificity": specificity})
+
+        for ix, species in enumerate(self.species):
+            table["%s_reads" % species] = self.species_reads[:, ix]
+
+        keep = (self.reads >= min_reads) & (self.mapped > 0)
+        table = table[keep].sort_values("reads", ascending=False)
+
+        return table.set_index("cell")
+
+
+def writeFeatures(table, outfile):
+    '''write the feature table, in parquet or feather format according
+    to the extension of `outfile`, otherwise as tsv'''
+
+    if outfile.endswith(".parquet"):
+        table.to_parquet(outfile)
+    elif outfile.endswith(".feather"):
+        table.reset_index().to_feather(outfile)
+    else:
+        table.to_csv(outfile, sep="\t")
+
+
+def readFeatures(infile):
+    '''read a feature table written by :func:`writeFeatures`'''
+
+    if infile.endswith(".parquet"):
+        return pd.read_parquet(infile)
+    elif infile.endswith(".feather"):
+        return pd.read_feather(infile).set_index("cell")
+    else:
+        return pd.read_csv(infile, sep="\t", index_col=0)
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="gene tagged BAM from featureCounts [%default]")
+
+    parser.add_option("--output-table", dest="output_table",
+                      type="string",
+                      help="output table (.parquet, .feather or .tsv) "
+                      "[%default]")
+
+    parser.add_option("--min-reads", dest="min_reads", type="int",
+                      help="only report cell barcodes with at least "
+                      "this many reads [%default]")
+
+    parser.add_option("--species", dest="species", type="string",
+                      help="comma separated species prefixes of the "
+                      "contig names [%default]")
+
+    parser.add_option("--mito-contig", dest="mito_contig", type="string",
+                      help="name of the mitochondrial contig, without "
+                      "the species prefix [%default]")
+
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="number of reads tallied at a time [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        output_table=None,
+        min_reads=100,
+        species="hg,mm",
+        mito_contig="chrM",
+        chunk_size=1000000,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile or not options.output_table:
+        raise ValueError("--bamfile and --output-table are required")
+
+    inbam = pysam.AlignmentFile(options.bamfile)
+
+    tallies = CellTallies(inbam.references,
+                          species=options.species.split(","),
+                          mito_contig=options.mito_contig,
+                          chunk_size=options.chunk_size)
+    n_reads = tallies.addBam(inbam)
+    inbam.close()
+
+    table = tallies.getFeatures(min_reads=options.min_reads)
+    writeFeatures(table, options.output_table)
+
+    E.info("Input reads: %i, cell barcodes: %i, reported: %i" % (
+        n_reads, len(tallies.cell2id), len(table)))
+    E.info("Mapped reads per genome: %s" % ", ".join(
+        "%s=%i" % x for x in sorted(tallies.genome2reads().items())))
+    if tallies.invalid_umis:
+        E.warn("%i assigned reads with invalid UMIs were not used for the "
+               "UMI features" % tallies.invalid_umis)
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,196 @@
+'''
+dedup_groups.py - remove duplicate reads using umi_tools group output
+======================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Take the BAM and ``--group-out`` tsv written by ``umi_tools group
+--per-cell --per-gene --output-bam --no-sort-output`` and retain a
+single read for each UMI group (and therefore each cell, gene and
+UMI).
+
+``umi_tools group`` writes all the reads for a UMI group
+consecutively and writes one line to the group tsv per output read,
+so both files can be walked together in a single ordered pass. Only
+the reads for the current group are held in memory.
+
+Where a group contains more than one read, the read with the lowest
+number of alignments (NH tag) is retained, with ties broken by the
+highest mapping quality and then by input order.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python dedup_groups.py --bamfile=grouped.bam --group-tsv=grouped.bam.tsv
+   --output-bam=deduped.bam -L deduped.log
+
+Command line options
+--------------------
+
+'''
+
+import sys
+
+import pysam
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+def iterateGroupTable(infile):
+    '''iterate over the ``umi_tools group`` tsv, yielding (read_id,
+    gene, unique_id) per line'''
+
+    header = next(infile).rstrip("\n").split("\t")
+    read_ix = header.index("read_id")
+    id_ix = header.index("unique_id")
+    gene_ix = header.index("gene") if "gene" in header else None
+
+    for line in infile:
+        fields = line.rstrip("\n").split("\t")
+        gene = fields[gene_ix] if gene_ix is not None else None
+        yield fields[read_ix], gene, int(fields[id_ix])
+
+
+def iterateGroups(inbam, group_table):
+    '''iterate over the reads in `inbam` alongside the `group_table`
+    lines, yielding (unique_id, gene, reads) for each UMI group.
+
+    Reads without a UG tag (not grouped) are skipped. Raises a
+    ValueError if the BAM and tsv disagree or if a group is not
+    contiguous in the input.
+    '''
+
+    last_id = None
+    last_gene = None
+    reads = []
+
+    for read in inbam.fetch(until_eof=True):
+
+        if not read.has_tag("UG"):
+            continue
+
+        try:
+            read_id, gene, unique_id = next(group_table)
+        except StopIteration:
+            raise ValueError(
+                "group tsv ended before the BAM at read %s" % read.query_name)
+
+        if read_id != read.query_name or unique_id != read.get_tag("UG"):
+            raise ValueError(
+                "BAM and group tsv are out of step: %s (UG:%s) vs %s (%s)" % (
+                    read.query_name, read.get_tag("UG"), read_id, unique_id))
+
+        if unique_id != last_id:
+            if reads:
+                yield last_id, last_gene, reads
+
+            # umi_tools assigns the unique ids in output order
+            if last_id is not None and unique_id < last_id:
+                raise ValueError(
+                    "UMI group %i is not contiguous. Was the group BAM "
+                    "sorted? Use --no-sort-output with umi_tools group" %
+                    unique_id)
+
+            last_id = unique_id
+            last_gene = gene
+            reads = []
+
+        reads.append(read)
+
+    if reads:
+        yield last_id, last_gene, reads
+
+    remaining = next(group_table, None)
+    if remaining is not None:
+        raise ValueError(
+            "group tsv has lines beyond the end of the BAM, starting at %s" %
+            remaining[0])
+
+
+def selectRead(reads):
+    '''select the read to retain from a UMI group. Retain the read
+    with the fewest alignments, then the highest MAPQ'''
+
+    def _key(read):
+        nh = read.get_tag("NH") if read.has_tag("NH") else 1
+        return (nh, -read.mapping_quality)
+
+    return min(reads, key=_key)
+
+
+def dedupGroups(inbam, outbam, group_table):
+    '''write one read per UMI group from `inbam` to `outbam`.
+
+    Returns a Counter of reads in, groups and reads out.
+    '''
+
+    counts = E.Counter()
+
+    for unique_id, gene, reads in iterateGroups(inbam, group_table):
+        counts.input_reads += len(reads)
+        counts.groups += 1
+        outbam.write(selectRead(reads))
+        counts.output_reads += 1
+
+    return counts
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="BAM output from umi_tools group [%default]")
+
+    parser.add_option("--group-tsv", dest="group_tsv", type="string",
+                      help="--group-out tsv from umi_tools group "
+                      "[%default]")
+
+    parser.add_option("--output-bam", dest="output_bam", type="string",
+                      help="deduplicated BAM [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        group_tsv=None,
+        output_bam=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not (options.bamfile and options.group_tsv and options.output_bam):
+        raise ValueError(
+            "--bamfile, --group-tsv and --output-bam are all required")
+
+    inbam = pysam.AlignmentFile(options.bamfile, "rb")
+    outbam = pysam.AlignmentFile(options.output_bam, "wb", template=inbam)
+
+    with IOTools.openFile(options.group_tsv, "r") as inf:
+        counts = dedupGroups(inbam, outbam, iterateGroupTable(inf))
+
+    outbam.close()
+    inbam.close()
+
+    E.info("Input reads: %i, UMI groups: %i, output reads: %i" % (
+        counts.input_reads, counts.groups, counts.output_reads))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
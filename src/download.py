@@ -0,0 +1,580 @@
+'''
+download.py - resumable, parallel downloads of the raw data
+===========================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Download the raw data over HTTP(S) or FTP, replacing the single
+stream ``wget`` calls in the download tasks.
+
+Where the server supports byte ranges (HTTP ``Accept-Ranges`` or FTP
+``REST``), the file is split into chunks which are fetched in
+parallel, each written in place into ``<outfile>.part``. The
+completed chunks are recorded in ``<outfile>.part.chunks`` so an
+interrupted download resumes with the remaining chunks. Otherwise,
+the file is fetched in a single stream, resuming from the end of any
+partial download if possible. Failed requests are retried.
+
+Once complete, the size is checked and the md5 checksum is compared
+against `md5` if given and written to ``<outfile>.md5``.
+
+For tar archives (e.g the 10X fastqs), members matching a pattern can
+be streamed straight into an output file, so the archive is never
+extracted to disk. Members are appended to the output in order of
+name, as ``cat`` of a glob would, and concatenated gzip members are a
+valid gzip file. The md5 checksum of each output, computed as it is
+written, is written to ``<outfile>.md5``. The byte range of each
+member in the output is recorded in ``<outfile>.members``, so the
+members (e.g the lanes) can be split out again by split_fastq.py.
+With `stream`, the archive itself is not written to disk either, at
+the cost of the parallel and resumable download. In this case the
+members are appended in archive order and an error is raised if the
+read 1 and read 2 members are not in the same order.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python download.py --url=ftp://ftp.sra.ebi.ac.uk/.../SRR1873277_1.fastq.gz
+   --outfile=raw/dropseq_mixed_species.fastq.1.gz --threads=4
+
+   python download.py --url=http://.../pbmc4k_fastqs.tar
+   --member="*/pbmc4k_S1_*_R1_001.fastq.gz:raw/10X_fastqs/pbmc4k.fastq.1.gz"
+   --member="*/pbmc4k_S1_*_R2_001.fastq.gz:raw/10X_fastqs/pbmc4k.fastq.2.gz"
+
+Command line options
+--------------------
+
+'''
+
+import concurrent.futures
+import fnmatch
+import ftplib
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+BLOCK_SIZE = 2 ** 20
+
+
+class _FTPRange(object):
+    '''file-like reader for bytes `start` to `end` (inclusive, or to the
+    end of the file if None) of a file on an FTP server'''
+
+    def __init__(self, url, start=0, end=None, timeout=60):
+        parsed = urllib.parse.urlparse(url)
+        self.ftp = ftplib.FTP(timeout=timeout)
+        self.ftp.connect(parsed.hostname, parsed.port or 21)
+        self.ftp.login(parsed.username or "anonymous",
+                       parsed.password or "anonymous@")
+        self.ftp.voidcmd("TYPE I")
+        self.conn = self.ftp.transfercmd(
+            "RETR %s" % urllib.parse.unquote(parsed.path), rest=start or None)
+        self.remaining = None if end is None else end - start + 1
+
+    def read(self, size=BLOCK_SIZE):
+        if size is None or size < 0:
+            size = BLOCK_SIZE
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size == 0:
+                return b""
+        data = self.conn.recv(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.conn.close()
+        try:
+            # stopping a transfer early makes the server report an error
+            self.ftp.voidresp()
+        except ftplib.all_errors:
+            pass
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+def _isFTP(url):
+    return url.startswith("ftp://")
+
+
+def remoteSize(url, timeout=60):
+    '''return the size of the remote file (None if unknown) and
+    whether byte range requests are supported'''
+
+    if _isFTP(url):
+        parsed = urllib.parse.urlparse(url)
+        ftp = ftplib.FTP(timeout=timeout)
+        ftp.connect(parsed.hostname, parsed.port or 21)
+        ftp.login(parsed.username or "anonymous",
+                  parsed.password or "anonymous@")
+        ftp.voidcmd("TYPE I")
+        try:
+            size = ftp.size(urllib.parse.unquote(parsed.path))
+        except ftplib.error_perm:
+            size = None
+        ftp.quit()
+        return size, size is not None
+
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        size = response.headers.get("Content-Length")
+        ranges = response.headers.get("Accept-Ranges", "none") == "bytes"
+
+    return (int(size) if size is not None else None), ranges
+
+
+def openRange(url, start=0, end=None, timeout=60):
+    '''open the remote file for reading from byte `start` to `end`
+    (inclusive, or to the end of the file if None)'''
+
+    if _isFTP(url):
+        return _FTPRange(url, start, end, timeout)
+
+    request = urllib.request.Request(url)
+    if start or end is not None:
+        request.add_header("Range", "bytes=%i-%s" % (
+            start, "" if end is None else end))
+
+    response = urllib.request.urlopen(request, timeout=timeout)
+    if (start or end is not None) and response.status != 206:
+        response.close()
+        raise IOError("server ignored the range request for %s" % url)
+
+    return response
+
+
+def _retry(func, retries, description):
+    '''call `func`, retrying with a back off if it raises an error'''
+
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (IOError, OSError, ftplib.Error) as error:
+            if attempt == retries:
+                raise
+            E.warn("%s failed (%s), retrying" % (description, error))
+            time.sleep(2 ** attempt)
+
+
+def _copyRange(url, start, end, outfile, timeout):
+    '''write bytes `start` to `end` of `url` in place into `outfile`'''
+
+    source = openRange(url, start, end, timeout)
+    try:
+        with open(outfile, "r+b") as outf:
+            outf.seek(start)
+            expected = end - start + 1
+            while expected > 0:
+                data = source.read(min(BLOCK_SIZE, expected))
+                if not data:
+                    raise IOError("connection closed early for %s" % url)
+                outf.write(data)
+                expected -= len(data)
+    finally:
+        source.close()
+
+
+def _readChunkState(state_file, size, chunk_size):
+    '''return the completed chunks recorded in `state_file`, or an
+    empty set if it was made for a different file size or chunk size'''
+
+    if not os.path.exists(state_file):
+        return set()
+
+    with open(state_file) as inf:
+        lines = inf.read().split()
+
+    if lines[:2] != [str(size), str(chunk_size)]:
+        return set()
+
+    return set(int(x) for x in lines[2:])
+
+
+def _downloadChunks(url, part_file, size, threads, chunk_size, retries,
+                    timeout):
+    '''fetch `url` into `part_file` in chunks, in parallel, recording
+    the completed chunks so the download can be resumed'''
+
+    state_file = part_file + ".chunks"
+    done = _readChunkState(state_file, size, chunk_size)
+
+    if not done or not os.path.exists(part_file):
+        done = set()
+        with open(part_file, "wb") as outf:
+            outf.truncate(size)
+        with open(state_file, "w") as outf:
+            outf.write("%i\n%i\n" % (size, chunk_size))
+
+    chunks = [(ix, start, min(start + chunk_size, size) - 1)
+              for ix, start in enumerate(range(0, size, chunk_size))
+              if ix not in done]
+
+    if done:
+        E.info("resuming %s: %i/%i chunks remaining" % (
+            url, len(chunks), len(chunks) + len(done)))
+
+    lock = threading.Lock()
+
+    def fetch(chunk):
+        ix, start, end = chunk
+        _retry(lambda: _copyRange(url, start, end, part_file, timeout),
+               retries, "chunk %i of %s" % (ix, url))
+        with lock:
+            with open(state_file, "a") as outf:
+                outf.write("%i\n" % ix)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for result in pool.map(fetch, chunks):
+            pass
+
+    os.unlink(state_file)
+
+
+def _downloadStream(url, part_file, ranges, retries, timeout):
+    '''fetch `url` into `part_file` in a single stream, resuming from the
+    end of `part_file` if the server supports ranges'''
+
+    def fetch():
+        start = 0
+        if ranges and os.path.exists(part_file):
+            start = os.path.getsize(part_file)
+        source = openRange(url, start, None, timeout)
+        try:
+            with open(part_file, "ab" if start else "wb") as outf:
+                shutil.copyfileobj(source, outf, BLOCK_SIZE)
+        finally:
+            source.close()
+
+    _retry(fetch, retries, "download of %s" % url)
+
+
+def writeChecksum(outfile, checksum):
+    '''write the md5 `checksum` of `outfile` to ``<outfile>.md5``, in
+    ``md5sum`` format'''
+
+    with open(outfile + ".md5", "w") as outf:
+        outf.write("%s  %s\n" % (checksum, os.path.basename(outfile)))
+
+
+def md5sum(infile):
+    '''return the md5 hex digest of `infile`'''
+
+    digest = hashlib.md5()
+    with open(infile, "rb") as inf:
+        for block in iter(lambda: inf.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def downloadFile(url, outfile, threads=4, chunk_size=2 ** 26, md5=None,
+                 retries=3, timeout=60):
+    '''download `url` to `outfile`, in parallel chunks if the server
+    supports byte ranges, resuming any earlier partial download.
+
+    Raises a ValueError if the size or the md5 checksum doesn't match.
+    '''
+
+    size, ranges = _retry(lambda: remoteSize(url, timeout), retries,
+                          "size of %s" % url)
+    part_file = outfile + ".part"
+
+    if ranges and size and threads > 1:
+        _downloadChunks(url, part_file, size, threads, chunk_size,
+                        retries, timeout)
+    else:
+        _downloadStream(url, part_file, ranges, retries, timeout)
+
+    if size is not None and os.path.getsize(part_file) != size:
+        raise ValueError("%s is %i bytes, expected %i" % (
+            part_file, os.path.getsize(part_file), size))
+
+    checksum = md5sum(part_file)
+    if md5 is not None and checksum != md5.lower():
+        os.unlink(part_file)
+        raise ValueError("md5 checksum of %s is %s, expected %s" % (
+            url, checksum, md5))
+
+    os.rename(part_file, outfile)
+    writeChecksum(outfile, checksum)
+
+    return checksum
+
+
+class _HashingReader(object):
+    '''file-like wrapper which computes the md5 of the data read'''
+
+    def __init__(self, source):
+        self.source = source
+        self.digest = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _matchMember(name, members):
+    '''return the index of the first (pattern, outfile) in `members`
+    matching the tar member `name`, or None'''
+
+    for ix, (pattern, _) in enumerate(members):
+        if fnmatch.fnmatch(name, pattern):
+            return ix
+    return None
+
+
+def _pairKey(name):
+    '''member name with the read number removed, to check the read 1
+    and read 2 members are in the same order'''
+    return re.sub("_[RI][12]_", "_", name)
+
+
+def extractMembers(tar, members, sort=True):
+    '''append the members of the open tarfile `tar` matching each
+    (pattern, outfile) in `members` to the outfile.
+
+    The md5 checksum of each outfile, computed as it is written, is
+    written to ``<outfile>.md5`` and the byte range of each member in
+    its outfile to ``<outfile>.members``.
+
+    Returns a list of the member names written to each outfile.
+    '''
+
+    if sort:
+        tar_members = sorted(tar.getmembers(), key=lambda x: x.name)
+    else:
+        tar_members = tar
+
+    written = [[] for x in members]
+    ranges = [[] for x in members]
+    digests = [hashlib.md5() for x in members]
+    outfiles = [open(outfile, "wb") for _, outfile in members]
+
+    try:
+        for member in tar_members:
+            if not member.isfile():
+                continue
+            ix = _matchMember(member.name, members)
+            if ix is None:
+                continue
+            offset = outfiles[ix].tell()
+            source = tar.extractfile(member)
+            for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+                digests[ix].update(block)
+                outfiles[ix].write(block)
+            written[ix].append(member.name)
+            ranges[ix].append((member.name, offset,
+                               outfiles[ix].tell() - offset))
+            E.debug("appended %s to %s" % (member.name, members[ix][1]))
+    finally:
+        for outf in outfiles:
+            outf.close()
+
+    # each member is a gzip file in its own right, so split_fastq.py
+    # can cut them out again by these byte ranges
+    for (_, outfile), member_ranges, digest in zip(members, ranges,
+                                                    digests):
+        writeChecksum(outfile, digest.hexdigest())
+        with open(outfile + ".members", "w") as outf:
+            outf.write("member\toffset\tsize\n")
+            for name, offset, size in member_ranges:
+                outf.write("%s\t%i\t%i\n" % (name, offset, size))
+
+    for (pattern, outfile), names in zip(members, written):
+        if not names:
+            raise ValueError("no members of the archive match %s" % pattern)
+
+    keys = [[_pairKey(os.path.basename(x)) for x in names]
+            for names in written]
+    if any(x != keys[0] for x in keys[1:]):
+        raise ValueError(
+            "the archive members are not in the same order for each "
+            "output: %s" % written)
+
+    return written
+
+
+def downloadTarMembers(url, members, tar_file=None, stream=False,
+                       md5=None, threads=4, chunk_size=2 ** 26, retries=3,
+                       timeout=60):
+    '''download the tar archive at `url` and write the members
+    matching each (pattern, outfile) in `members` to the outfile.
+
+    Unless `stream`, the archive is downloaded to `tar_file` (with
+    :func:`downloadFile`) and removed once the members have been
+    written. Otherwise, the members are read directly from the
+    download.
+    '''
+
+    if not stream:
+        tar_file = tar_file or members[0][1] + ".tar"
+        downloadFile(url, tar_file, threads=threads, chunk_size=chunk_size,
+                     md5=md5, retries=retries, timeout=timeout)
+        with tarfile.open(tar_file) as tar:
+            written = extractMembers(tar, members, sort=True)
+        os.unlink(tar_file)
+        os.unlink(tar_file + ".md5")
+        return written
+
+    source = _HashingReader(_retry(lambda: openRange(url, 0, None, timeout),
+                                   retries, "download of %s" % url))
+    try:
+        with tarfile.open(fileobj=source, mode="r|*") as tar:
+            written = extractMembers(tar, members, sort=False)
+        # read any padding at the end so the checksum covers the file
+        while source.read(BLOCK_SIZE):
+            pass
+    finally:
+        source.source.close()
+
+    checksum = source.digest.hexdigest()
+    if md5 is not None and checksum != md5.lower():
+        for _, outfile in members:
+            for suffix in ("", ".md5", ".members"):
+                os.unlink(outfile + suffix)
+        raise ValueError("md5 checksum of %s is %s, expected %s" % (
+            url, checksum, md5))
+
+    return written
+
+
+def readChecksums(infile):
+    '''read a table of file name and md5 checksum, e.g as written by
+    ``md5sum``'''
+
+    checksums = {}
+    with IOTools.openFile(infile, "r") as inf:
+        for line in inf:
+            if line.startswith("#") or not line.strip():
+                continue
+            checksum, name = line.split()[:2]
+            checksums[os.path.basename(name.lstrip("*"))] = checksum
+    return checksums
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--url", dest="url", type="string",
+                      help="HTTP(S) or FTP url to download [%default]")
+
+    parser.add_option("--outfile", dest="outfile", type="string",
+                      help="output file. For tar archives, where the "
+                      "archive is downloaded to [%default]")
+
+    parser.add_option("--member", dest="members", type="string",
+                      action="append",
+                      help="PATTERN:OUTFILE. Append the members of the tar "
+                      "archive matching PATTERN to OUTFILE. May be given "
+                      "more than once [%default]")
+
+    parser.add_option("--stream", dest="stream", action="store_true",
+                      help="read the tar members directly from the "
+                      "download, without writing the archive to disk "
+                      "[%default]")
+
+    parser.add_option("--md5", dest="md5", type="string",
+                      help="expected md5 checksum [%default]")
+
+    parser.add_option("--checksums", dest="checksums", type="string",
+                      help="table of file names and md5 checksums, used "
+                      "if --md5 is not given [%default]")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="number of parallel connections [%default]")
+
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="size of the chunks fetched in parallel "
+                      "[%default]")
+
+    parser.add_option("--retries", dest="retries", type="int",
+                      help="number of retries for failed requests "
+                      "[%default]")
+
+    parser.set_defaults(
+        url=None,
+        outfile=None,
+        members=[],
+        stream=False,
+        md5=None,
+        checksums=None,
+        threads=4,
+        chunk_size=2 ** 26,
+        retries=3,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.url is None:
+        raise ValueError("--url is required")
+
+    if options.md5 is None and options.checksums:
+        name = os.path.basename(urllib.parse.urlparse(options.url).path)
+        options.md5 = readChecksums(options.checksums).get(name)
+        if options.md5 is None:
+            E.warn("no checksum for %s in %s" % (name, options.checksums))
+
+    if options.members:
+        members = []
+        for member in options.members:
+            pattern, _, outfile = member.rpartition(":")
+            if not pattern:
+                raise ValueError("--member should be PATTERN:OUTFILE: %s" %
+                                 member)
+            members.append((pattern, outfile))
+
+        written = downloadTarMembers(
+            options.url, members, tar_file=options.outfile,
+            stream=options.stream, md5=options.md5,
+            threads=options.threads, chunk_size=options.chunk_size,
+            retries=options.retries)
+
+        for (pattern, outfile), names in zip(members, written):
+            E.info("%s: %s" % (outfile, ", ".join(names)))
+
+    else:
+        if options.outfile is None:
+            raise ValueError("--outfile is required")
+
+        checksum = downloadFile(
+            options.url, options.outfile, threads=options.threads,
+            chunk_size=options.chunk_size, md5=options.md5,
+            retries=options.retries)
+
+        E.info("%s md5: %s" % (options.outfile, checksum))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,669 @@
+'''
+extract_barcodes.py - count cell barcodes and UMIs from read 1 in parallel
+===========================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Count the reads and unique UMIs per cell barcode from a (gzipped)
+read 1 fastq. This replaces the single process
+``umi_methods.fastqIterate`` / ``ReadExtractor.getBarcodes`` loops in
+the Check_knee_with_umis and Find_the_ambient notebooks.
+
+The fastq is decompressed (with ``pigz`` if available) and split into
+blocks of whole records. The blocks are passed to a pool of worker
+processes through a bounded queue, so memory use does not depend on
+the size of the input. Each worker extracts the barcodes with the
+same ``string`` or ``regex`` barcode patterns as ``umi_tools``
+(e.g as used in ``MakeDropSeqWhitelist`` and ``MakeInDropWhitelist``)
+and accumulates the counts in :mod:`barcode_codec` count tables. The
+per-worker tables are merged once all the blocks have been processed.
+An OSError is raised if a worker fails, or if ``pigz`` exits with an
+error (e.g on a truncated file), rather than returning partial counts.
+
+For the ``string`` method, the barcodes are extracted from a block
+with array operations. For the ``regex`` method, each read is matched
+in turn. Cell barcodes of differing lengths (e.g inDrop) are counted
+separately by length.
+
+With `cache_dir`, the counts are saved to and re-used from a cache
+file keyed on the input fastq, barcode pattern, extract method and
+number of reads, so re-running the whitelisting, or sweeping its
+parameters, does not re-read the fastq. The fastq is identified by
+the md5 checksum written alongside it by download.py where available.
+Otherwise, with `hash_file`, it is identified by its content hash as
+recorded by task_cache.py, which is kept when the fastq is zapped once
+it has been extracted. Failing both, it is identified by its size and
+checksums of its first and last blocks.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python extract_barcodes.py --fastq=raw/sample.fastq.1.gz
+   --bc-pattern=CCCCCCCCCCCCCCCCNNNNNNNNNN --extract-method=string
+   --subset-reads=50000000 --threads=16 --cache-dir=barcode_counts.dir
+   -S sample_counts.tsv
+
+The output is a tab-separated table of cell barcode, reads and unique
+UMIs, in descending order of reads.
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import hashlib
+import multiprocessing
+import os
+import queue as queue_module
+import shutil
+import signal
+import subprocess
+import sys
+import traceback
+
+import numpy as np
+import regex
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+import barcode_codec
+import file_hashes
+
+
+class BarcodePattern(object):
+    '''the cell barcode and UMI positions in read 1, using the
+    ``umi_tools`` ``string`` and ``regex`` barcode pattern syntax'''
+
+    def __init__(self, pattern, method="string"):
+
+        self.pattern = pattern
+        self.method = method
+
+        if method == "string":
+            if set(pattern).difference("CNX"):
+                raise ValueError(
+                    "string barcode patterns may only contain C, N & X: %s" %
+                    pattern)
+            self.cell_positions = np.array(
+                [ix for ix, x in enumerate(pattern) if x == "C"])
+            self.umi_positions = np.array(
+                [ix for ix, x in enumerate(pattern) if x == "N"])
+            if len(self.umi_positions) == 0:
+                raise ValueError("barcode pattern does not contain a UMI")
+
+        elif method == "regex":
+            self.regex = regex.compile(pattern)
+            groups = self.regex.groupindex
+            self.cell_groups = sorted(
+                x for x in groups if x.startswith("cell_"))
+            self.umi_groups = sorted(
+                x for x in groups if x.startswith("umi_"))
+            if not self.umi_groups:
+                raise ValueError("barcode pattern does not contain a UMI")
+
+        else:
+            raise ValueError("unknown extract method: %s" % method)
+
+    def __getstate__(self):
+        # compiled regexes are re-compiled in the worker processes
+        state = self.__dict__.copy()
+        state.pop("regex", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.method == "regex":
+            self.regex = regex.compile(self.pattern)
+
+    def extract(self, seqs):
+        '''extract the barcodes from a list of read sequences (bytes).
+
+        Returns a dictionary mapping cell barcode length to aligned
+        arrays of cell barcode and UMI codes. Reads which don't match
+        the pattern or contain characters other than ACGTN in the
+        barcodes are skipped.
+        '''
+
+        if self.method == "string":
+            return self._extractString(seqs)
+        else:
+            return self._extractRegex(seqs)
+
+    def _extractString(self, seqs):
+
+        length = len(self.pattern)
+        seqs = [x[:length] for x in seqs if len(x) >= length]
+
+        if not seqs:
+            return {}
+
+        chars = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(
+            len(seqs), length)
+        cells, cells_valid = barcode_codec.encodeChars(
+            chars[:, self.cell_positions])
+        umis, umis_valid = barcode_codec.encodeChars(
+            chars[:, self.umi_positions])
+        valid = cells_valid & umis_valid
+
+        return {len(self.cell_positions): (cells[valid], umis[valid])}
+
+    def _extractRegex(self, seqs):
+
+        barcodes = collections.defaultdict(lambda: ([], []))
+
+        for seq in seqs:
+            match = self.regex.match(seq.decode("ascii", "replace"))
+            if match is None:
+                continue
+            cell = "".join(match.group(x) for x in self.cell_groups)
+            umi = "".join(match.group(x) for x in self.umi_groups)
+            cells, umis = barcodes[len(cell)]
+            cells.append(cell)
+            umis.append(umi)
+
+        extracted = {}
+        for length, (cells, umis) in barcodes.items():
+            cells, cells_valid = barcode_codec.encode(cells, length)
+            umis, umis_valid = barcode_codec.encode(umis)
+            valid = cells_valid & umis_valid
+            extracted[length] = (cells[valid], umis[valid])
+
+        return extracted
+
+
+class BarcodeCounts(object):
+    '''reads and unique UMIs per cell barcode, with separate count
+    tables for each cell barcode length'''
+
+    def __init__(self):
+        self.tables = {}
+        self.input_reads = 0
+        self.extracted_reads = 0
+
+    def _table(self, length):
+        if length not in self.tables:
+            self.tables[length] = barcode_codec.PairCountTable(
+                dtype1=barcode_codec.codeDtype(length))
+        return self.tables[length]
+
+    def update(self, extracted, input_reads):
+        '''add the output of :meth:`BarcodePattern.extract`'''
+
+        self.input_reads += input_reads
+        for length, (cells, umis) in extracted.items():
+            self._table(length).update(cells, umis)
+            self.extracted_reads += len(cells)
+
+    def merge(self, other):
+        '''add the counts from another BarcodeCounts'''
+
+        self.input_reads += other.input_reads
+        self.extracted_reads += other.extracted_reads
+        for length, table in other.tables.items():
+            self._table(length).merge(table)
+
+    def save(self, outfile):
+        '''save the counts to a ``.npz`` file'''
+
+        arrays = {"input_reads": np.array(self.input_reads),
+                  "extracted_reads": np.array(self.extracted_reads)}
+        for length, table in self.tables.items():
+            (keys1, keys2), counts = table.keys, table.counts
+            arrays["cells_%i" % length] = keys1
+            arrays["umis_%i" % length] = keys2
+            arrays["counts_%i" % length] = counts
+
+        # write to a temporary file first so a failed write can't
+        # leave a truncated cache file
+        tmpfile = outfile + ".tmp.npz"
+        np.savez(tmpfile, **arrays)
+        os.replace(tmpfile, outfile)
+
+    @classmethod
+    def load(cls, infile):
+        '''load counts saved with :meth:`save`'''
+
+        counts = cls()
+        with np.load(infile) as npz:
+            counts.input_reads = int(npz["input_reads"])
+            counts.extracted_reads = int(npz["extracted_reads"])
+            for name in npz.files:
+                if name.startswith("cells_"):
+                    length = int(name[len("cells_"):])
+                    counts._table(length).update(
+                        npz[name], npz["umis_%i" % length],
+                        npz["counts_%i" % length])
+        return counts
+
+    def iterateCounts(self):
+        '''iterate over (cell barcode, reads, unique UMIs) in descending
+        order of reads'''
+
+        cells = []
+        reads = []
+        umis = []
+        for length, table in sorted(self.tables.items()):
+            keys, read_counts = table.totals()
+            _, umi_counts = table.uniqueCounts()
+            cells.extend(barcode_codec.decode(keys, length))
+            reads.append(read_counts)
+            umis.append(umi_counts)
+
+        if not cells:
+            return
+
+        reads = np.concatenate(reads)
+        umis = np.concatenate(umis)
+
+        for ix in np.argsort(-reads, kind="mergesort"):
+            yield cells[ix], reads[ix], umis[ix]
+
+
+class _PigzFile(object):
+    '''read a gzipped file decompressed by a ``pigz`` process. Closing
+    the file raises an OSError if pigz failed, e.g on a truncated or
+    corrupt file'''
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.proc = subprocess.Popen(["pigz", "-dc", infile],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     bufsize=2 ** 20)
+        self.at_end = False
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data:
+            self.at_end = True
+        return data
+
+    def close(self):
+        if self.proc.stdout.closed:
+            return
+
+        self.proc.stdout.close()
+        stderr = self.proc.stderr.read().decode("utf-8", "replace")
+        self.proc.stderr.close()
+        returncode = self.proc.wait()
+
+        # pigz is killed by SIGPIPE if the file is closed before the
+        # end, e.g with subset_reads
+        if returncode == -signal.SIGPIPE and not self.at_end:
+            return
+
+        if returncode != 0:
+            raise OSError("pigz failed to decompress %s (exit code %i): %s" %
+                          (self.infile, returncode, stderr.strip()))
+
+
+def openFastq(infile):
+    '''open a fastq for reading as bytes, decompressing gzipped files
+    in a separate ``pigz`` process where available'''
+
+    if infile.endswith(".gz") and shutil.which("pigz"):
+        return _PigzFile(infile)
+
+    return IOTools.openFile(infile, "rb")
+
+
+def iterateBlocks(infile, block_size=2 ** 24, subset_reads=None):
+    '''iterate over `infile`, yielding (block, number of reads) where
+    each block is approximately `block_size` bytes of whole fastq
+    records. Stop after `subset_reads` reads, if set.'''
+
+    remainder = b""
+    total = 0
+
+    while True:
+        data = infile.read(block_size)
+        block = remainder + data
+
+        if not data:
+            if not block.strip():
+                break
+            if not block.endswith(b"\n"):
+                block += b"\n"
+            if block.count(b"\n") % 4 != 0:
+                raise ValueError("fastq ends with an incomplete record")
+
+        n_lines = block.count(b"\n")
+        if n_lines < 4:
+            remainder = block
+            continue
+
+        # cut the block after the last complete (4 line) record
+        end = len(block)
+        for ix in range(n_lines % 4 + 1):
+            end = block.rfind(b"\n", 0, end)
+        end += 1
+
+        block, remainder = block[:end], block[end:]
+        n_reads = n_lines // 4
+
+        if subset_reads and total + n_reads >= subset_reads:
+            n_reads = subset_reads - total
+            end = -1
+            for ix in range(n_reads * 4):
+                end = block.find(b"\n", end + 1)
+            yield block[:end + 1], n_reads
+            break
+
+        total += n_reads
+        yield block, n_reads
+
+        if not data:
+            break
+
+
+def _worker(pattern, queue, results):
+    '''extract and count the barcodes for blocks from `queue` until a
+    None is received, then put the counts on `results`. If the
+    extraction fails, the traceback is put on `results` instead'''
+
+    try:
+        counts = BarcodeCounts()
+
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            block, n_reads = item
+            seqs = block.split(b"\n")[1::4]
+            counts.update(pattern.extract(seqs), n_reads)
+
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+
+    results.put(counts)
+
+
+def _checkWorkers(workers, results, collected, timeout=0):
+    '''add the counts put on `results` by the `workers` to `collected`,
+    waiting up to `timeout` seconds for the first. Raises an OSError if
+    a worker has put a traceback on `results` or has died without
+    putting its counts there'''
+
+    # taken before the results are read, as a worker exits after its
+    # counts are put on results
+    exitcodes = [worker.exitcode for worker in workers]
+
+    while True:
+        try:
+            result = results.get(timeout=timeout)
+        except queue_module.Empty:
+            break
+        timeout = 0
+        if isinstance(result, str):
+            raise OSError("barcode extraction worker failed:\n%s" % result)
+        collected.append(result)
+
+    for exitcode in exitcodes:
+        if exitcode not in (None, 0):
+            raise OSError("barcode extraction worker failed with exit "
+                          "code %i" % exitcode)
+
+    if len(collected) < exitcodes.count(0):
+        raise OSError("barcode extraction worker exited without its "
+                      "counts")
+
+
+def countBarcodes(infile, pattern, threads=1, subset_reads=None,
+                  block_size=2 ** 24, poll=1):
+    '''count the reads and unique UMIs per cell barcode in the fastq
+    `infile` using the :class:`BarcodePattern` `pattern`.
+
+    With more than one thread, the workers are checked every `poll`
+    seconds while waiting on them, and an OSError is raised if one has
+    failed.
+
+    Returns a :class:`BarcodeCounts`.
+    '''
+
+    if threads <= 1:
+        inf = openFastq(infile)
+        counts = BarcodeCounts()
+        try:
+            for block, n_reads in iterateBlocks(inf, block_size,
+                                                subset_reads):
+                counts.update(pattern.extract(block.split(b"\n")[1::4]),
+                              n_reads)
+        finally:
+            inf.close()
+        return counts
+
+    # bound the blocks in flight so the reader can't outrun the workers
+    blocks = multiprocessing.Queue(maxsize=2 * threads)
+    results = multiprocessing.Queue()
+
+    workers = [multiprocessing.Process(
+        target=_worker, args=(pattern, blocks, results))
+        for x in range(threads)]
+
+    for worker in workers:
+        worker.start()
+
+    # opened once the workers are forked so they don't hold the pigz
+    # pipe open
+    inf = openFastq(infile)
+
+    # the queues are polled so that a failed worker is noticed rather
+    # than waited on
+    collected = []
+
+    def put(item):
+        while True:
+            try:
+                blocks.put(item, timeout=poll)
+                return
+            except queue_module.Full:
+                _checkWorkers(workers, results, collected)
+                if not any(worker.is_alive() for worker in workers):
+                    raise OSError("no barcode extraction workers left")
+
+    try:
+        n_blocks = 0
+        for block, n_reads in iterateBlocks(inf, block_size, subset_reads):
+            put((block, n_reads))
+            n_blocks += 1
+            if n_blocks % 100 == 0:
+                E.debug("queued %i blocks" % n_blocks)
+
+        inf.close()
+
+        for worker in workers:
+            put(None)
+
+        while len(collected) < len(workers):
+            _checkWorkers(workers, results, collected, timeout=poll)
+
+        for worker in workers:
+            worker.join()
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        # the blocks left on the queue can't be sent once the workers
+        # have gone
+        blocks.cancel_join_thread()
+        inf.close()
+
+    counts = BarcodeCounts()
+    for result in collected:
+        counts.merge(result)
+
+    return counts
+
+
+def fileFingerprint(infile, block_size=2 ** 24, hash_file=None):
+    '''identify the contents of `infile`: the md5 checksum from
+    ``<infile>.md5`` if present, otherwise its content hash from the
+    task_cache.py `hash_file`, if given, otherwise the size and md5
+    checksums of the first and last `block_size` bytes'''
+
+    if os.path.exists(infile + ".md5"):
+        with open(infile + ".md5") as inf:
+            return "md5:" + inf.read().split()[0]
+
+    if hash_file is not None:
+        if not os.path.exists(os.path.dirname(os.path.abspath(hash_file))):
+            os.makedirs(os.path.dirname(os.path.abspath(hash_file)))
+        return file_hashes.FileHashes(hash_file).get(infile)
+
+    size = os.path.getsize(infile)
+    digest = hashlib.md5()
+    with open(infile, "rb") as inf:
+        digest.update(inf.read(block_size))
+        if size > block_size:
+            inf.seek(max(block_size, size - block_size))
+            digest.update(inf.read(block_size))
+
+    return "size:%i:%s" % (size, digest.hexdigest())
+
+
+def cacheFile(cache_dir, infile, pattern, subset_reads=None,
+              hash_file=None):
+    '''return the cache file for the counts from `infile` with the
+    :class:`BarcodePattern` `pattern` and `subset_reads`'''
+
+    key = "\t".join((fileFingerprint(infile, hash_file=hash_file),
+                     pattern.pattern,
+                     pattern.method, str(subset_reads or "all")))
+    name = os.path.basename(infile)
+    for suffix in (".gz", ".fastq.1", ".fastq"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    return os.path.join(cache_dir, "%s_%s.npz" % (
+        name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def countBarcodesCached(infile, pattern, cache_dir, threads=1,
+                        subset_reads=None, block_size=2 ** 24,
+                        hash_file=None):
+    '''as :func:`countBarcodes`, but re-use the counts from
+    `cache_dir` if they have been made before. `hash_file` is a
+    task_cache.py hash file to identify `infile` by, see
+    :func:`fileFingerprint`'''
+
+    cache = cacheFile(cache_dir, infile, pattern, subset_reads,
+                      hash_file=hash_file)
+
+    if os.path.exists(cache):
+        E.info("using cached counts: %s" % cache)
+        return BarcodeCounts.load(cache)
+
+    counts = countBarcodes(infile, pattern, threads=threads,
+                           subset_reads=subset_reads, block_size=block_size)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    counts.save(cache)
+    E.info("cached counts: %s" % cache)
+
+    return counts
+
+
+def writeCounts(counts, outfile):
+    '''write the (cell barcode, reads, unique UMIs) table'''
+
+    outfile.write("cell\treads\tunique_umis\n")
+    for cell, reads, umis in counts.iterateCounts():
+        outfile.write("%s\t%i\t%i\n" % (cell, reads, umis))
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-i", "--fastq", dest="fastq", type="string",
+                      help="read 1 fastq [%default]")
+
+    parser.add_option("-p", "--bc-pattern", dest="pattern", type="string",
+                      help="barcode pattern [%default]")
+
+    parser.add_option("--extract-method", dest="extract_method",
+                      type="choice", choices=("string", "regex"),
+                      help="how to extract the barcodes [%default]")
+
+    parser.add_option("--subset-reads", dest="subset_reads", type="int",
+                      help="only use the first N reads [%default]")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="number of worker processes [%default]")
+
+    parser.add_option("--block-size", dest="block_size", type="int",
+                      help="size of the fastq blocks passed to the "
+                      "workers, in bytes [%default]")
+
+    parser.add_option("--cache-dir", dest="cache_dir", type="string",
+                      help="directory to cache the counts in [%default]")
+
+    parser.add_option("--hash-file", dest="hash_file", type="string",
+                      help="task_cache.py file hashes to identify the "
+                      "fastq by, if it has no .md5 file [%default]")
+
+    parser.set_defaults(
+        fastq=None,
+        pattern=None,
+        extract_method="string",
+        subset_reads=None,
+        threads=os.cpu_count() or 1,
+        block_size=2 ** 24,
+        cache_dir=None,
+        hash_file=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.fastq is None and len(args) == 1:
+        options.fastq = args[0]
+
+    if not options.fastq or not options.pattern:
+        raise ValueError("a fastq and --bc-pattern are required")
+
+    pattern = BarcodePattern(options.pattern, options.extract_method)
+
+    if options.cache_dir:
+        counts = countBarcodesCached(options.fastq, pattern,
+                                     options.cache_dir,
+                                     threads=options.threads,
+                                     subset_reads=options.subset_reads,
+                                     block_size=options.block_size,
+                                     hash_file=options.hash_file)
+    else:
+        counts = countBarcodes(options.fastq, pattern,
+                               threads=options.threads,
+                               subset_reads=options.subset_reads,
+                               block_size=options.block_size)
+
+    writeCounts(counts, options.stdout)
+
+    E.info("Input reads: %i, reads with barcodes: %i" % (
+        counts.input_reads, counts.extracted_reads))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
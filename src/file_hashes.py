@@ -0,0 +1,114 @@
+'''
+file_hashes.py - content hashes of files, cached by path and mtime
+===================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Content hash files, caching the hashes in a tab separated file by
+path, size and modification time so a file is only read again when it
+changes. A file with a ``<file>.md5`` checksum newer than itself (see
+download.py) isn't read at all. Files zapped with
+:meth:`FileHashes.zap` keep the hash of their content before they
+were zapped.
+
+This is the hash file used by task_cache.py, kept apart from it so
+that scripts can read the hashes without ruffus installed.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import file_hashes
+
+   hashes = file_hashes.FileHashes("task_cache.dir/file_hashes.tsv")
+   digest = hashes.get("raw/sample.fastq.1.gz")
+
+'''
+
+import hashlib
+import os
+
+import CGAT.IOTools as IOTools
+
+
+def _stat(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FileHashes(object):
+    '''content hashes of files, cached by path, size and modification
+    time in a tab separated file'''
+
+    def __init__(self, hash_file):
+        self.hash_file = hash_file
+        self.hashes = {}
+        if os.path.exists(hash_file):
+            with open(hash_file) as inf:
+                for line in inf:
+                    path, size, mtime_ns, digest, zapped = line.rstrip(
+                        "\n").split("\t")
+                    self.hashes[path] = (int(size), int(mtime_ns), digest,
+                                         zapped == "1")
+
+    def _add(self, path, size, mtime_ns, digest, zapped=False):
+        self.hashes[path] = (size, mtime_ns, digest, zapped)
+        # jobs run in separate processes, so append each hash as it's
+        # made rather than rewriting the file
+        with open(self.hash_file, "a") as outf:
+            outf.write("%s\t%i\t%i\t%s\t%i\n" % (
+                path, size, mtime_ns, digest, zapped))
+
+    @staticmethod
+    def _hashContent(filename, block_size=2 ** 24):
+        checksum_file = filename + ".md5"
+        if (os.path.exists(checksum_file) and
+                os.stat(checksum_file).st_mtime_ns >=
+                os.stat(filename).st_mtime_ns):
+            with open(checksum_file) as inf:
+                return "md5:" + inf.read().split()[0]
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filename, "rb") as inf:
+            for block in iter(lambda: inf.read(block_size), b""):
+                digest.update(block)
+        return "blake2b:" + digest.hexdigest()
+
+    def get(self, filename):
+        '''return the content hash of `filename`'''
+
+        path = os.path.abspath(filename)
+        if os.path.isdir(path):
+            return "directory"
+
+        size, mtime_ns = _stat(path)
+        if path in self.hashes:
+            recorded_size, recorded_mtime_ns, digest, zapped = \
+                self.hashes[path]
+            if (recorded_size, recorded_mtime_ns) == (size, mtime_ns):
+                return digest
+            # a zapped file which has been touched is still the same file
+            if zapped and size == 0:
+                self._add(path, size, mtime_ns, digest, zapped)
+                return digest
+
+        digest = self._hashContent(path)
+        self._add(path, size, mtime_ns, digest)
+        return digest
+
+    def zap(self, filename):
+        '''zap `filename` (see IOTools.zapFile), recording the hash of
+        its content before it was zapped'''
+
+        digest = self.get(filename)
+        IOTools.zapFile(filename)
+        size, mtime_ns = _stat(filename)
+        self._add(os.path.abspath(filename), size, mtime_ns, digest,
+                  zapped=True)
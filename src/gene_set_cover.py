@@ -0,0 +1,205 @@
+'''
+gene_set_cover.py - minimal set of genes explaining the multimapped reads
+=========================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Greedily select a minimal set of genes which together account for
+all the gene assigned reads in a BAM, where reads may be assigned to
+more than one gene (``featureCounts -M``). At each step the gene
+covering the most reads not yet covered is selected, with ties broken
+by the order in which the genes are first seen in the BAM. This gives
+the same ``keep_genes`` as the group_deduping notebook.
+
+The notebook rescans every gene for the maximum and rebuilds every
+gene's set of reads on each iteration. Here, the reads are mapped to
+integer ids and the reads for each gene are held in compressed sparse
+row arrays, with a boolean array flagging the covered reads. The
+genes are held in a max-heap keyed on their coverage. As coverage only
+ever falls, the coverage in the heap is an upper bound, so it only
+needs updating for the gene at the top of the heap (lazy updates): if
+the updated coverage is unchanged, that gene is the next to select.
+
+The reads are identified by the read name without the
+instrument/run/flowcell fields, as per the notebook. The read ids are
+hashed to 64-bit keys with ``blake2b`` rather than held in a
+dictionary so memory use remains modest for the larger samples.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python gene_set_cover.py --bamfile=mapped/sample_hg_mm_grouped.bam
+   -S mapped/sample_hg_mm_set_cover_genes.tsv
+
+The output is a table of the selected genes in the order selected
+with the number of reads each newly covers and the cumulative number
+of reads covered.
+
+Command line options
+--------------------
+
+'''
+
+import array
+import hashlib
+import heapq
+import sys
+
+import numpy as np
+import pysam
+
+import CGAT.Experiment as E
+
+
+def _readKey(read_name):
+    '''64-bit key for the read id (without the cell barcode and UMI
+    and the first three fields)'''
+
+    read_id = read_name.split("_")[0]
+    short_read_id = ":".join(read_id.split(":")[3:])
+    return int.from_bytes(
+        hashlib.blake2b(short_read_id.encode(), digest_size=8).digest(),
+        "little", signed=True)
+
+
+def readGeneAssignments(inbam, gene_tag="XT"):
+    '''read the gene assignments from `inbam`.
+
+    Returns the genes, in the order first seen, and CSR arrays
+    (indptr, indices) of the integer ids of the reads assigned to each
+    gene, along with the number of reads.
+    '''
+
+    gene2id = {}
+    gene_ids = array.array("q")
+    read_keys = array.array("q")
+
+    for read in inbam.fetch(until_eof=True):
+
+        if not read.has_tag(gene_tag):
+            continue
+
+        gene = read.get_tag(gene_tag)
+        gene_id = gene2id.get(gene)
+        if gene_id is None:
+            gene_id = gene2id[gene] = len(gene2id)
+
+        gene_ids.append(gene_id)
+        read_keys.append(_readKey(read.query_name))
+
+    genes = [None] * len(gene2id)
+    for gene, gene_id in gene2id.items():
+        genes[gene_id] = gene
+
+    gene_ids = np.frombuffer(gene_ids, dtype=np.int64)
+    read_keys = np.frombuffer(read_keys, dtype=np.int64)
+
+    unique_keys, read_ids = np.unique(read_keys, return_inverse=True)
+
+    # the unique (gene, read) pairs, sorted by gene
+    pairs = np.unique(gene_ids * len(unique_keys) + read_ids.ravel())
+    pair_genes = pairs // max(len(unique_keys), 1)
+    indices = (pairs % max(len(unique_keys), 1)).astype(np.int64)
+
+    indptr = np.zeros(len(genes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(pair_genes, minlength=len(genes)))
+
+    return genes, indptr, indices, len(unique_keys)
+
+
+def greedySetCover(indptr, indices, n_reads):
+    '''greedily select the genes covering all `n_reads` reads, given CSR
+    arrays of the reads for each gene.
+
+    Returns a list of (gene index, reads newly covered) in the order
+    selected. Ties in coverage go to the lowest gene index.
+    '''
+
+    covered = np.zeros(n_reads, dtype=bool)
+    n_covered = 0
+    selected = []
+
+    coverage = np.diff(indptr)
+    heap = [(-int(count), gene) for gene, count in enumerate(coverage)
+            if count > 0]
+    heapq.heapify(heap)
+
+    while heap and n_covered < n_reads:
+        count, gene = heapq.heappop(heap)
+        reads = indices[indptr[gene]:indptr[gene + 1]]
+        uncovered = reads[~covered[reads]]
+
+        if len(uncovered) < -count:
+            # stale coverage, re-queue with the current coverage
+            if len(uncovered):
+                heapq.heappush(heap, (-len(uncovered), gene))
+            continue
+
+        covered[uncovered] = True
+        n_covered += len(uncovered)
+        selected.append((gene, len(uncovered)))
+
+        if len(selected) % 1000 == 0:
+            E.debug("selected %i genes, %i/%i reads covered" % (
+                len(selected), n_covered, n_reads))
+
+    return selected
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="gene tagged BAM [%default]")
+
+    parser.add_option("--gene-tag", dest="gene_tag", type="string",
+                      help="tag holding the gene assignment [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        gene_tag="XT",
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.bamfile is None:
+        raise ValueError("--bamfile is required")
+
+    inbam = pysam.AlignmentFile(options.bamfile)
+    genes, indptr, indices, n_reads = readGeneAssignments(
+        inbam, options.gene_tag)
+    inbam.close()
+
+    E.info("%i reads assigned to %i genes" % (n_reads, len(genes)))
+
+    selected = greedySetCover(indptr, indices, n_reads)
+
+    options.stdout.write("gene\treads\tcumulative_reads\n")
+    total = 0
+    for gene, count in selected:
+        total += count
+        options.stdout.write("%s\t%i\t%i\n" % (genes[gene], count, total))
+
+    E.info("%i genes selected to cover %i reads" % (len(selected), total))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,331 @@
+'''
+gene_tagger.py - tag the reads in a BAM with the gene they overlap
+===================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Tag each read in a BAM with the gene it is assigned to, as per
+``featureCounts -M -R BAM``, but writing the reads in their input
+order. A coordinate sorted (and indexed) input therefore gives a
+coordinate sorted and indexed output which can be passed straight to
+``umi_tools group/dedup`` without sorting it again.
+
+The exons are loaded from a GTF into a sorted array of starts per
+contig, with an aligned array of the running maximum of the ends. The
+exons which may overlap an aligned block are then those between two
+binary searches, one for the block end in the starts and one for the
+block start in the running maximum ends, which are made for a batch
+of reads at once.
+
+As per featureCounts defaults, a read is assigned to a gene if any of
+its aligned blocks overlaps an exon of that gene by at least one base,
+regardless of strand, and only if it overlaps exactly one gene. All
+alignments of multimapping reads are assigned. The reads are tagged
+with:
+
+XS
+   Assigned, Unassigned_NoFeatures, Unassigned_Ambiguity or
+   Unassigned_Unmapped
+XN
+   the number of genes overlapped
+XT
+   the gene, for assigned reads
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python gene_tagger.py --bamfile=mapped/sample.bam
+   --geneset=references.dir/hg38_geneset_coding_exons.gtf.gz
+   --output-bam=mapped/sample.bam.featureCounts.bam
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import sys
+
+import numpy as np
+import pysam
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+ASSIGNED = "Assigned"
+NO_FEATURES = "Unassigned_NoFeatures"
+AMBIGUOUS = "Unassigned_Ambiguity"
+UNMAPPED = "Unassigned_Unmapped"
+
+
+def _parseAttribute(attributes, attribute):
+    '''return the value of `attribute` from a GTF attributes field'''
+
+    for field in attributes.split(";"):
+        key, _, value = field.strip().partition(" ")
+        if key == attribute:
+            return value.strip('"')
+    return None
+
+
+class GeneIndex(object):
+    '''the exons of each gene, indexed by contig for overlap queries'''
+
+    def __init__(self, exons, genes):
+        '''`exons` is a dict of contig to lists of (start, end, gene
+        index), with 0-based half open coordinates and `genes` the
+        list of gene names'''
+
+        self.genes = genes
+        self.contigs = {}
+
+        for contig, intervals in exons.items():
+            intervals = np.array(intervals, dtype=np.int64).reshape(-1, 3)
+            intervals = intervals[np.argsort(intervals[:, 0],
+                                             kind="mergesort")]
+            starts, ends, gene_ix = intervals.T
+            self.contigs[contig] = (starts.copy(), ends.copy(),
+                                    np.maximum.accumulate(ends),
+                                    gene_ix.astype(np.int32))
+
+    @classmethod
+    def fromGTF(cls, infile, feature="exon", attribute="gene_id"):
+        '''build the index from the `feature` records of a GTF, grouped
+        by `attribute`'''
+
+        gene2index = {}
+        exons = collections.defaultdict(list)
+
+        with IOTools.openFile(infile, "r") as inf:
+            for line in inf:
+                if line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 9 or fields[2] != feature:
+                    continue
+                gene = _parseAttribute(fields[8], attribute)
+                if gene is None:
+                    continue
+                if gene not in gene2index:
+                    gene2index[gene] = len(gene2index)
+                exons[fields[0]].append(
+                    (int(fields[3]) - 1, int(fields[4]), gene2index[gene]))
+
+        if not exons:
+            raise ValueError("no %s records with a %s in %s" % (
+                feature, attribute, infile))
+
+        genes = sorted(gene2index, key=gene2index.get)
+
+        return cls(exons, genes)
+
+    def overlaps(self, contig, starts, ends):
+        '''find the genes overlapping the intervals `starts`-`ends` on
+        `contig`.
+
+        Returns aligned arrays of the interval and gene indices for
+        each overlap (an interval may overlap several exons of the
+        same gene).
+        '''
+
+        empty = np.zeros(0, dtype=np.int64)
+        if contig not in self.contigs or len(starts) == 0:
+            return empty, empty
+
+        exon_starts, exon_ends, max_ends, gene_ix = self.contigs[contig]
+
+        # exons before `lo` end before the interval start, exons from
+        # `hi` on start after the interval end
+        lo = np.searchsorted(max_ends, starts, side="right")
+        hi = np.searchsorted(exon_starts, ends, side="left")
+        n = np.maximum(hi - lo, 0)
+
+        interval_ix = np.repeat(np.arange(len(starts)), n)
+        exon_ix = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) +
+                   np.repeat(lo, n))
+
+        keep = exon_ends[exon_ix] > starts[interval_ix]
+
+        return interval_ix[keep], gene_ix[exon_ix[keep]]
+
+
+class GeneTagger(object):
+    '''tag batches of reads with the gene they are assigned to'''
+
+    def __init__(self, index):
+        self.index = index
+        self.counts = collections.Counter()
+
+    def assign(self, reads):
+        '''return the number of genes overlapped by each read and the
+        gene index for the reads overlapping one gene'''
+
+        n_genes = len(self.index.genes)
+
+        read_ix = []
+        contigs = []
+        starts = []
+        ends = []
+        for ix, read in enumerate(reads):
+            if read.is_unmapped:
+                continue
+            for start, end in read.get_blocks():
+                read_ix.append(ix)
+                contigs.append(read.reference_name)
+                starts.append(start)
+                ends.append(end)
+
+        read_ix = np.array(read_ix, dtype=np.int64)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        contigs = np.array(contigs, dtype=object)
+
+        # the reads overlapping each gene, with each pair once
+        keys = []
+        for contig in set(contigs):
+            blocks = np.flatnonzero(contigs == contig)
+            block_ix, gene_ix = self.index.overlaps(
+                contig, starts[blocks], ends[blocks])
+            keys.append(read_ix[blocks[block_ix]] * n_genes + gene_ix)
+
+        if keys:
+            keys = np.unique(np.concatenate(keys))
+        else:
+            keys = np.zeros(0, dtype=np.int64)
+
+        n_overlaps = np.bincount(keys // n_genes, minlength=len(reads))
+        genes = np.full(len(reads), -1, dtype=np.int64)
+        genes[keys // n_genes] = keys % n_genes
+
+        return n_overlaps, genes
+
+    def tag(self, reads):
+        '''tag the `reads` in place'''
+
+        n_overlaps, genes = self.assign(reads)
+
+        for read, n, gene in zip(reads, n_overlaps, genes):
+            if read.is_unmapped:
+                status = UNMAPPED
+            elif n == 0:
+                status = NO_FEATURES
+            elif n == 1:
+                status = ASSIGNED
+                read.set_tag("XT", self.index.genes[gene], "Z")
+            else:
+                status = AMBIGUOUS
+
+            read.set_tag("XS", status, "Z")
+            if not read.is_unmapped:
+                read.set_tag("XN", int(n), "i")
+            self.counts[status] += 1
+
+
+def tagBam(infile, outfile, index, batch_size=100000):
+    '''tag the reads in the BAM `infile` with their genes from the
+    :class:`GeneIndex` `index`, writing them in the same order to
+    `outfile`. If `infile` is coordinate sorted, `outfile` is indexed.
+
+    Returns the counts of the reads by assignment status.
+    '''
+
+    tagger = GeneTagger(index)
+
+    inbam = pysam.AlignmentFile(infile)
+    outbam = pysam.AlignmentFile(outfile, "wb", template=inbam)
+
+    is_sorted = inbam.header.to_dict().get(
+        "HD", {}).get("SO") == "coordinate"
+
+    batch = []
+    for read in inbam.fetch(until_eof=True):
+        batch.append(read)
+        if len(batch) >= batch_size:
+            tagger.tag(batch)
+            for tagged in batch:
+                outbam.write(tagged)
+            batch = []
+
+    if batch:
+        tagger.tag(batch)
+        for tagged in batch:
+            outbam.write(tagged)
+
+    inbam.close()
+    outbam.close()
+
+    if is_sorted:
+        pysam.index(outfile)
+
+    return tagger.counts
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="BAM to tag [%default]")
+
+    parser.add_option("--geneset", dest="geneset", type="string",
+                      help="GTF of the exons [%default]")
+
+    parser.add_option("--output-bam", dest="output_bam", type="string",
+                      help="tagged BAM [%default]")
+
+    parser.add_option("--feature", dest="feature", type="string",
+                      help="GTF feature type to assign the reads to "
+                      "[%default]")
+
+    parser.add_option("--attribute", dest="attribute", type="string",
+                      help="GTF attribute to group the features by "
+                      "[%default]")
+
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      help="number of reads per batch [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        geneset=None,
+        output_bam=None,
+        feature="exon",
+        attribute="gene_id",
+        batch_size=100000,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile or not options.geneset or not options.output_bam:
+        raise ValueError("--bamfile, --geneset and --output-bam are required")
+
+    index = GeneIndex.fromGTF(options.geneset, options.feature,
+                              options.attribute)
+    E.info("loaded %i genes from %s" % (len(index.genes), options.geneset))
+
+    counts = tagBam(options.bamfile, options.output_bam, index,
+                    batch_size=options.batch_size)
+
+    for status in (ASSIGNED, NO_FEATURES, AMBIGUOUS, UNMAPPED):
+        E.info("%s: %i" % (status, counts[status]))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,363 @@
+'''
+job_sizing.py - size cluster jobs from the resources used by past runs
+=======================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Predict the threads, memory and scratch space a pipeline job needs
+from the size of its inputs and the sample (number of cells and
+sequencing saturation), calibrated from the resources used by previous
+jobs of the same kind.
+
+Jobs are monitored while they run (see
+:func:`run_ledger.monitorStatement`) for the peak resident memory of
+their process tree, the peak size of their temporary files and their
+run time. Once a job is done, its usage is appended to a tab separated
+run log along with the input size, sample and threads (see
+:meth:`Job.record`).
+
+For each kind of job in the run log, with at least `min_runs` runs:
+
+memory
+   the least squares fit of the peak memory on the input size (and the
+   number of cells and saturation once there are enough runs to fit
+   them), shifted up by the largest underestimate of a logged run and
+   multiplied by `headroom`
+threads
+   enough threads for the input to be processed in `target_hours` at
+   the median throughput per thread of the logged runs, between
+   `min_threads` and `max_threads`
+scratch
+   the input size times the largest ratio of scratch space to input
+   size of the logged runs, multiplied by `headroom`
+
+Until then the job is given the default resources the pipeline
+configures, so the first runs calibrate the model.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   # the fitted models in the run log
+   python job_sizing.py --run-log=sizing_runs.tsv
+
+   # the resources predicted for a job
+   python job_sizing.py --run-log=sizing_runs.tsv --kind=align_extracted
+   --input-bytes=80000000000 --n-cells=8000 --seq-sat=92.9
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import math
+import os
+import re
+import sys
+
+import numpy as np
+
+import CGAT.Experiment as E
+
+
+Resources = collections.namedtuple(
+    "Resources", ["threads", "memory", "scratch"])
+
+RUN_LOG_COLUMNS = ("kind", "job", "input_bytes", "n_cells", "seq_sat",
+                   "threads", "max_rss", "max_scratch", "wall_seconds")
+
+_MEMORY_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30,
+                 "T": 2 ** 40}
+
+
+def parseMemory(memory):
+    '''return the bytes in a memory string, e.g "3.9G"'''
+
+    match = re.match(r"^([\d.]+)([KMGT]?)B?$", str(memory).upper())
+    if not match:
+        raise ValueError("can't parse the memory %s" % memory)
+
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+
+
+def formatMemory(memory):
+    '''return `memory` bytes as a string for job_memory, rounded up to
+    0.1G'''
+
+    return "%.1fG" % (math.ceil(memory * 10.0 / 2 ** 30) / 10)
+
+
+def _number(value):
+    '''return `value` as a float, or None if it is missing'''
+
+    if value in (None, ""):
+        return None
+    return float(value)
+
+
+##############################################################################
+#  Run log and model
+##############################################################################
+
+class RunLog(object):
+    '''the resources used by past jobs, in a tab separated file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, kind, job, input_bytes, n_cells, seq_sat, threads,
+               usage):
+        '''log a job of `kind` which used `usage` (see
+        :func:`run_ledger.readUsage`)'''
+
+        is_new = not os.path.exists(self.filename)
+        row = (kind, job, input_bytes, n_cells, seq_sat, threads,
+               usage["max_rss"], usage["max_scratch"],
+               usage["wall_seconds"])
+
+        # jobs finish in separate processes, so append a line at a time
+        with open(self.filename, "a") as outf:
+            if is_new:
+                outf.write("\t".join(RUN_LOG_COLUMNS) + "\n")
+            outf.write("\t".join(
+                "" if x is None else str(x) for x in row) + "\n")
+
+    def runs(self):
+        '''return the logged runs of each kind of job'''
+
+        runs = collections.defaultdict(list)
+        if not os.path.exists(self.filename):
+            return runs
+
+        with open(self.filename) as inf:
+            header = next(inf).rstrip("\n").split("\t")
+            for line in inf:
+                if line.startswith("kind\t"):
+                    continue
+                run = dict(zip(header, line.rstrip("\n").split("\t")))
+                for column in RUN_LOG_COLUMNS[2:]:
+                    run[column] = _number(run[column])
+                runs[run["kind"]].append(run)
+
+        return runs
+
+
+class SizingModel(object):
+    '''predict the resources for a job from the logged runs of the same
+    kind of job'''
+
+    def __init__(self, run_log, min_runs=3, headroom=1.25, target_hours=4,
+                 min_threads=1, max_threads=16, max_memory=None):
+        self.run_log = RunLog(run_log)
+        self.min_runs = min_runs
+        self.headroom = headroom
+        self.target_seconds = target_hours * 3600
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.max_memory = max_memory
+        self._runs = None
+
+    @property
+    def runs(self):
+        if self._runs is None:
+            self._runs = self.run_log.runs()
+        return self._runs
+
+    def _features(self, runs, n_cells, seq_sat):
+        '''return the features to fit the memory on: the input size,
+        and the number of cells and saturation when the job and all the
+        runs have them and there are enough runs to fit them'''
+
+        features = ["input_bytes"]
+        for feature, value in (("n_cells", n_cells), ("seq_sat", seq_sat)):
+            if (value is not None and
+                    len(runs) >= 3 * (len(features) + 2) and
+                    all(x[feature] is not None for x in runs)):
+                features.append(feature)
+        return features
+
+    def fitMemory(self, runs, features):
+        '''return the coefficients of the least squares fit of the peak
+        memory on `features` (with an intercept first) and the largest
+        underestimate of the fit'''
+
+        design = np.array([[1.0] + [x[feature] for feature in features]
+                           for x in runs])
+        max_rss = np.array([x["max_rss"] for x in runs])
+
+        coefficients = np.linalg.lstsq(design, max_rss, rcond=None)[0]
+        underestimate = max((max_rss - design.dot(coefficients)).max(), 0)
+
+        return coefficients, underestimate
+
+    def throughput(self, runs):
+        '''return the median input bytes processed per thread second'''
+
+        return np.median([x["input_bytes"] / (x["wall_seconds"] * x["threads"])
+                          for x in runs
+                          if x["wall_seconds"] and x["threads"]] or [0])
+
+    def scratchRatio(self, runs):
+        '''return the largest scratch space per input byte'''
+
+        return max([x["max_scratch"] / x["input_bytes"] for x in runs
+                    if x["input_bytes"] > 0] or [0])
+
+    def predict(self, kind, input_bytes, n_cells=None, seq_sat=None,
+                default=Resources(1, None, None)):
+        '''return the :class:`Resources` for a job of `kind` with
+        `input_bytes` of input, or `default` if there aren't enough
+        logged runs'''
+
+        runs = [x for x in self.runs.get(kind, [])
+                if x["max_rss"] is not None and x["input_bytes"]]
+        if len(runs) < self.min_runs:
+            return default
+
+        features = self._features(runs, n_cells, seq_sat)
+        coefficients, underestimate = self.fitMemory(runs, features)
+        values = dict(input_bytes=input_bytes, n_cells=n_cells,
+                      seq_sat=seq_sat)
+        memory = (coefficients[0] + underestimate +
+                  sum(coefficient * values[feature] for coefficient, feature
+                      in zip(coefficients[1:], features)))
+        # the fit can't be less than the smallest run used
+        memory = max(memory, min(x["max_rss"] for x in runs))
+        memory *= self.headroom
+        if self.max_memory:
+            memory = min(memory, self.max_memory)
+
+        throughput = self.throughput(runs)
+        if throughput > 0:
+            threads = int(math.ceil(
+                input_bytes / (throughput * self.target_seconds)))
+            threads = min(max(threads, self.min_threads), self.max_threads)
+        else:
+            threads = default.threads
+
+        scratch = input_bytes * self.scratchRatio(runs) * self.headroom
+
+        return Resources(threads, int(memory), int(scratch))
+
+
+class Job(object):
+    '''a job of `kind` on `infiles`, sized by a :class:`SizingModel`,
+    whose usage is logged to calibrate the model.
+
+    `name` identifies the job (e.g its output) and `scratch` is a glob
+    of its temporary files, to be monitored.
+    '''
+
+    def __init__(self, model, kind, name, infiles, n_cells=None,
+                 seq_sat=None, default=Resources(1, None, None),
+                 scratch=None):
+        self.model = model
+        self.kind = kind
+        self.name = name
+        self.n_cells = _number(n_cells)
+        self.seq_sat = _number(seq_sat)
+        self.input_bytes = sum(os.path.getsize(x) for x in infiles)
+        self.scratch = scratch
+
+        self.resources = model.predict(kind, self.input_bytes, self.n_cells,
+                                       self.seq_sat, default)
+
+    @property
+    def threads(self):
+        return self.resources.threads
+
+    def jobMemory(self, job_threads, default):
+        '''return the job_memory per thread for a job with `job_threads`
+        threads, or `default` if the memory isn't predicted'''
+
+        if self.resources.memory is None:
+            return default
+        return formatMemory(self.resources.memory / float(job_threads))
+
+    def record(self, usage):
+        '''append the job's `usage` (see :func:`run_ledger.readUsage`)
+        to the run log of the model'''
+
+        self.model.run_log.append(
+            self.kind, self.name, self.input_bytes, self.n_cells,
+            self.seq_sat, self.threads, usage)
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--run-log", dest="run_log", type="string",
+                      help="run log of past jobs [%default]")
+
+    parser.add_option("--kind", dest="kind", type="string",
+                      help="kind of job to predict the resources for "
+                      "[%default]")
+
+    parser.add_option("--input-bytes", dest="input_bytes", type="int",
+                      help="input size of the job [%default]")
+
+    parser.add_option("--n-cells", dest="n_cells", type="float",
+                      help="number of cells in the sample [%default]")
+
+    parser.add_option("--seq-sat", dest="seq_sat", type="float",
+                      help="sequencing saturation of the sample "
+                      "[%default]")
+
+    parser.set_defaults(
+        run_log=None,
+        kind=None,
+        input_bytes=None,
+        n_cells=None,
+        seq_sat=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.run_log:
+        raise ValueError("--run-log is required")
+
+    model = SizingModel(options.run_log)
+
+    if options.kind:
+        if options.input_bytes is None:
+            raise ValueError("--kind requires --input-bytes")
+        resources = model.predict(options.kind, options.input_bytes,
+                                  options.n_cells, options.seq_sat,
+                                  default=Resources(None, None, None))
+        options.stdout.write("threads\tmemory\tscratch\n%s\t%s\t%s\n" % (
+            resources.threads, resources.memory, resources.scratch))
+    else:
+        options.stdout.write(
+            "kind\truns\tintercept\tbytes_per_input_byte\t"
+            "input_bytes_per_thread_second\tscratch_per_input_byte\n")
+        for kind, runs in sorted(model.runs.items()):
+            runs = [x for x in runs
+                    if x["max_rss"] is not None and x["input_bytes"]]
+            if not runs:
+                continue
+            coefficients, _ = model.fitMemory(runs, ["input_bytes"])
+            options.stdout.write("%s\t%i\t%i\t%.4g\t%.4g\t%.4g\n" % (
+                kind, len(runs), coefficients[0], coefficients[1],
+                model.throughput(runs), model.scratchRatio(runs)))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,355 @@
+'''
+knee_detection.py - estimate the number of cells from barcode counts
+=====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Estimate the threshold separating real cell barcodes from ambient
+and error barcodes from the counts (reads or unique UMIs) per cell
+barcode, replacing the manual inspection of cumulative count plots
+and ``log10(reads) > 3.8`` style cutoffs in the notebooks.
+
+Three estimates are made from a single sort of the counts:
+
+knee
+   The knee of the cumulative count curve (cf. the cumulative count
+   plots in the notebooks), i.e the barcode furthest from the line
+   from the first to the last barcode, as per the ``umi_tools
+   whitelist`` distance method. The distance is sensitive to the
+   number of background barcodes, which move the knee into the
+   background, so it is found again on the top `refine` times as
+   many barcodes as the first estimate.
+
+inflection
+   The point of steepest descent on the smoothed log10(count) vs
+   log10(rank) curve.
+
+density
+   The local minimum in the density of log10(count) between the
+   cells and background peaks, as per ``umi_tools whitelist``. The
+   density is weighted by the counts so that the cell barcodes are not
+   swamped by the background barcodes. As the weighting can leave the
+   background peak far below the cells peak, the peaks are paired by
+   the depth of the minimum between them relative to the lower peak,
+   rather than by height.
+
+Each estimate is returned with a range of plausible thresholds and a
+confidence between 0 and 1. For the knee and inflection, the range
+covers the ranks scoring within `tolerance` of the optimum and the
+confidence is 1 minus the width of this range as a fraction of the
+log10 rank range. For the density, the range covers the bins within
+`tolerance` of the minimum density and the confidence is the depth
+of the minimum relative to the lower of the two peaks.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python knee_detection.py --counts=sample_counts.tsv
+   --count-column=reads -S sample_cell_number.tsv
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import sys
+
+import numpy as np
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+Threshold = collections.namedtuple(
+    "Threshold", ["method", "count", "n_cells", "lower", "upper",
+                  "confidence"])
+
+METHODS = ("knee", "inflection", "density")
+
+
+def _gaussianSmooth(values, width):
+    '''smooth `values` with a gaussian kernel with sd `width` points'''
+
+    if width <= 0:
+        return values
+
+    half = int(np.ceil(3 * width))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / width) ** 2)
+    kernel /= kernel.sum()
+
+    padded = np.pad(values, half, mode="edge")
+    return np.convolve(padded, kernel, mode="valid")
+
+
+def _nCells(sorted_counts, threshold):
+    '''number of barcodes with counts >= threshold, given counts in
+    descending order'''
+    return int(np.searchsorted(-sorted_counts, -threshold, side="right"))
+
+
+def _rangeConfidence(n_low, n_high, n_total):
+    '''confidence from the width of a range of ranks in log10 space'''
+
+    if n_total <= 1:
+        return 0.0
+
+    width = np.log10(max(n_high, 1)) - np.log10(max(n_low, 1))
+    return float(max(0.0, 1.0 - width / np.log10(n_total)))
+
+
+def _rankCurve(sorted_counts, n_points=1000, smooth=5):
+    '''return the smoothed log10(count) vs log10(rank) curve, resampled
+    at `n_points` evenly spaced log10 ranks'''
+
+    # the mid rank of each run of tied counts
+    values, run_lengths = np.unique(sorted_counts, return_counts=True)
+    values = values[::-1]
+    run_lengths = run_lengths[::-1]
+    mid_ranks = np.cumsum(run_lengths) - (run_lengths - 1) / 2.0
+
+    log_rank = np.log10(mid_ranks)
+    log_count = np.log10(values)
+
+    # resample evenly in log rank space so the smoothing is even
+    grid = np.linspace(log_rank[0], log_rank[-1], n_points)
+    curve = _gaussianSmooth(np.interp(grid, log_rank, log_count), smooth)
+
+    return grid, curve
+
+
+def _curveThreshold(method, sorted_counts, grid, curve, best, close):
+    '''make a Threshold for point `best` of the rank curve, with the
+    range covered by the points `close`'''
+
+    count = 10 ** curve[best]
+
+    return Threshold(method, int(np.ceil(count)),
+                     _nCells(sorted_counts, count),
+                     int(np.ceil(10 ** curve[close.max()])),
+                     int(np.ceil(10 ** curve[close.min()])),
+                     _rangeConfidence(10 ** grid[close.min()],
+                                      10 ** grid[close.max()],
+                                      len(sorted_counts)))
+
+
+def kneeThreshold(sorted_counts, refine=3, tolerance=0.05):
+    '''threshold at the knee of the cumulative count curve, given
+    counts in descending order.
+
+    The knee is the barcode furthest above the line from the first to
+    the last barcode on the cumulative count curve. As the background
+    barcodes pull the knee into the background, it is found again on
+    the top `refine` times as many barcodes as the first estimate.
+    '''
+
+    def furthest(n):
+        cumulative = np.cumsum(sorted_counts[:n], dtype=np.float64)
+        ranks = np.arange(n, dtype=np.float64)
+        distance = cumulative - (
+            cumulative[0] + ranks * (cumulative[-1] - cumulative[0]) /
+            (n - 1))
+        return distance, int(np.argmax(distance))
+
+    if len(sorted_counts) < 3 or sorted_counts[0] == sorted_counts[-1]:
+        return None
+
+    distance, knee = furthest(len(sorted_counts))
+    n = min(len(sorted_counts), refine * (knee + 1))
+    if n >= 3 and n < len(sorted_counts):
+        distance, knee = furthest(n)
+
+    if distance[knee] <= 0:
+        return None
+
+    close = np.flatnonzero(distance >= distance[knee] * (1 - tolerance))
+    count = sorted_counts[knee]
+
+    return Threshold("knee", int(count), _nCells(sorted_counts, count),
+                     int(sorted_counts[close.max()]),
+                     int(sorted_counts[close.min()]),
+                     _rangeConfidence(close.min() + 1, close.max() + 1,
+                                      len(sorted_counts)))
+
+
+def inflectionThreshold(sorted_counts, n_points=1000, smooth=5,
+                        tolerance=0.05):
+    '''threshold at the inflection of the log-log rank curve, i.e its
+    steepest point, given counts in descending order'''
+
+    if len(np.unique(sorted_counts)) < 3:
+        return None
+
+    grid, curve = _rankCurve(sorted_counts, n_points, smooth)
+    gradient = np.gradient(curve, grid)
+
+    inflection = int(np.argmin(gradient))
+    close = np.flatnonzero(gradient <= gradient[inflection] * (1 - tolerance))
+
+    return _curveThreshold(
+        "inflection", sorted_counts, grid, curve, inflection, close)
+
+
+def densityThreshold(sorted_counts, n_bins=100, smooth=2,
+                     min_depth=0.5, tolerance=0.05):
+    '''threshold at the deepest density minimum between the highest
+    peak and another peak in the count-weighted density of log10
+    counts. Returns None if the density is not bimodal, i.e. there is
+    no minimum with a depth of `min_depth` relative to the lower peak'''
+
+    # weighting by counts stops the many background barcodes swamping
+    # the density of the cell barcodes
+    log_counts = np.log10(sorted_counts)
+    density, edges = np.histogram(log_counts, bins=n_bins, density=True,
+                                  weights=sorted_counts)
+    density = _gaussianSmooth(density, smooth)
+    centres = (edges[:-1] + edges[1:]) / 2
+
+    inner = density[1:-1]
+    peaks = np.flatnonzero((inner > density[:-2]) &
+                           (inner >= density[2:])) + 1
+
+    if len(peaks) < 2:
+        return None
+
+    # the weighting can leave either peak far lower than the other, so
+    # the depth of the minimum is taken relative to the lower peak
+    highest = peaks[np.argmax(density[peaks])]
+    confidence = 0.0
+    for peak in peaks[peaks != highest]:
+        peak_between = np.arange(min(highest, peak), max(highest, peak) + 1)
+        peak_best = peak_between[np.argmin(density[peak_between])]
+        lower_peak = min(density[peak], density[highest])
+        if 1 - density[peak_best] / lower_peak > confidence:
+            confidence = 1 - density[peak_best] / lower_peak
+            between, best, lower = peak_between, peak_best, lower_peak
+
+    if confidence < min_depth:
+        return None
+
+    close = between[density[between] <=
+                    density[best] + tolerance * lower]
+    count = 10 ** centres[best]
+
+    return Threshold("density", int(np.ceil(count)),
+                     _nCells(sorted_counts, count),
+                     int(np.ceil(10 ** centres[close.min()])),
+                     int(np.ceil(10 ** centres[close.max()])),
+                     float(confidence))
+
+
+def estimateThresholds(counts, min_count=10):
+    '''estimate the cell barcode count thresholds from an array of
+    `counts` per barcode (reads or unique UMIs). Barcodes with fewer
+    than `min_count` counts are ignored.
+
+    Returns a dictionary mapping method to :class:`Threshold`, or to
+    None where no threshold could be estimated.
+    '''
+
+    counts = np.asarray(counts)
+    counts = counts[counts >= max(min_count, 1)]
+
+    if len(counts) < 3:
+        raise ValueError("too few barcodes to estimate a threshold")
+
+    sorted_counts = -np.sort(-counts)
+
+    return {"knee": kneeThreshold(sorted_counts),
+            "inflection": inflectionThreshold(sorted_counts),
+            "density": densityThreshold(sorted_counts)}
+
+
+def readCounts(infile, column="reads"):
+    '''read the `column` counts from a barcode counts table, as
+    written by extract_barcodes.py'''
+
+    with IOTools.openFile(infile, "r") as inf:
+        header = next(inf).rstrip("\n").split("\t")
+        ix = header.index(column)
+        return np.array([int(line.split("\t")[ix]) for line in inf],
+                        dtype=np.int64)
+
+
+def readThreshold(infile, method):
+    '''read the :class:`Threshold` for `method` from a table written by
+    this script'''
+
+    with IOTools.openFile(infile, "r") as inf:
+        header = next(inf).rstrip("\n").split("\t")
+        for line in inf:
+            values = dict(zip(header, line.rstrip("\n").split("\t")))
+            if values["method"] == method:
+                if values["count"] == "NA":
+                    return None
+                return Threshold(method, int(values["count"]),
+                                 int(values["n_cells"]),
+                                 int(values["lower"]),
+                                 int(values["upper"]),
+                                 float(values["confidence"]))
+
+    raise KeyError("no threshold for method %s in %s" % (method, infile))
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-i", "--counts", dest="counts", type="string",
+                      help="barcode counts table [%default]")
+
+    parser.add_option("--count-column", dest="count_column",
+                      type="choice", choices=("reads", "unique_umis"),
+                      help="counts to use [%default]")
+
+    parser.add_option("--min-count", dest="min_count", type="int",
+                      help="ignore barcodes with fewer counts "
+                      "[%default]")
+
+    parser.set_defaults(
+        counts=None,
+        count_column="reads",
+        min_count=10,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.counts is None:
+        raise ValueError("--counts is required")
+
+    thresholds = estimateThresholds(
+        readCounts(options.counts, options.count_column),
+        min_count=options.min_count)
+
+    options.stdout.write("\t".join(Threshold._fields) + "\n")
+    for method in METHODS:
+        threshold = thresholds[method]
+        if threshold is None:
+            options.stdout.write("%s\tNA\tNA\tNA\tNA\tNA\n" % method)
+            E.warn("no %s threshold could be estimated" % method)
+        else:
+            options.stdout.write("%s\t%i\t%i\t%i\t%i\t%.3f\n" % threshold)
+            E.info("%s threshold: %i %s (%i cells)" % (
+                method, threshold.count, options.count_column,
+                threshold.n_cells))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,302 @@
+'''
+make_whitelist.py - make a cell barcode whitelist from barcode counts
+======================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Make a whitelist of "true" cell barcodes from a barcode counts table
+written by extract_barcodes.py, in place of ``umi_tools whitelist``.
+As the counts are cached by extract_barcodes.py, changing the number
+of cells, the threshold method or the plots only re-reads the counts
+table, not the fastq.
+
+The whitelist is the top `cell_number` barcodes by count, either given
+directly or taken from a knee_detection.py table with `method`. As per
+``umi_tools whitelist``, each other barcode within a single
+substitution of exactly one whitelisted barcode is reported as an
+error of that barcode. The output has the same columns as
+``umi_tools whitelist``: the barcode, the comma separated error
+barcodes, the count and the comma separated error counts.
+
+With `plot_prefix`, the counts per barcode by rank are plotted to
+``<plot_prefix>_cell_barcode_counts.png`` (requires matplotlib).
+
+With `background`, the barcodes of the empty droplets are written
+instead, in the same format, e.g to extract their reads for
+ambient_rna.py. These are the barcodes outside the whitelist with
+fewer counts than the lower bound of the `method` threshold's
+plausible range (or `background_max_count`) and at least
+`background_min_count` counts, as fewer are mostly sequencing errors.
+The error barcodes of the whitelisted barcodes are excluded.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python make_whitelist.py --counts=sample_barcode_counts.tsv
+   --cell-number-table=sample_cell_number.tsv --method=inflection
+   -S sample_whitelist.tsv
+
+   python make_whitelist.py --counts=sample_barcode_counts.tsv
+   --cell-number-table=sample_cell_number.tsv --method=inflection
+   --background -S sample_background.tsv
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import sys
+
+import numpy as np
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+import knee_detection
+import whitelist_index
+
+
+def readCounts(infile, column="reads"):
+    '''read the cell barcodes and `column` counts from a barcode
+    counts table, in descending order of counts'''
+
+    cells = []
+    counts = []
+    with IOTools.openFile(infile, "r") as inf:
+        header = next(inf).rstrip("\n").split("\t")
+        ix = header.index(column)
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            cells.append(fields[0])
+            counts.append(int(fields[ix]))
+
+    counts = np.array(counts, dtype=np.int64)
+    order = np.argsort(-counts, kind="mergesort")
+
+    return [cells[x] for x in order], counts[order]
+
+
+def findErrors(cells, counts, n_cells):
+    '''assign the barcodes after the top `n_cells` to the whitelisted
+    barcode they are a single substitution from, where there is
+    exactly one.
+
+    Returns a dict of whitelisted barcode to a list of (error barcode,
+    count).
+    '''
+
+    errors = collections.defaultdict(list)
+
+    by_length = collections.defaultdict(list)
+    for ix in range(n_cells, len(cells)):
+        by_length[len(cells[ix])].append(ix)
+
+    for length, indices in by_length.items():
+        # Ns can't be indexed, so whitelisted barcodes with Ns only
+        # match exactly
+        whitelist = [x for x in cells[:n_cells]
+                     if len(x) == length and "N" not in x]
+        if not whitelist:
+            continue
+
+        index = whitelist_index.WhitelistIndex(whitelist, indels=False)
+        targets, status = index.correctIndices([cells[x] for x in indices])
+
+        for ix, target, code in zip(indices, targets, status):
+            if code == whitelist_index.CORRECTED:
+                errors[whitelist[target]].append((cells[ix], counts[ix]))
+
+    return errors
+
+
+def writeWhitelist(outfile, cells, counts, n_cells, errors):
+    '''write the whitelist in the ``umi_tools whitelist`` format'''
+
+    for cell, count in zip(cells[:n_cells], counts[:n_cells]):
+        cell_errors = errors.get(cell, [])
+        outfile.write("%s\t%s\t%i\t%s\n" % (
+            cell,
+            ",".join(x[0] for x in cell_errors),
+            count,
+            ",".join(str(x[1]) for x in cell_errors)))
+
+
+def backgroundBarcodes(cells, counts, n_cells, errors, max_count,
+                       min_count=10):
+    '''return the indices of the background barcodes: those after
+    the top `n_cells` and not in the `errors` of a whitelisted barcode,
+    with fewer than `max_count` and at least `min_count` counts'''
+
+    error_barcodes = set(
+        x[0] for cell_errors in errors.values() for x in cell_errors)
+
+    return [ix for ix in np.flatnonzero(
+        (counts < max_count) & (counts >= min_count))
+        if ix >= n_cells and cells[ix] not in error_barcodes]
+
+
+def plotCounts(plot_prefix, counts, n_cells, column):
+    '''plot the counts per barcode by rank, marking the threshold'''
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.plot(np.arange(1, len(counts) + 1), counts)
+    ax.axvline(n_cells, color="red", linestyle="dashed")
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("Cell barcode rank")
+    ax.set_ylabel(column.replace("_", " ").capitalize())
+    fig.savefig("%s_cell_barcode_counts.png" % plot_prefix)
+    plt.close(fig)
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-i", "--counts", dest="counts", type="string",
+                      help="barcode counts table [%default]")
+
+    parser.add_option("--count-column", dest="count_column",
+                      type="choice", choices=("reads", "unique_umis"),
+                      help="counts to rank the barcodes by [%default]")
+
+    parser.add_option("--cell-number", dest="cell_number", type="int",
+                      help="number of cell barcodes to whitelist "
+                      "[%default]")
+
+    parser.add_option("--cell-number-table", dest="cell_number_table",
+                      type="string",
+                      help="knee_detection.py table to take the number "
+                      "of cells from, if --cell-number is not given "
+                      "[%default]")
+
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=knee_detection.METHODS,
+                      help="threshold from --cell-number-table to use "
+                      "[%default]")
+
+    parser.add_option("--error-correct-threshold",
+                      dest="error_correct_threshold", type="int",
+                      help="report barcodes this many substitutions "
+                      "from a whitelisted barcode as errors, 0 or 1 "
+                      "[%default]")
+
+    parser.add_option("--plot-prefix", dest="plot_prefix", type="string",
+                      help="prefix for the plot of the counts "
+                      "[%default]")
+
+    parser.add_option("--background", dest="background",
+                      action="store_true",
+                      help="write the background barcodes rather than "
+                      "the whitelist [%default]")
+
+    parser.add_option("--background-max-count", dest="background_max_count",
+                      type="int",
+                      help="background barcodes have fewer counts, "
+                      "in place of the lower bound of the --method "
+                      "threshold [%default]")
+
+    parser.add_option("--background-min-count", dest="background_min_count",
+                      type="int",
+                      help="background barcodes have at least this many "
+                      "counts [%default]")
+
+    parser.set_defaults(
+        counts=None,
+        count_column="reads",
+        cell_number=None,
+        cell_number_table=None,
+        method="inflection",
+        error_correct_threshold=1,
+        plot_prefix=None,
+        background=False,
+        background_max_count=None,
+        background_min_count=10,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.counts is None:
+        raise ValueError("--counts is required")
+
+    if options.error_correct_threshold not in (0, 1):
+        raise ValueError("--error-correct-threshold must be 0 or 1")
+
+    def readThreshold():
+        if options.cell_number_table is None:
+            return None
+        threshold = knee_detection.readThreshold(
+            options.cell_number_table, options.method)
+        if threshold is None:
+            raise ValueError("no %s threshold in %s" % (
+                options.method, options.cell_number_table))
+        return threshold
+
+    if options.cell_number is None:
+        threshold = readThreshold()
+        if threshold is None:
+            raise ValueError(
+                "one of --cell-number or --cell-number-table is required")
+        options.cell_number = threshold.n_cells
+
+    cells, counts = readCounts(options.counts, options.count_column)
+    n_cells = min(options.cell_number, len(cells))
+
+    if options.error_correct_threshold:
+        errors = findErrors(cells, counts, n_cells)
+    else:
+        errors = {}
+
+    if options.background:
+        if options.background_max_count is None:
+            threshold = readThreshold()
+            if threshold is None:
+                raise ValueError("--background needs --cell-number-table "
+                                 "or --background-max-count")
+            options.background_max_count = threshold.lower
+
+        background = backgroundBarcodes(
+            cells, counts, n_cells, errors, options.background_max_count,
+            options.background_min_count)
+        writeWhitelist(options.stdout, [cells[x] for x in background],
+                       counts[background], len(background), {})
+
+        E.info("%i background barcodes with %i-%i counts" % (
+            len(background), options.background_min_count,
+            options.background_max_count - 1))
+
+    else:
+        writeWhitelist(options.stdout, cells, counts, n_cells, errors)
+
+        E.info("whitelisted %i cell barcodes, %i error barcodes" % (
+            n_cells, sum(len(x) for x in errors.values())))
+
+        if options.plot_prefix:
+            plotCounts(options.plot_prefix, counts, n_cells,
+                       options.count_column)
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,283 @@
+'''
+parallel_dedup.py - run umi_tools dedup on each contig in parallel
+===================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Run ``umi_tools dedup`` on a sorted and indexed BAM as one process per
+contig (``--chrom``), `threads` at a time, and combine the outputs, so
+the deduplication of a large sample scales with the number of cores.
+
+The reads of a gene bundle are all on one contig, so the contigs can
+be deduplicated independently. Contigs can't be split further as
+``umi_tools`` can only be restricted to a whole contig. The contigs
+with the most mapped reads (from the BAM index) are started first so
+the largest contigs don't hold up the end of the run.
+
+The deduplicated BAMs are concatenated in the order of the contigs in
+the BAM header, i.e the order a single ``umi_tools dedup`` process
+would write them in. With `output_stats`, the ``--output-stats``
+tables of the contigs are merged by summing the counts for each UMI,
+count or edit distance. The median counts per UMI (the
+``median_counts_*`` columns of the per UMI table) can't be merged
+exactly, as umi_tools doesn't report the counts they are the median
+of. They are approximated by the median of the per contig medians,
+weighted by the number of times each UMI was observed on the contig,
+and the merged table has an ``approximate_medians`` column to say so.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python parallel_dedup.py --bamfile=sample_sorted.bam --threads=8
+   --output-bam=sample_dedup.bam --output-stats=sample_dedup.bam_stats
+   --umi-tools-options="--per-cell --per-gene --gene-tag=XT"
+
+Command line options
+--------------------
+
+'''
+
+import concurrent.futures
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pysam
+
+import CGAT.Experiment as E
+
+
+# the --output-stats tables and the column they are keyed on
+STATS_TABLES = (("_per_umi.tsv", "UMI"),
+                ("_per_umi_per_position.tsv", "counts"),
+                ("_edit_distance.tsv", "edit_distance"))
+
+_LOG_COUNTS = (("input_reads", re.compile(r"Input Reads: (\d+)")),
+               ("output_reads", re.compile(r"Number of reads out: (\d+)")))
+
+
+def mappedContigs(bamfile):
+    '''return the contigs with mapped reads, in header order, and the
+    number of mapped reads on each'''
+
+    with pysam.AlignmentFile(bamfile) as inbam:
+        return [(x.contig, x.mapped)
+                for x in inbam.get_index_statistics() if x.mapped > 0]
+
+
+def _dedupContig(bamfile, contig, prefix, umi_tools_options, stats):
+    '''run umi_tools dedup on `contig`, writing to `prefix`.bam'''
+
+    command = ["umi_tools", "dedup",
+               "-I", bamfile,
+               "--chrom=%s" % contig,
+               "-S", prefix + ".bam",
+               "-L", prefix + ".log"] + umi_tools_options
+    if stats:
+        command.append("--output-stats=%s" % prefix)
+
+    if subprocess.call(command) != 0:
+        raise OSError("umi_tools dedup failed for %s, see %s.log" % (
+            contig, prefix))
+
+    return readLogCounts(prefix + ".log")
+
+
+def readLogCounts(logfile):
+    '''return the input and output read counts from a umi_tools log'''
+
+    counts = dict((name, 0) for name, _ in _LOG_COUNTS)
+    with open(logfile) as inf:
+        for line in inf:
+            for name, regex in _LOG_COUNTS:
+                match = regex.search(line)
+                if match:
+                    counts[name] = int(match.group(1))
+    return counts
+
+
+def _sortKeys(keys):
+    '''order keys with non-numeric keys (e.g Single_UMI) first, then
+    numerically'''
+
+    numeric = pd.to_numeric(pd.Series(keys), errors="coerce")
+    return np.lexsort((keys.astype(str), numeric.fillna(-np.inf).values))
+
+
+def _weightedMedian(df, key, median_column, weight_column):
+    '''return the `weight_column` weighted median of `median_column`
+    for each `key`.
+
+    This approximates the median of the values the `median_column`
+    medians were taken from. It is exact where a key is in a single
+    table, but otherwise can be anywhere between the smallest and
+    largest of the medians.
+    '''
+
+    df = df[[key, median_column, weight_column]].dropna()
+    df = df.sort_values([key, median_column], kind="mergesort")
+    cumulative = df.groupby(key, sort=False)[weight_column].cumsum()
+    total = df.groupby(key, sort=False)[weight_column].transform("sum")
+    return df[cumulative * 2 >= total].groupby(key)[median_column].first()
+
+
+def mergeStats(infiles, outfile, key):
+    '''merge umi_tools --output-stats tables keyed on `key`. The counts
+    are summed and the medians are approximated with
+    :func:`_weightedMedian`, in which case the merged table has an
+    ``approximate_medians`` column set to True'''
+
+    tables = [pd.read_csv(x, sep="\t", dtype={key: str}) for x in infiles
+              if os.path.getsize(x) > 0]
+    if not tables:
+        return
+
+    df = pd.concat(tables, ignore_index=True)
+
+    medians = [x for x in df.columns if x.startswith("median_")]
+    sums = [x for x in df.columns if x != key and x not in medians]
+
+    merged = df.groupby(key)[sums].sum()
+    for column in medians:
+        # e.g median_counts_pre is weighted by times_observed_pre
+        weight_column = "times_observed" + column[len("median_counts"):]
+        merged[column] = _weightedMedian(df, key, column, weight_column)
+
+    merged = merged.iloc[_sortKeys(merged.index.values)]
+
+    # the counts are read as floats where a table has missing values
+    for column in sums:
+        merged[column] = merged[column].astype(np.int64)
+
+    columns = list(df.columns)
+    if medians:
+        E.info("%s: %s are approximate" % (outfile, ", ".join(medians)))
+        merged["approximate_medians"] = True
+        columns.append("approximate_medians")
+
+    merged.reset_index()[columns].to_csv(outfile, sep="\t", index=False)
+
+
+def parallelDedup(bamfile, output_bam, umi_tools_options, threads=1,
+                  output_stats=None, tmpdir=None):
+    '''run umi_tools dedup on each contig of `bamfile` and combine the
+    outputs. Returns the total input and output reads'''
+
+    contigs = mappedContigs(bamfile)
+    if not contigs:
+        raise ValueError("no mapped reads in %s" % bamfile)
+
+    tmpdir = tempfile.mkdtemp(
+        dir=tmpdir or os.path.dirname(os.path.abspath(output_bam)))
+
+    prefixes = dict((contig, os.path.join(tmpdir, "contig%i" % ix))
+                    for ix, (contig, _) in enumerate(contigs))
+
+    totals = dict((name, 0) for name, _ in _LOG_COUNTS)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            jobs = dict(
+                (pool.submit(_dedupContig, bamfile, contig,
+                             prefixes[contig], umi_tools_options,
+                             output_stats is not None), contig)
+                for contig, _ in sorted(contigs, key=lambda x: -x[1]))
+
+            for job in concurrent.futures.as_completed(jobs):
+                counts = job.result()
+                E.info("%s: %i reads in, %i reads out" % (
+                    jobs[job], counts["input_reads"],
+                    counts["output_reads"]))
+                for name in totals:
+                    totals[name] += counts[name]
+
+        pysam.cat("-o", output_bam,
+                  *[prefixes[contig] + ".bam" for contig, _ in contigs])
+
+        if output_stats is not None:
+            for suffix, key in STATS_TABLES:
+                mergeStats([prefixes[contig] + suffix
+                            for contig, _ in contigs],
+                           output_stats + suffix, key)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return totals
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="sorted and indexed BAM [%default]")
+
+    parser.add_option("--output-bam", dest="output_bam", type="string",
+                      help="deduplicated BAM [%default]")
+
+    parser.add_option("--output-stats", dest="output_stats", type="string",
+                      help="prefix for the merged umi_tools "
+                      "--output-stats tables [%default]")
+
+    parser.add_option("--umi-tools-options", dest="umi_tools_options",
+                      type="string",
+                      help="options to pass to umi_tools dedup "
+                      "[%default]")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="number of umi_tools processes [%default]")
+
+    parser.add_option("--tmpdir", dest="tmpdir", type="string",
+                      help="directory for the per contig outputs, "
+                      "defaults to that of --output-bam [%default]")
+
+    parser.set_defaults(
+        bamfile=None,
+        output_bam=None,
+        output_stats=None,
+        umi_tools_options="",
+        threads=1,
+        tmpdir=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile or not options.output_bam:
+        raise ValueError("--bamfile and --output-bam are required")
+
+    totals = parallelDedup(options.bamfile, options.output_bam,
+                           shlex.split(options.umi_tools_options),
+                           threads=options.threads,
+                           output_stats=options.output_stats,
+                           tmpdir=options.tmpdir)
+
+    # as per the umi_tools dedup log
+    E.info("Reads: Input Reads: %i" % totals["input_reads"])
+    E.info("Number of reads out: %i" % totals["output_reads"])
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
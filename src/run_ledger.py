@@ -0,0 +1,573 @@
+'''
+run_ledger.py - record the resources and tool counters of pipeline jobs
+========================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Instrument the statements run by the pipeline tasks and record the
+resources each job used, along with the counters reported in the logs
+of the tools it ran, in a run ledger in the pipeline database.
+
+A monitor process runs alongside the job's statement (see
+:func:`monitorStatement`). Every `interval` seconds it samples the
+job's process tree for its resident memory, CPU time, bytes read and
+written and the size of its temporary files. Once the statement is
+done, the monitor takes a final sample while the job's shell is still
+running. By then the CPU time and I/O of all the job's processes have
+been added to the shell's own, so the totals are exact. The usage is
+written to a tab separated usage file (see :func:`readUsage`).
+
+The logs written by the job are then parsed for their counters (see
+:func:`jobCounters`):
+
+hisat2
+   the alignment summary: reads, aligned 0, 1 and >1 times and the
+   overall alignment rate
+featureCounts
+   the ``.summary`` table of reads by assignment status
+umi_tools and CGAT scripts
+   ``INFO <counter>: <number>`` lines, e.g ``INFO Reads: Input Reads:
+   1000`` as ``reads_input_reads``
+
+:meth:`RunLedger.run` runs a pipeline task's statement, as per
+``P.run()``, and records the job in two tables:
+
+run_ledger
+   a row per job: task, job (output), sample, start time, threads,
+   wall and CPU seconds, peak memory and scratch, bytes read and written
+   (``read_bytes``/``write_bytes`` from storage, ``read_chars`` and
+   ``write_chars`` including pipes and the page cache) and the read
+   throughput (read chars per wall second)
+run_ledger_counters
+   a row per tool counter: run_id, source (the log), tool, counter and
+   value
+
+Usage
+-----
+
+Report the latest run of each task for each sample, and the fraction
+of the sample's total run time it took:
+
+.. code-block:: bash
+
+   python run_ledger.py --database=csvdb
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import glob
+import hashlib
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import CGAT.Experiment as E
+
+
+# monitored usage, in the order written to the usage file
+USAGE_FIELDS = ("wall_seconds", "cpu_seconds", "max_rss", "max_scratch",
+                "read_bytes", "write_bytes", "read_chars", "write_chars")
+
+# the cumulative /proc/<pid>/io counters and the usage they are
+# recorded as
+_IO_FIELDS = (("read_bytes", "read_bytes"), ("write_bytes", "write_bytes"),
+              ("rchar", "read_chars"), ("wchar", "write_chars"))
+
+LEDGER_COLUMNS = (("task", "TEXT"), ("job", "TEXT"), ("sample", "TEXT"),
+                  ("started", "TEXT"), ("threads", "INTEGER")) + tuple(
+                      (x, "REAL" if x.endswith("seconds") else "INTEGER")
+                      for x in USAGE_FIELDS) + (
+                          ("read_throughput", "REAL"),)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+_HISAT2_COUNTERS = (
+    ("reads", re.compile(r"^\s*(\d+) reads; of these:")),
+    ("aligned_0", re.compile(r"^\s*(\d+) \([\d.]+%\) aligned 0 times")),
+    ("aligned_1", re.compile(
+        r"^\s*(\d+) \([\d.]+%\) aligned exactly 1 time")),
+    ("aligned_multi", re.compile(r"^\s*(\d+) \([\d.]+%\) aligned >1 times")),
+    ("overall_alignment_rate", re.compile(
+        r"^\s*([\d.]+)% overall alignment rate")))
+
+_INFO_COUNTER = re.compile(r"\bINFO\s+(.*\S)\s*:\s*(-?\d+(?:\.\d+)?)\s*$")
+
+_COMMAND = re.compile(r"^# output generated by (.+)$")
+
+
+##############################################################################
+#  Monitoring
+##############################################################################
+
+def _processTree(pid):
+    '''return the ids of `pid` and all its descendants'''
+
+    children = collections.defaultdict(list)
+    for stat_file in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_file) as inf:
+                stat = inf.read()
+        except (IOError, OSError):
+            continue
+        # the command in brackets may contain spaces
+        child, _, fields = stat.rpartition(")")
+        children[int(fields.split()[1])].append(
+            int(child.split(" (")[0]))
+
+    tree = [pid]
+    for process in tree:
+        tree.extend(children[process])
+    return tree
+
+
+def _processUsage(pid):
+    '''return the resident memory, CPU seconds and I/O counters of
+    `pid`. The CPU seconds and I/O include those of the children it
+    has waited for'''
+
+    with open("/proc/%i/stat" % pid) as inf:
+        fields = inf.read().rpartition(")")[2].split()
+    # utime, stime, cutime and cstime
+    cpu_seconds = sum(int(x) for x in fields[11:15]) / float(_CLOCK_TICKS)
+
+    with open("/proc/%i/statm" % pid) as inf:
+        rss = int(inf.read().split()[1]) * _PAGE_SIZE
+
+    io = {}
+    try:
+        with open("/proc/%i/io" % pid) as inf:
+            for line in inf:
+                key, _, value = line.partition(":")
+                io[key] = int(value)
+    except (IOError, OSError):
+        pass
+
+    return rss, cpu_seconds, io
+
+
+def _scratchSize(pattern):
+    '''return the total size of the files matching `pattern`'''
+
+    total = 0
+    for filename in glob.glob(pattern):
+        try:
+            if os.path.isdir(filename):
+                for root, _, files in os.walk(filename):
+                    for name in files:
+                        total += os.path.getsize(os.path.join(root, name))
+            else:
+                total += os.path.getsize(filename)
+        except OSError:
+            continue
+    return total
+
+
+def _sample(pid, usage, scratch=None):
+    '''update `usage` with a sample of the process tree of `pid`'''
+
+    rss = cpu_seconds = 0
+    io = collections.Counter()
+    for process in _processTree(pid):
+        if process == os.getpid():
+            continue
+        try:
+            process_rss, process_cpu, process_io = _processUsage(process)
+        except (IOError, OSError):
+            continue
+        rss += process_rss
+        cpu_seconds += process_cpu
+        io.update(process_io)
+
+    # the totals drop while an exited process waits to be reaped
+    usage["max_rss"] = max(usage["max_rss"], rss)
+    usage["cpu_seconds"] = max(usage["cpu_seconds"], cpu_seconds)
+    for key, field in _IO_FIELDS:
+        usage[field] = max(usage[field], io[key])
+    if scratch:
+        usage["max_scratch"] = max(usage["max_scratch"],
+                                   _scratchSize(scratch))
+
+
+def writeUsage(usage_file, usage):
+    # the pipeline may read the usage while the monitor is writing it
+    tmpfile = "%s.%i" % (usage_file, os.getpid())
+    with open(tmpfile, "w") as outf:
+        for field in USAGE_FIELDS:
+            if field.endswith("seconds"):
+                outf.write("%s\t%.3f\n" % (field, usage[field]))
+            else:
+                outf.write("%s\t%i\n" % (field, usage[field]))
+    os.replace(tmpfile, usage_file)
+
+
+def readUsage(usage_file):
+    '''return the usage written by :func:`monitor`, a dictionary of
+    the :data:`USAGE_FIELDS`'''
+
+    usage = {}
+    with open(usage_file) as inf:
+        for line in inf:
+            key, value = line.rstrip("\n").split("\t")
+            usage[key] = float(value) if "." in value else int(value)
+    return usage
+
+
+def monitor(pid, usage_file, scratch=None, interval=5, poll=0.2):
+    '''sample the process tree of `pid`, and the size of the files
+    matching `scratch`, every `interval` seconds until `pid` exits or
+    `usage_file`.done is created, then write the usage to
+    `usage_file`'''
+
+    done_file = usage_file + ".done"
+    start = time.time()
+    usage = dict.fromkeys(USAGE_FIELDS, 0)
+
+    next_sample = start
+    while os.path.exists("/proc/%i" % pid) and not os.path.exists(done_file):
+        if time.time() >= next_sample:
+            _sample(pid, usage, scratch)
+            usage["wall_seconds"] = time.time() - start
+            writeUsage(usage_file, usage)
+            next_sample += interval
+        time.sleep(poll)
+
+    if os.path.exists("/proc/%i" % pid):
+        _sample(pid, usage, scratch)
+    usage["wall_seconds"] = time.time() - start
+    writeUsage(usage_file, usage)
+
+    if os.path.exists(done_file):
+        os.unlink(done_file)
+
+
+def monitorStatement(statement, usage_file, scratch=None, interval=5):
+    '''return `statement` run alongside a :func:`monitor` of its shell,
+    which takes its final sample once `statement` is done. The exit
+    status is that of `statement`'''
+
+    for filename in (usage_file, usage_file + ".done"):
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    command = "python %s --monitor-pid=$$ --usage=%s --interval=%i" % (
+        os.path.abspath(__file__), usage_file, interval)
+    if scratch:
+        command += " --scratch='%s'" % scratch
+
+    return ("%s </dev/null >/dev/null 2>&1 & monitor_pid=$! ; "
+            "%s ; status=$? ; touch %s.done ; wait $monitor_pid ; "
+            "(exit $status)" % (
+                command, statement.strip().rstrip(";"), usage_file))
+
+
+##############################################################################
+#  Tool counters
+##############################################################################
+
+def _counterName(name):
+    return re.sub(r"[^0-9a-z]+", "_", name.lower()).strip("_")
+
+
+def _tool(command):
+    '''return the tool from a log's "output generated by" command'''
+
+    words = [os.path.basename(x) for x in command.split()[:2]]
+    if words[0].startswith("python") and len(words) > 1:
+        return words[1]
+    elif words[0] == "umi_tools" and len(words) > 1:
+        return "umi_tools_" + words[1]
+    return words[0]
+
+
+def parseLog(logfile):
+    '''return the tool which wrote `logfile` and a dictionary of its
+    counters'''
+
+    with open(logfile) as inf:
+        lines = inf.readlines()
+
+    counters = collections.OrderedDict()
+
+    if logfile.endswith(".summary") and lines and lines[0].startswith(
+            "Status\t"):
+        for line in lines[1:]:
+            status, count = line.rstrip("\n").split("\t")[:2]
+            counters[_counterName(status)] = int(count)
+        return "featureCounts", counters
+
+    if any("overall alignment rate" in x for x in lines):
+        for line in lines:
+            for name, regex in _HISAT2_COUNTERS:
+                match = regex.match(line)
+                if match:
+                    counters[name] = float(match.group(1))
+        return "hisat2", counters
+
+    tool = "log"
+    for line in lines:
+        match = _COMMAND.match(line)
+        if match and tool == "log":
+            tool = _tool(match.group(1))
+            continue
+        match = _INFO_COUNTER.search(line)
+        if match:
+            counters[_counterName(match.group(1))] = float(match.group(2))
+
+    return tool, counters
+
+
+def jobLogs(statement, since=None):
+    '''return the logs and featureCounts summaries named in `statement`
+    (with its parameters interpolated), which were written since
+    `since`'''
+
+    logs = set()
+    for token in re.findall(r"[^\s'\"=<>|;&]+", statement):
+        for filename in (token, token + ".summary"):
+            if (filename.endswith((".log", ".summary")) and
+                    os.path.isfile(filename) and
+                    (since is None or os.path.getmtime(filename) >= since)):
+                logs.add(filename)
+    return sorted(logs)
+
+
+def jobCounters(statement, since=None):
+    '''return the (source, tool, counter, value) of the counters in the
+    logs written by `statement`'''
+
+    counters = []
+    for logfile in jobLogs(statement, since):
+        try:
+            tool, values = parseLog(logfile)
+        except (IOError, ValueError) as error:
+            E.warn("could not parse %s: %s" % (logfile, error))
+            continue
+        counters.extend((logfile, tool, counter, value)
+                        for counter, value in values.items())
+    return counters
+
+
+##############################################################################
+#  Ledger
+##############################################################################
+
+class RunLedger(object):
+    '''run pipeline jobs with `run` (i.e P.run), recording them in the
+    run ledger tables of the database returned by `connect`.
+
+    The statements are interpolated with `params`. The usage files of
+    the running jobs are written to `ledger_dir` and `sample` returns
+    the sample for a job's output.
+    '''
+
+    def __init__(self, connect, params, run, ledger_dir, interval=5,
+                 enabled=True, sample=None):
+        self.connect = connect
+        self.params = params
+        self._run = run
+        self.ledger_dir = ledger_dir
+        self.interval = interval
+        self.enabled = enabled
+        self.sample = sample
+
+    @staticmethod
+    def createTables(cursor):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS run_ledger "
+            "(run_id INTEGER PRIMARY KEY AUTOINCREMENT, %s)" % ", ".join(
+                "%s %s" % x for x in LEDGER_COLUMNS))
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS run_ledger_counters "
+            "(run_id INTEGER, source TEXT, tool TEXT, counter TEXT, "
+            "value REAL)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS run_ledger_counters_run_id "
+            "ON run_ledger_counters (run_id)")
+
+    def record(self, task, job, sample, started, threads, usage, counters):
+        '''record a job of `task` which started at `started` (seconds
+        since the epoch) and used `usage` (see :func:`readUsage`), with
+        the tool `counters` (see :func:`jobCounters`).
+
+        Returns the run_id.
+        '''
+
+        row = dict(usage)
+        row.update(
+            task=task, job=job, sample=sample, threads=threads,
+            started=time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(started)),
+            read_throughput=(usage["read_chars"] / usage["wall_seconds"]
+                             if usage["wall_seconds"] else None))
+        columns = [x for x, _ in LEDGER_COLUMNS]
+
+        dbh = self.connect()
+        try:
+            cursor = dbh.cursor()
+            self.createTables(cursor)
+            cursor.execute(
+                "INSERT INTO run_ledger (%s) VALUES (%s)" % (
+                    ", ".join(columns), ", ".join("?" * len(columns))),
+                [row[x] for x in columns])
+            run_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO run_ledger_counters VALUES (?, ?, ?, ?, ?)",
+                [(run_id,) + tuple(x) for x in counters])
+            dbh.commit()
+        finally:
+            dbh.close()
+
+        return run_id
+
+    def run(self, job_size=None, **kwargs):
+        '''run the calling task's statement, monitoring the resources
+        it uses, and record them and the counters in the logs it writes.
+        The usage is also logged for the job_sizing.Job `job_size` to
+        calibrate the sizing model.
+
+        As per P.run(), the statement is interpolated with the task's
+        local variables, the parameters and `kwargs`.
+        '''
+
+        caller = inspect.currentframe().f_back
+        options = dict(caller.f_locals)
+        options.update(kwargs)
+
+        if not self.enabled and job_size is None:
+            return self._run(**options)
+
+        task = caller.f_code.co_name
+        job = (options.get("outfile") or options.get("output_pattern") or
+               options.get("outfiles") or task)
+        if isinstance(job, (list, tuple)):
+            job = job[0]
+
+        if not os.path.exists(self.ledger_dir):
+            os.makedirs(self.ledger_dir)
+        usage_file = os.path.abspath(os.path.join(
+            self.ledger_dir, "%s_%s.usage" % (
+                task, hashlib.sha1(job.encode()).hexdigest()[:16])))
+
+        statement = options["statement"]
+        options["statement"] = monitorStatement(
+            statement, usage_file,
+            scratch=job_size.scratch if job_size is not None else None,
+            interval=self.interval)
+
+        started = time.time()
+        self._run(**options)
+
+        if not os.path.exists(usage_file):
+            E.warn("no resource usage was recorded for %s" % job)
+            return
+
+        usage = readUsage(usage_file)
+        os.unlink(usage_file)
+
+        if job_size is not None:
+            job_size.record(usage)
+
+        if self.enabled:
+            try:
+                statement = statement % dict(self.params, **options)
+            except (KeyError, ValueError, TypeError):
+                E.warn("could not find the logs of %s" % job)
+
+            self.record(task, job,
+                        self.sample(job) if self.sample else None,
+                        started, options.get("job_threads", 1), usage,
+                        jobCounters(statement, since=started - 1))
+
+
+def summariseLedger(dbh):
+    '''return the latest run of each job, with the fraction of its
+    sample's wall and CPU time'''
+
+    import pandas as pd
+
+    df = pd.read_sql(
+        "SELECT * FROM run_ledger WHERE run_id IN "
+        "(SELECT MAX(run_id) FROM run_ledger GROUP BY task, job)", dbh)
+    df["sample"] = df["sample"].fillna("")
+
+    for column in ("wall_seconds", "cpu_seconds"):
+        total = df.groupby("sample")[column].transform("sum")
+        df["fraction_" + column] = (df[column] / total).where(total > 0)
+
+    return df.sort_values(["sample", "wall_seconds"],
+                          ascending=[True, False])
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--database", dest="database", type="string",
+                      help="pipeline database with the run ledger "
+                      "[%default]")
+
+    parser.add_option("--monitor-pid", dest="monitor_pid", type="int",
+                      help="monitor the resources used by this process "
+                      "and its descendants [%default]")
+
+    parser.add_option("--usage", dest="usage", type="string",
+                      help="file to write the monitored usage to "
+                      "[%default]")
+
+    parser.add_option("--scratch", dest="scratch", type="string",
+                      help="glob of the monitored job's temporary files "
+                      "[%default]")
+
+    parser.add_option("--interval", dest="interval", type="int",
+                      help="seconds between samples of the monitored "
+                      "job [%default]")
+
+    parser.set_defaults(
+        database=None,
+        monitor_pid=None,
+        usage=None,
+        scratch=None,
+        interval=5,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.monitor_pid is not None:
+        if not options.usage:
+            raise ValueError("--monitor-pid requires --usage")
+        monitor(options.monitor_pid, options.usage, options.scratch,
+                options.interval)
+
+    elif options.database:
+        dbh = sqlite3.connect(options.database)
+        summariseLedger(dbh).to_csv(options.stdout, sep="\t", index=False)
+        dbh.close()
+
+    else:
+        raise ValueError("--database or --monitor-pid is required")
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
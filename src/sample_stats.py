@@ -0,0 +1,297 @@
+'''
+sample_stats.py - collect the stats of a sample into a columnar dataset
+=======================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Convert the deduplication stats, whitelist and gene assignment outputs
+of a sample into parquet tables (requires ``pyarrow``), partitioned by
+sample, so the tables of all the samples can be read in one go rather
+than by globbing and parsing the outputs of each sample.
+
+Each table is written to ``<outdir>/<table>/sample=<sample>/part-0.parquet``
+along with the metadata of the sample from the sample_info file
+(version, n_cells, species, seq_sat and chem), so it needn't be joined
+by hand:
+
+summary
+   a row for the sample: the reads in and out of ``umi_tools dedup``
+   and the duplication rate, the number of whitelisted cells and their
+   reads, the error barcodes and reads corrected to them, and the
+   reads assigned to genes and the fraction of the assigned reads
+edit_distance, per_umi_per_position, per_umi
+   the ``umi_tools dedup --output-stats`` tables. The per_umi
+   ``approximate_medians`` column is True where the tables were merged
+   over contigs by parallel_dedup.py, in which case the
+   ``median_counts_*`` columns are approximate
+assignment
+   the reads by gene assignment status, from the featureCounts
+   summaries or gene_tagger.py logs (summed over the shards)
+whitelist
+   a row per whitelisted cell barcode: its count, the number of error
+   barcodes and the count of the error barcodes
+
+The tables for all the samples are then read with, e.g:
+
+.. code-block:: python
+
+   edit_distance = pd.read_parquet("stats.dir/edit_distance")
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python sample_stats.py --sample=pbmc4k --sample-info=sample_info
+   --dedup-log=mapped/pbmc4k_dedup.bam.log
+   --dedup-stats=mapped/pbmc4k_dedup.bam_stats
+   --whitelist=whitelist/10X_pbmc4k_whitelist.tsv
+   --assign-log=mapped/pbmc4k.bam.featureCounts.bam.txt.summary
+   --output-dir=stats.dir
+
+Command line options
+--------------------
+
+'''
+
+import collections
+import os
+import sys
+
+import pandas as pd
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+import parallel_dedup
+import run_ledger
+
+
+TABLES = ("summary", "edit_distance", "per_umi_per_position", "per_umi",
+          "assignment", "whitelist")
+
+# the sample_info columns, as named in the pipeline's TENX2INFO
+METADATA = (("version", str), ("n_cells", int), ("species", str),
+            ("seq_sat", float), ("chem", str))
+
+# the column types of the metadata, which may be missing
+_DTYPES = {str: object, int: "Int64", float: float}
+
+
+def readSampleInfo(sample_info):
+    '''return the metadata of each sample in `sample_info`'''
+
+    samples = {}
+    with IOTools.openFile(sample_info, "r") as inf:
+        next(inf)
+        for line in inf:
+            fields = line.strip().split(",")
+            samples[fields[0]] = collections.OrderedDict(
+                (name, convert(value) if value else None)
+                for (name, convert), value in zip(METADATA, fields[1:]))
+    return samples
+
+
+def readStatsTable(infile, key):
+    '''return an ``umi_tools dedup --output-stats`` table keyed on
+    `key`. The key is numeric unless it has non-numeric values (e.g
+    Single_UMI in the edit distances)'''
+
+    if not os.path.exists(infile) or os.path.getsize(infile) == 0:
+        return pd.DataFrame(columns=[key])
+
+    df = pd.read_csv(infile, sep="\t", dtype={key: str})
+    numeric = pd.to_numeric(df[key], errors="coerce")
+    if numeric.notnull().all():
+        df[key] = numeric
+    return df
+
+
+def readWhitelist(infile):
+    '''return the cell barcodes in a whitelist, their counts and the
+    number and counts of their error barcodes'''
+
+    rows = []
+    with IOTools.openFile(infile, "r") as inf:
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            barcode, errors, count = fields[:3]
+            error_counts = fields[3] if len(fields) > 3 else ""
+            rows.append((
+                barcode, int(count),
+                len(errors.split(",")) if errors else 0,
+                sum(int(x) for x in error_counts.split(",") if x)))
+
+    return pd.DataFrame(rows, columns=["barcode", "count", "error_barcodes",
+                                       "error_reads"])
+
+
+def readAssignment(logfiles):
+    '''return the reads by assignment status, summed over the
+    featureCounts summaries or gene_tagger.py logs in `logfiles`'''
+
+    counts = collections.OrderedDict()
+    for logfile in logfiles:
+        _, counters = run_ledger.parseLog(logfile)
+        for status, reads in counters.items():
+            counts[status] = counts.get(status, 0) + int(reads)
+
+    return pd.DataFrame(list(counts.items()), columns=["status", "reads"])
+
+
+def summarise(dedup_counts, whitelist, assignment):
+    '''return the summary row of a sample'''
+
+    input_reads = dedup_counts["input_reads"]
+    assigned = int(assignment.loc[
+        assignment["status"] == "assigned", "reads"].sum())
+    total = int(assignment["reads"].sum())
+
+    return pd.DataFrame([collections.OrderedDict((
+        ("input_reads", input_reads),
+        ("output_reads", dedup_counts["output_reads"]),
+        ("duplication_rate",
+         (input_reads - dedup_counts["output_reads"]) / float(input_reads)
+         if input_reads else None),
+        ("whitelist_cells", len(whitelist)),
+        ("whitelist_reads", int(whitelist["count"].sum())),
+        ("error_barcodes", int(whitelist["error_barcodes"].sum())),
+        ("error_reads", int(whitelist["error_reads"].sum())),
+        ("assigned_reads", assigned),
+        ("assigned_fraction", assigned / float(total) if total else None)))])
+
+
+def partitionFile(outdir, table, sample):
+    '''return the parquet file of `table` for `sample`'''
+
+    return os.path.join(outdir, table, "sample=%s" % sample,
+                        "part-0.parquet")
+
+
+def writePartition(df, outdir, table, sample, metadata):
+    '''write `df` with the sample `metadata` to the partition of
+    `sample` in `table`. The sample is in the partition's path, not
+    the file'''
+
+    df = df.copy()
+    for name, convert in METADATA:
+        df[name] = pd.Series([metadata.get(name)] * len(df), index=df.index,
+                             dtype=_DTYPES[convert])
+
+    outfile = partitionFile(outdir, table, sample)
+    if not os.path.exists(os.path.dirname(outfile)):
+        os.makedirs(os.path.dirname(outfile))
+
+    # the dataset may be read while it is written. Files starting with
+    # "_" aren't part of the dataset
+    tmpfile = os.path.join(os.path.dirname(outfile), "_%s.%i" % (
+        os.path.basename(outfile), os.getpid()))
+    df.to_parquet(tmpfile, index=False)
+    os.replace(tmpfile, outfile)
+
+
+def sampleStats(sample, metadata, dedup_log, dedup_stats, whitelist,
+                assign_logs, outdir):
+    '''write the tables of `sample` to `outdir`'''
+
+    tables = {}
+    for suffix, key in parallel_dedup.STATS_TABLES:
+        tables[suffix[1:-len(".tsv")]] = readStatsTable(
+            dedup_stats + suffix, key)
+
+    # the medians are exact unless merged by parallel_dedup.py
+    if "approximate_medians" not in tables["per_umi"].columns:
+        tables["per_umi"]["approximate_medians"] = False
+
+    tables["whitelist"] = readWhitelist(whitelist)
+    tables["assignment"] = readAssignment(assign_logs)
+    tables["summary"] = summarise(
+        parallel_dedup.readLogCounts(dedup_log), tables["whitelist"],
+        tables["assignment"])
+
+    for table in TABLES:
+        writePartition(tables[table], outdir, table, sample, metadata)
+
+    return tables["summary"]
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--sample", dest="sample", type="string",
+                      help="sample name [%default]")
+
+    parser.add_option("--sample-info", dest="sample_info", type="string",
+                      help="sample_info file with the sample metadata "
+                      "[%default]")
+
+    parser.add_option("--dedup-log", dest="dedup_log", type="string",
+                      help="umi_tools dedup or parallel_dedup.py log "
+                      "[%default]")
+
+    parser.add_option("--dedup-stats", dest="dedup_stats", type="string",
+                      help="--output-stats prefix of the deduplication "
+                      "[%default]")
+
+    parser.add_option("--whitelist", dest="whitelist", type="string",
+                      help="whitelist of the sample [%default]")
+
+    parser.add_option("--assign-log", dest="assign_logs", type="string",
+                      action="append",
+                      help="featureCounts summary or gene_tagger.py log "
+                      "of the gene assignment, can be given more than "
+                      "once [%default]")
+
+    parser.add_option("--output-dir", dest="outdir", type="string",
+                      help="directory of the dataset [%default]")
+
+    parser.set_defaults(
+        sample=None,
+        sample_info=None,
+        dedup_log=None,
+        dedup_stats=None,
+        whitelist=None,
+        assign_logs=[],
+        outdir="stats.dir",
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    required = ("sample", "sample_info", "dedup_log", "dedup_stats",
+                "whitelist")
+    if not all(getattr(options, x) for x in required):
+        raise ValueError("--%s are required" % ", --".join(
+            x.replace("_", "-") for x in required))
+
+    samples = readSampleInfo(options.sample_info)
+    if options.sample not in samples:
+        raise ValueError("%s is not in %s" % (
+            options.sample, options.sample_info))
+
+    summary = sampleStats(options.sample, samples[options.sample],
+                          options.dedup_log, options.dedup_stats,
+                          options.whitelist, options.assign_logs,
+                          options.outdir)
+
+    for column in summary.columns:
+        E.info("%s: %s" % (column, summary[column].iloc[0]))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
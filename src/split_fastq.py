@@ -0,0 +1,152 @@
+'''
+split_fastq.py - split a downloaded fastq into its lanes
+=========================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Split a gzipped fastq streamed from the members of a tar archive by
+download.py (e.g the lanes of a 10X sample) back into its members, so
+each lane can be processed as an independent shard.
+
+download.py appends each member to the fastq unchanged and records
+the byte range of each member in ``<fastq>.members``. As each member
+is a gzip file in its own right, the shards are copied from these
+byte ranges without being decompressed or recompressed. The read 1
+and read 2 members are written in the same order by download.py, so
+shard N of read 1 pairs with shard N of read 2.
+
+Usage
+-----
+
+.. code-block:: bash
+
+   python split_fastq.py --fastq=raw/10X_fastqs/pbmc8k.fastq.1.gz
+   --output-pattern=shards/pbmc8k/pbmc8k_shard%03i.fastq.1.gz
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+
+
+BLOCK_SIZE = 2 ** 20
+
+
+def readMembers(infile):
+    '''return the (member, offset, size) of each member of the fastq
+    `infile`, from the ``<infile>.members`` table written by
+    download.py'''
+
+    members_file = infile + ".members"
+    if not os.path.exists(members_file):
+        raise ValueError("%s has no members table, it should be "
+                         "downloaded with download.py --member" % infile)
+
+    members = []
+    with IOTools.openFile(members_file, "r") as inf:
+        next(inf)
+        for line in inf:
+            name, offset, size = line.rstrip("\n").split("\t")
+            members.append((name, int(offset), int(size)))
+    return members
+
+
+def _copyRange(inf, outf, offset, size):
+    '''copy `size` bytes from `offset` in `inf` to `outf`, within the
+    kernel where possible'''
+
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(inf.fileno(), outf.fileno(),
+                                   size - copied, offset + copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        inf.seek(offset + copied)
+        outf.seek(copied)
+        remaining = size - copied
+        while remaining > 0:
+            data = inf.read(min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            outf.write(data)
+            copied += len(data)
+            remaining -= len(data)
+
+    if copied != size:
+        raise ValueError("%s ends %i bytes into a member of %i bytes" % (
+            inf.name, copied, size))
+
+
+def splitFastq(infile, output_pattern):
+    '''write each member of `infile` to ``output_pattern % shard``
+    (shards numbered from 1).
+
+    Returns the output files.
+    '''
+
+    members = readMembers(infile)
+
+    outfiles = []
+    with open(infile, "rb") as inf:
+        for ix, (name, offset, size) in enumerate(members):
+            outfiles.append(output_pattern % (ix + 1))
+            with open(outfiles[-1], "wb") as outf:
+                _copyRange(inf, outf, offset, size)
+            E.debug("wrote %s to %s" % (name, outfiles[-1]))
+
+    return outfiles
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-i", "--fastq", dest="fastq", type="string",
+                      help="fastq to split [%default]")
+
+    parser.add_option("--output-pattern", dest="output_pattern",
+                      type="string",
+                      help="output file pattern, with a %i for the shard "
+                      "number [%default]")
+
+    parser.set_defaults(
+        fastq=None,
+        output_pattern=None,
+    )
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.fastq or not options.output_pattern:
+        raise ValueError("--fastq and --output-pattern are required")
+
+    outfiles = splitFastq(options.fastq, options.output_pattern)
+
+    E.info("split %s into %i shards" % (options.fastq, len(outfiles)))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,338 @@
+'''
+task_cache.py - content and parameter keyed task caching for ruffus
+====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Decide whether a ruffus job needs to be rerun from the content of its
+inputs, the pipeline parameters it uses and its code, rather than from
+the file timestamps.
+
+Each job has a key made from:
+
+* the content hash of each input file
+* any other job parameters
+* the code of the task, and of the functions in the pipeline module
+  it calls (e.g the statement builders), ignoring comments and
+  formatting
+* the values of the PARAMS the code refers to, either as a string
+  (``PARAMS["align_threads"]``) or in a statement (``%(align_threads)s``),
+  other than the resource PARAMS
+* the values of any other module level data the code refers to (e.g
+  ``TENX2INFO``)
+
+Assignments to ``job_`` variables (``job_threads``, ``job_memory``
+etc.) are left out of the code, and the PARAMS matching the
+`resources` patterns (by default ``*_threads``, ``*_memory`` and
+``*_tmpdir``) are left out of the key, as the resources a job is given
+don't change its outputs. Tuning the threads or memory of the
+alignment therefore doesn't rerun it.
+
+When a job completes, its key and the content hashes of its outputs
+are recorded in `cache_dir`. The job is up to date while its outputs
+still have these hashes and its key is unchanged, so touching a file,
+or changing a parameter a task doesn't use, doesn't rerun it.
+
+Content hashes are cached in `cache_dir` by path, size and
+modification time, so a file is only read again when it changes. A
+file with a ``<file>.md5`` checksum newer than itself (see download.py)
+isn't read at all. Files zapped with :meth:`TaskCache.zapFile` keep
+the hash of their content before they were zapped, so the job which
+made them is still up to date and the jobs using them see the same
+input.
+
+Jobs completed before the cache was used are recorded the first time
+they are checked if their outputs are newer than their inputs, as per
+the ruffus timestamp check, so enabling the cache doesn't rerun them.
+
+The cache applies to tasks whose jobs take (inputs, outputs, extras)
+parameters, i.e not @originate tasks.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import task_cache
+
+   CACHE = task_cache.TaskCache("task_cache.dir", PARAMS)
+
+   @transform(Extract10X, suffix(".fastq"), ".bam")
+   @CACHE.cached
+   def AlignToHumanMouse(infile, outfile):
+       ...
+       CACHE.zapFile(infile)
+
+'''
+
+import ast
+import fnmatch
+import functools
+import hashlib
+import inspect
+import os
+import re
+import textwrap
+
+from ruffus import check_if_uptodate
+
+import CGAT.IOTools as IOTools
+
+import file_hashes
+
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+# module level data which is part of the key if a task refers to it
+_DATA_TYPES = (str, int, float, bool, dict, list, tuple, set, frozenset)
+
+# the PARAMS which only set the resources of a job
+RESOURCE_PARAMS = ("*_threads", "*_memory", "*_tmpdir")
+
+
+def _flatten(files):
+    '''iterate over the file names in nested lists/tuples of `files`'''
+
+    if isinstance(files, str):
+        yield files
+    elif isinstance(files, (list, tuple)):
+        for item in files:
+            for filename in _flatten(item):
+                yield filename
+
+
+class _DropJobResources(ast.NodeTransformer):
+    '''remove the assignments to job_ variables'''
+
+    def visit_Assign(self, node):
+        if all(isinstance(x, ast.Name) and x.id.startswith("job_")
+               for x in node.targets):
+            return None
+        return node
+
+
+class TaskCache(object):
+    '''decide whether ruffus jobs are up to date from the hashes of
+    their inputs, parameters and code'''
+
+    def __init__(self, cache_dir, params, enabled=True,
+                 resources=RESOURCE_PARAMS):
+        self.cache_dir = cache_dir
+        self.params = params
+        self.enabled = enabled
+        self.resources = resources
+        self._hashes = None
+        self._code = {}
+
+    @property
+    def hashes(self):
+        if self._hashes is None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self._hashes = file_hashes.FileHashes(
+                os.path.join(self.cache_dir, "file_hashes.tsv"))
+        return self._hashes
+
+    def _functionBody(self, func):
+        '''return the AST of the body of `func`, without its decorators
+        or job resources'''
+
+        tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+        node = tree.body[0]
+        node.decorator_list = []
+        return _DropJobResources().visit(node)
+
+    def isResource(self, key):
+        '''return whether the PARAMS `key` only sets the resources of
+        a job, so isn't part of the key'''
+        return any(fnmatch.fnmatchcase(key, x) for x in self.resources)
+
+    def codeKey(self, func):
+        '''return the hash of the code of `func` and the functions in
+        its module it calls, and of the parameters and module data
+        they refer to'''
+
+        name = func.__name__
+        if name in self._code:
+            return self._code[name]
+
+        module_globals = func.__globals__
+        seen = set()
+        pending = [func]
+        code = []
+        strings = set()
+        data_names = set()
+
+        while pending:
+            function = pending.pop()
+            if function.__name__ in seen:
+                continue
+            seen.add(function.__name__)
+
+            node = self._functionBody(function)
+            code.append(ast.dump(node))
+
+            for child in ast.walk(node):
+                if isinstance(child, ast.Constant) and isinstance(
+                        child.value, str):
+                    strings.add(child.value)
+                    strings.update(_PLACEHOLDER.findall(child.value))
+                elif isinstance(child, ast.Name):
+                    value = module_globals.get(child.id)
+                    if value is None or value is self.params:
+                        continue
+                    if inspect.isfunction(value):
+                        if value.__module__ == func.__module__:
+                            pending.append(inspect.unwrap(value))
+                    elif isinstance(value, _DATA_TYPES):
+                        data_names.add(child.id)
+
+        digest = hashlib.sha1()
+        for item in sorted(code):
+            digest.update(item.encode())
+        for key in sorted(strings):
+            if key in self.params and not self.isResource(key):
+                digest.update(("%s=%r" % (key, self.params[key])).encode())
+        for data_name in sorted(data_names):
+            digest.update(("%s=%s" % (
+                data_name, _reprData(module_globals[data_name]))).encode())
+
+        self._code[name] = digest.hexdigest()
+        return self._code[name]
+
+    def jobKey(self, func, args):
+        '''return the key of the job with parameters `args`'''
+
+        digest = hashlib.sha1()
+        digest.update(func.__name__.encode())
+        digest.update(self.codeKey(func).encode())
+
+        for filename in _flatten(args[0]):
+            if os.path.exists(filename):
+                digest.update(("%s=%s" % (
+                    filename, self.hashes.get(filename))).encode())
+            else:
+                digest.update(filename.encode())
+
+        digest.update(repr(args[2:]).encode())
+
+        return digest.hexdigest()
+
+    def _recordFile(self, func, outputs):
+        name = hashlib.sha1("\t".join(outputs).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "tasks",
+                            "%s_%s.tsv" % (func.__name__, name))
+
+    def _readRecord(self, func, outputs):
+        '''return the recorded key and output hashes for the job'''
+
+        record_file = self._recordFile(func, outputs)
+        if not os.path.exists(record_file):
+            return None, None
+
+        key = None
+        output_hashes = {}
+        with open(record_file) as inf:
+            for line in inf:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] == "key":
+                    key = fields[1]
+                elif fields[0] == "output":
+                    output_hashes[fields[1]] = fields[2]
+
+        return key, output_hashes
+
+    def _writeRecord(self, func, outputs, key):
+        record_file = self._recordFile(func, outputs)
+        if not os.path.exists(os.path.dirname(record_file)):
+            os.makedirs(os.path.dirname(record_file))
+
+        tmpfile = "%s.%i" % (record_file, os.getpid())
+        with open(tmpfile, "w") as outf:
+            outf.write("key\t%s\n" % key)
+            for output in outputs:
+                outf.write("output\t%s\t%s\n" % (
+                    output, self.hashes.get(output)))
+        os.replace(tmpfile, record_file)
+
+    def isUpToDate(self, func, args):
+        '''ruffus check_if_uptodate function: returns whether the job
+        needs to be run and why'''
+
+        inputs = list(_flatten(args[0]))
+        outputs = list(_flatten(args[1]))
+
+        missing = [x for x in outputs if not os.path.exists(x)]
+        if missing:
+            return True, "missing outputs: %s" % ",".join(missing)
+
+        key, output_hashes = self._readRecord(func, outputs)
+
+        if key is None:
+            # outputs made before the cache was used
+            existing = [x for x in inputs if os.path.exists(x)]
+            if not existing or (
+                    min(os.path.getmtime(x) for x in outputs) >=
+                    max(os.path.getmtime(x) for x in existing)):
+                self._writeRecord(func, outputs, self.jobKey(func, args))
+                return False, "outputs newer than inputs, now cached"
+            return True, "no cache record"
+
+        for output in outputs:
+            if output_hashes.get(output) != self.hashes.get(output):
+                return True, "output changed: %s" % output
+
+        if key != self.jobKey(func, args):
+            return True, "inputs, parameters or code changed"
+
+        return False, "cached"
+
+    def cached(self, func):
+        '''decorator for the task function, inside the ruffus decorators,
+        which checks whether its jobs are up to date with
+        :meth:`isUpToDate` and records them when they complete'''
+
+        if not self.enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            # the key is made before the job can zap its inputs
+            key = self.jobKey(func, args)
+            result = func(*args)
+            self._writeRecord(func, list(_flatten(args[1])), key)
+            return result
+
+        def check(*args):
+            return self.isUpToDate(func, args)
+
+        return check_if_uptodate(check)(wrapper)
+
+    def zapFile(self, filename):
+        '''zap `filename`, keeping its hash so it can still be used to
+        decide whether jobs are up to date'''
+
+        if self.enabled:
+            self.hashes.zap(filename)
+        else:
+            IOTools.zapFile(filename)
+
+
+def _reprData(value):
+    '''return a repr of `value` which doesn't depend on dict order'''
+
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(
+            "%r: %s" % (key, _reprData(value[key]))
+            for key in sorted(value, key=repr))
+    elif isinstance(value, (set, frozenset)):
+        return "{%s}" % ", ".join(sorted(_reprData(x) for x in value))
+    elif isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(_reprData(x) for x in value)
+    return repr(value)
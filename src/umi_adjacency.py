@@ -0,0 +1,230 @@
+'''
+umi_adjacency.py - build UMI/barcode adjacency without pairwise comparisons
+============================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Identify all pairs of UMIs (or cell barcodes) within a hamming
+distance threshold. This replaces the ``itertools.combinations`` scan
+in ``get_adj_list_adjacency`` (see
+notebooks/adj_list_memory_usage.ipynb), which is quadratic in the
+number of UMIs.
+
+Sequences are packed into integers with :mod:`barcode_codec`. For a
+threshold of ``t``, every combination of ``t`` positions is masked in
+turn and the sequences are sorted by their masked value. Two sequences
+within ``t`` mismatches share a masked value for at least one
+combination of positions, and sequences sharing a masked value are
+adjacent in the sorted order, so neighbours can be read off with array
+operations. Each pair is only reported for a single (canonical)
+combination of positions so no de-duplication of the pairs is
+required.
+
+The run time is O(C(L, t) * n log n) for n sequences of length L and
+the adjacency is returned as compressed sparse row (CSR) arrays of
+sequence indices, rather than a dictionary of lists of sequences.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import umi_adjacency
+
+   umis = [b"ATAT", b"ATAC", b"GGGG"]
+   indptr, indices = umi_adjacency.getAdjacency(umis, threshold=1)
+   adj_list = umi_adjacency.toAdjList(umis, indptr, indices)
+
+'''
+
+import itertools
+
+import numpy as np
+
+import barcode_codec
+
+
+def _positionMask(positions, length, lanes_only=False):
+    '''return the bits of a :mod:`barcode_codec` code holding
+    `positions`, including the N mask. If `lanes_only`, only the lowest
+    base bit of each position is set'''
+
+    mask = 0
+    for position in positions:
+        shift = length - 1 - position
+        if lanes_only:
+            mask |= 1 << (2 * shift)
+        else:
+            mask |= 3 << (2 * shift)
+            if length <= barcode_codec.MAX_LENGTH_N:
+                mask |= 1 << (2 * length + shift)
+    return mask
+
+
+def _spread(values):
+    '''move bit k to bit 2k for an array of values below 2^32'''
+
+    for shift, mask in ((16, 0x0000FFFF0000FFFF),
+                        (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def _mismatchLanes(codes1, codes2, length):
+    '''return the mismatched positions between two arrays of codes,
+    with the lowest base bit of each mismatched position set'''
+
+    bases1, n_mask1 = barcode_codec.splitN(codes1, length)
+    bases2, n_mask2 = barcode_codec.splitN(codes2, length)
+
+    diff = bases1 ^ bases2
+    lanes = (diff | (diff >> np.uint64(1))) | _spread(n_mask1 ^ n_mask2)
+    return lanes & np.uint64(_positionMask(range(length), length, True))
+
+
+def _canonicalLanes(lanes, threshold, length):
+    '''return the canonical combination of masked positions for pairs
+    with mismatches at `lanes`: the mismatched positions plus the
+    first unmismatched positions up to `threshold` positions'''
+
+    all_lanes = np.uint64(_positionMask(range(length), length, True))
+    n_mismatches = barcode_codec.popcount(lanes)
+    canonical = lanes.copy()
+
+    for n in range(threshold):
+        free = all_lanes & ~canonical
+        # the most significant free lane is the first position
+        top = np.zeros_like(free)
+        for position in range(length - 1, -1, -1):
+            lane = np.uint64(_positionMask([position], length, True))
+            top = np.where(free & lane, lane, top)
+        canonical = np.where(n_mismatches + np.uint64(n) < threshold,
+                             canonical | top, canonical)
+
+    return canonical
+
+
+def getAdjacentPairs(codes, length, threshold=1):
+    '''identify all pairs of :mod:`barcode_codec` `codes` for
+    sequences of `length` within `threshold` mismatches.
+
+    Returns two arrays of indices into `codes` (first < second is not
+    guaranteed). Each pair is reported once.
+    '''
+
+    first = []
+    second = []
+
+    if len(codes) < 2 or length == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+
+    codes = np.asarray(codes, dtype=np.uint64)
+    threshold = min(threshold, length)
+    all_positions = range(length)
+
+    for masked in itertools.combinations(all_positions, threshold):
+        keep = np.uint64(
+            _positionMask(set(all_positions).difference(masked), length))
+        masked_lanes = np.uint64(_positionMask(masked, length, True))
+
+        keys = codes & keep
+        order = np.argsort(keys, kind="mergesort")
+        sorted_keys = keys[order]
+
+        offset = 1
+        while offset < len(codes):
+            same = sorted_keys[:-offset] == sorted_keys[offset:]
+            if not same.any():
+                break
+
+            ix1 = order[:-offset][same]
+            ix2 = order[offset:][same]
+
+            # only report each pair for its canonical masked positions.
+            # Pairs with `threshold` mismatches share a single masked value
+            lanes = _mismatchLanes(codes[ix1], codes[ix2], length)
+            report = barcode_codec.popcount(lanes) == threshold
+            fewer = ~report
+            if fewer.any():
+                canonical = _canonicalLanes(lanes[fewer], threshold, length)
+                report[fewer] = canonical == masked_lanes
+
+            first.append(ix1[report])
+            second.append(ix2[report])
+            offset += 1
+
+    if not first:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def pairsToCSR(first, second, n):
+    '''convert undirected pairs of indices to CSR (indptr, indices)
+    arrays for `n` nodes'''
+
+    rows = np.concatenate([first, second]).astype(np.int64)
+    cols = np.concatenate([second, first]).astype(np.int64)
+
+    # sorting a single combined key is much faster than a lexsort
+    keys = np.sort(rows * n + cols)
+    indices = (keys % n).astype(np.int32)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=n))
+
+    return indptr, indices
+
+
+def getAdjacency(umis, threshold=1):
+    '''identify all `umis` within hamming distance `threshold` of each
+    other. `umis` must be unique and of equal length.
+
+    Returns CSR arrays (indptr, indices) where the neighbours of
+    ``umis[i]`` are ``umis[j] for j in indices[indptr[i]:indptr[i+1]]``
+    '''
+
+    umis = list(umis)
+    length = len(umis[0]) if umis else 0
+
+    if any(len(x) != length for x in umis):
+        raise ValueError("all sequences must be the same length")
+
+    codes, valid = barcode_codec.encode(umis, length)
+
+    if not valid.all():
+        raise ValueError("sequences may only contain A, C, G, T and N")
+
+    if len(np.unique(codes)) != len(codes):
+        raise ValueError("UMIs must be unique")
+
+    first, second = getAdjacentPairs(codes, length, threshold)
+
+    return pairsToCSR(first, second, len(umis))
+
+
+def toAdjList(umis, indptr, indices):
+    '''convert CSR adjacency to the umi_tools style adjacency list, a
+    dictionary mapping each UMI to a list of its neighbours'''
+
+    umis = list(umis)
+    return {umi: [umis[ix] for ix in indices[indptr[n]:indptr[n + 1]]]
+            for n, umi in enumerate(umis)}
+
+
+def get_adj_list_adjacency(umis, threshold=1):
+    ''' identify all umis within hamming distance threshold'''
+
+    umis = list(umis)
+    indptr, indices = getAdjacency(umis, threshold)
+    return toAdjList(umis, indptr, indices)
@@ -0,0 +1,283 @@
+'''
+whitelist_index.py - error correct cell barcodes against a whitelist
+=====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Correct cell barcodes which are a single error away from a
+whitelisted barcode. This replaces ``checkError`` in the
+Find_the_ambinet and Learning_real_CBs notebooks, which compiles a
+fuzzy regex per candidate barcode and tests it against every
+whitelisted barcode.
+
+Instead, every barcode one error away from a whitelisted barcode is
+generated once, up front, and stored as a sorted array of 2-bit
+packed keys with an aligned array of the whitelisted barcode each
+key corrects to. Keys which are one error away from more than one
+whitelisted barcode are flagged as ambiguous. Queries are then a
+binary search per barcode and can be made in batches.
+
+The errors considered are those accepted by the notebooks' anchored
+``regex.compile("(%s){e<=1}" % barcode).match`` of the whitelisted
+barcodes: substitutions and, optionally, a base of the barcode deleted
+(the base shifted into the end of the whitelisted barcode may be any
+base). Note this is not symmetric: a barcode with a base inserted
+relative to the whitelisted barcode is not corrected. Barcodes
+containing a single N are corrected by testing the four possible bases
+against the whitelist.
+
+Usage
+-----
+
+.. code-block:: python
+
+   import whitelist_index
+
+   index = whitelist_index.WhitelistIndex.fromFile("whitelist.tsv")
+   true_barcodes, status = index.correct(["AAAACCCCGGGGTTTN"])
+
+'''
+
+import numpy as np
+
+import CGAT.IOTools as IOTools
+
+import barcode_codec
+
+
+# query status codes
+EXACT = 0
+CORRECTED = 1
+AMBIGUOUS = 2
+NO_MATCH = 3
+
+STATUS2NAME = {EXACT: "exact",
+               CORRECTED: "corrected",
+               AMBIGUOUS: "ambiguous",
+               NO_MATCH: "no_match"}
+
+_AMBIGUOUS_TARGET = -1
+
+
+def _encode(barcodes, length):
+    '''pack `barcodes` with :mod:`barcode_codec`.
+
+    Returns the 2-bit codes (Ns encoded as A), a boolean array
+    flagging barcodes which could be encoded, the number of Ns in each
+    barcode and the N mask.
+    '''
+
+    codes, valid = barcode_codec.encode(barcodes, length)
+    bases, n_mask = barcode_codec.splitN(codes, length)
+
+    return bases, valid, barcode_codec.popcount(n_mask), n_mask
+
+
+def _variants(codes, length, insertions=False, deletions=False):
+    '''generate all codes one error away from each of `codes`.
+
+    Substitutions are always generated. With `insertions`, a base
+    is inserted and the last base lost. With `deletions`, a base is
+    deleted and any base enters at the end.
+
+    Returns the variant codes and the index of the code each was
+    derived from.
+    '''
+
+    two = np.uint64(2)
+    full = np.uint64((1 << (2 * length)) - 1)
+    sources = np.arange(len(codes), dtype=np.int32)
+
+    variants = []
+    targets = []
+
+    for position in range(length):
+        shift = np.uint64(2 * (length - 1 - position))
+
+        # XOR with a non-zero 2-bit value gives each other base
+        for delta in range(1, 4):
+            variants.append(codes ^ (np.uint64(delta) << shift))
+            targets.append(sources)
+
+        if not (insertions or deletions):
+            continue
+
+        # bases before `position` are unchanged by an indel here
+        head_mask = np.uint64(~((1 << (2 * (length - position))) - 1) &
+                              ((1 << (2 * length)) - 1))
+        tail_mask = np.uint64((1 << (2 * (length - position))) - 1)
+        head = codes & head_mask
+        tail = codes & tail_mask
+
+        for base in range(4):
+            base = np.uint64(base)
+
+            # deletion: tail shifts left, any base enters at the end
+            if deletions:
+                deletion = head | (((tail << two) & tail_mask) | base)
+                variants.append(deletion & full)
+                targets.append(sources)
+
+            # insertion: base inserted, tail shifts right, last base lost
+            if insertions:
+                insertion = head | (base << shift) | (tail >> two)
+                variants.append(insertion & full)
+                targets.append(sources)
+
+    return np.concatenate(variants), np.concatenate(targets)
+
+
+class WhitelistIndex(object):
+    '''index of barcodes one error from a set of whitelisted barcodes.
+
+    Build once from the whitelist then query with :meth:`correct`.
+    '''
+
+    def __init__(self, whitelist, indels=True):
+
+        self.whitelist = [x.decode() if isinstance(x, bytes) else x
+                          for x in whitelist]
+
+        if len(self.whitelist) == 0:
+            raise ValueError("whitelist is empty")
+
+        self.length = len(self.whitelist[0])
+        if self.length > 32:
+            raise ValueError("barcodes longer than 32bp can't be packed")
+
+        codes, valid, n_count, _ = _encode(self.whitelist, self.length)
+        if not valid.all() or n_count.any():
+            raise ValueError(
+                "whitelisted barcodes must all be the same length and "
+                "only contain A, C, G & T")
+
+        order = np.argsort(codes)
+        self.exact_keys = codes[order]
+        self.exact_targets = order.astype(np.int32)
+
+        if len(np.unique(self.exact_keys)) != len(self.exact_keys):
+            raise ValueError("whitelist contains duplicate barcodes")
+
+        # a query matches a whitelisted barcode with a deletion in the
+        # query, i.e. the query is the barcode with a base inserted
+        keys, targets = _variants(codes, self.length, insertions=indels)
+
+        # whitelisted barcodes are always exact matches
+        keep = ~np.isin(keys, self.exact_keys)
+        keys = keys[keep]
+        targets = targets[keep]
+
+        order = np.argsort(keys, kind="mergesort")
+        keys = keys[order]
+        targets = targets[order]
+
+        self.keys, starts = np.unique(keys, return_index=True)
+        lowest = np.minimum.reduceat(targets, starts)
+        highest = np.maximum.reduceat(targets, starts)
+        self.targets = np.where(
+            lowest == highest, lowest, _AMBIGUOUS_TARGET).astype(np.int32)
+
+    @classmethod
+    def fromFile(cls, infile, indels=True):
+        '''build the index from a ``umi_tools whitelist`` output file'''
+
+        with IOTools.openFile(infile, "r") as inf:
+            whitelist = [line.split("\t")[0].strip() for line in inf
+                         if not line.startswith("#") and line.strip()]
+
+        return cls(whitelist, indels=indels)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def _lookup(keys, targets, query):
+        '''return the target for each `query` code, -2 if absent'''
+
+        ix = np.searchsorted(keys, query)
+        ix = np.minimum(ix, len(keys) - 1)
+        found = keys[ix] == query
+        return np.where(found, targets[ix], -2)
+
+    def correctIndices(self, barcodes):
+        '''error correct `barcodes`.
+
+        Returns an array of indices into the whitelist (-1 where
+        there is no unique match) and an array of status codes
+        (EXACT, CORRECTED, AMBIGUOUS or NO_MATCH).
+        '''
+
+        codes, valid, n_count, n_mask = _encode(barcodes, self.length)
+
+        result = np.full(len(codes), -1, dtype=np.int32)
+        status = np.full(len(codes), NO_MATCH, dtype=np.int8)
+
+        # barcodes without Ns: exact match, then the error index
+        clean = valid & (n_count == 0)
+        exact = self._lookup(self.exact_keys, self.exact_targets,
+                             codes[clean])
+        error = self._lookup(self.keys, self.targets, codes[clean])
+
+        clean_status = np.select(
+            [exact >= 0, error >= 0, error == _AMBIGUOUS_TARGET],
+            [EXACT, CORRECTED, AMBIGUOUS], NO_MATCH)
+        result[clean] = np.where(exact >= 0, exact, np.maximum(error, -1))
+        status[clean] = clean_status
+
+        # barcodes with a single N: try each base in its place
+        single_n = valid & (n_count == 1)
+        if single_n.any():
+            # an N at bit k of the N mask is at bits 2k and 2k+1 of the code
+            shifts = (2 * np.log2(n_mask[single_n])).astype(np.uint64)
+            hits = np.stack(
+                [self._lookup(self.exact_keys, self.exact_targets,
+                              codes[single_n] | (np.uint64(base) << shifts))
+                 for base in range(4)], axis=1)
+            n_hits = (hits >= 0).sum(axis=1)
+
+            result[single_n] = np.where(n_hits == 1, hits.max(axis=1), -1)
+            status[single_n] = np.select(
+                [n_hits == 1, n_hits > 1], [CORRECTED, AMBIGUOUS], NO_MATCH)
+
+        return result, status
+
+    def correct(self, barcodes):
+        '''error correct `barcodes`.
+
+        Returns a list of the whitelisted barcode for each query (None
+        where there is no unique match) and an array of status codes.
+        '''
+
+        indices, status = self.correctIndices(barcodes)
+        return ([self.whitelist[ix] if ix >= 0 else None for ix in indices],
+                status)
+
+    def checkError(self, barcode):
+        '''return the set of whitelisted barcodes one error from
+        `barcode`, excluding `barcode` itself.
+
+        As per ``checkError`` in the notebooks, this is the set of
+        whitelisted barcodes matched by
+        ``regex.compile("(%s){e<=1}" % barcode).match``, without
+        stopping at the second match.
+        '''
+
+        codes, valid, n_count, _ = _encode([barcode], self.length)
+        if not valid[0] or n_count[0] > 0:
+            return set()
+
+        # the anchored regex matches a substitution, or a prefix of the
+        # whitelisted barcode with a base of `barcode` deleted, so the
+        # matches are the whitelisted barcodes among these variants
+        variants, _ = _variants(codes, self.length, deletions=True)
+        hits = self._lookup(self.exact_keys, self.exact_targets,
+                            np.unique(variants))
+
+        return set(self.whitelist[ix] for ix in hits[hits >= 0]
+                   if self.whitelist[ix] != barcode)
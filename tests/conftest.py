@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the pipeline's modules are scripts in src/ rather than a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,62 @@
+'''tests for the barcode_codec.py count tables'''
+
+import collections
+
+import numpy as np
+import pytest
+
+import barcode_codec
+
+
+@pytest.mark.parametrize("dtype", [np.uint32, np.uint64])
+def test_count_tables(dtype):
+    '''the tables match a Counter over many flushes of a small buffer,
+    with keys whose big-endian bytes end in zeros'''
+
+    rng = np.random.default_rng(0)
+    pairs = barcode_codec.PairCountTable(dtype, dtype, buffer_size=50)
+    singles = barcode_codec.CountTable(dtype, buffer_size=50)
+    expected_pairs = collections.Counter()
+    expected_singles = collections.Counter()
+
+    for ix in range(300):
+        keys1 = rng.integers(0, 30, rng.integers(0, 40)).astype(dtype)
+        keys2 = (rng.integers(0, 7, len(keys1)) << 24).astype(dtype)
+
+        if ix % 3:
+            pairs.update(keys1, keys2)
+            singles.update(keys1)
+        else:
+            for key1, key2 in zip(keys1.tolist(), keys2.tolist()):
+                pairs.add(key1, key2)
+                singles.add(key1)
+
+        expected_pairs.update(zip(keys1.tolist(), keys2.tolist()))
+        expected_singles.update(keys1.tolist())
+
+        # reading the tables part way through merges the runs
+        if ix % 100 == 0:
+            assert len(pairs) == len(expected_pairs)
+            assert len(singles) == len(expected_singles)
+
+    keys1, keys2 = pairs.keys
+    assert list(zip(zip(keys1.tolist(), keys2.tolist()),
+                    pairs.counts.tolist())) == sorted(expected_pairs.items())
+    assert list(zip(singles.keys.tolist(), singles.counts.tolist())) == \
+        sorted(expected_singles.items())
+
+
+def test_runs_are_tiered():
+    '''flushing the buffer doesn't re-sort the whole table: the runs
+    stay few and of decreasing size'''
+
+    table = barcode_codec.CountTable(buffer_size=100)
+    for ix in range(64):
+        table.update(np.arange(ix * 100, (ix + 1) * 100))
+
+        sizes = [len(x[0]) for x in table._runs]
+        assert len(table._keys) == 0
+        assert sizes == sorted(sizes, reverse=True)
+        assert len(sizes) <= 2 * np.log2(ix + 2)
+
+    assert len(table) == 6400
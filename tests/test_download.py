@@ -0,0 +1,248 @@
+'''tests for download.py against a local HTTP server'''
+
+import gzip
+import hashlib
+import http.server
+import io
+import os
+import re
+import tarfile
+import threading
+
+import numpy as np
+import pytest
+
+import download
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''serve the in-memory files of the server, with byte ranges if the
+    server's `ranges` is set'''
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body):
+        server = self.server
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+
+        match = re.match(r"bytes=(\d+)-(\d*)$",
+                         self.headers.get("Range", ""))
+        if server.ranges and match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            server.requests.append((start, end))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (
+                start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            if body:
+                server.requests.append((0, len(data) - 1))
+            self.send_response(200)
+
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.files = {}
+    httpd.ranges = True
+    httpd.requests = []
+    httpd.url = "http://127.0.0.1:%i" % httpd.server_address[1]
+
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def randomBytes(size, seed=0):
+    return np.random.default_rng(seed).bytes(size)
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def readChecksum(outfile):
+    with open(outfile + ".md5") as inf:
+        return inf.read().split()[0]
+
+
+def test_parallel_chunks(server, tmpdir):
+    data = randomBytes(10 * 4096 + 100)
+    server.files["/data.bin"] = data
+    outfile = str(tmpdir.join("data.bin"))
+
+    checksum = download.downloadFile(server.url + "/data.bin", outfile,
+                                     threads=4, chunk_size=4096,
+                                     md5=md5(data))
+
+    with open(outfile, "rb") as inf:
+        assert inf.read() == data
+    assert checksum == md5(data)
+    assert readChecksum(outfile) == md5(data)
+    assert sorted(server.requests) == [
+        (start, min(start + 4096, len(data)) - 1)
+        for start in range(0, len(data), 4096)]
+    assert not os.path.exists(outfile + ".part")
+    assert not os.path.exists(outfile + ".part.chunks")
+
+
+def test_resume_chunks(server, tmpdir):
+    data = randomBytes(8 * 4096, seed=1)
+    server.files["/data.bin"] = data
+    outfile = str(tmpdir.join("data.bin"))
+
+    # an interrupted download with chunks 0, 2 and 5 complete
+    done = (0, 2, 5)
+    with open(outfile + ".part", "wb") as outf:
+        outf.write(b"\0" * len(data))
+        for ix in done:
+            outf.seek(ix * 4096)
+            outf.write(data[ix * 4096:(ix + 1) * 4096])
+    with open(outfile + ".part.chunks", "w") as outf:
+        outf.write("%i\n%i\n" % (len(data), 4096))
+        outf.write("".join("%i\n" % ix for ix in done))
+
+    download.downloadFile(server.url + "/data.bin", outfile, threads=2,
+                          chunk_size=4096)
+
+    with open(outfile, "rb") as inf:
+        assert inf.read() == data
+    assert sorted(start // 4096 for start, end in server.requests) == [
+        ix for ix in range(8) if ix not in done]
+
+
+def test_resume_other_chunk_size(server, tmpdir):
+    data = randomBytes(4 * 4096, seed=2)
+    server.files["/data.bin"] = data
+    outfile = str(tmpdir.join("data.bin"))
+
+    # chunks recorded with a different chunk size aren't re-used
+    with open(outfile + ".part", "wb") as outf:
+        outf.write(b"\0" * len(data))
+    with open(outfile + ".part.chunks", "w") as outf:
+        outf.write("%i\n%i\n0\n1\n" % (len(data), 8192))
+
+    download.downloadFile(server.url + "/data.bin", outfile, threads=2,
+                          chunk_size=4096)
+
+    with open(outfile, "rb") as inf:
+        assert inf.read() == data
+    assert len(server.requests) == 4
+
+
+def test_single_stream(server, tmpdir):
+    data = randomBytes(3 * 4096, seed=3)
+    server.files["/data.bin"] = data
+    server.ranges = False
+    outfile = str(tmpdir.join("data.bin"))
+
+    download.downloadFile(server.url + "/data.bin", outfile, threads=4,
+                          chunk_size=4096)
+
+    with open(outfile, "rb") as inf:
+        assert inf.read() == data
+    assert server.requests == [(0, len(data) - 1)]
+
+
+def test_md5_mismatch(server, tmpdir):
+    data = randomBytes(2 * 4096, seed=4)
+    server.files["/data.bin"] = data
+    outfile = str(tmpdir.join("data.bin"))
+
+    with pytest.raises(ValueError, match="md5 checksum"):
+        download.downloadFile(server.url + "/data.bin", outfile, threads=2,
+                              chunk_size=4096, md5="0" * 32)
+
+    assert not os.path.exists(outfile)
+    assert not os.path.exists(outfile + ".md5")
+    assert not os.path.exists(outfile + ".part")
+
+
+def makeTar(lanes=3):
+    '''return a tar of gzipped read 1 and read 2 fastqs for each lane,
+    and the members'''
+
+    members = {}
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for lane in range(1, lanes + 1):
+            for read in (1, 2):
+                name = "fastqs/sample_S1_L%03i_R%i_001.fastq.gz" % (
+                    lane, read)
+                members[name] = gzip.compress(
+                    ("@r%i:%i\nACGT\n+\nIIII\n" % (lane, read) *
+                     (100 * lane)).encode())
+                info = tarfile.TarInfo(name)
+                info.size = len(members[name])
+                tar.addfile(info, io.BytesIO(members[name]))
+    return buf.getvalue(), members
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_tar_members(server, tmpdir, stream):
+    tar, members = makeTar()
+    server.files["/fastqs.tar"] = tar
+
+    outfiles = [str(tmpdir.join("sample.fastq.%i.gz" % read))
+                for read in (1, 2)]
+    written = download.downloadTarMembers(
+        server.url + "/fastqs.tar",
+        [("*_R%i_001.fastq.gz" % read, outfile)
+         for read, outfile in zip((1, 2), outfiles)],
+        tar_file=str(tmpdir.join("fastqs.tar")), stream=stream,
+        md5=md5(tar), threads=2, chunk_size=4096)
+
+    for read, outfile, names in zip((1, 2), outfiles, written):
+        expected = sorted(x for x in members if "_R%i_" % read in x)
+        assert names == expected
+
+        with open(outfile, "rb") as inf:
+            data = inf.read()
+        assert data == b"".join(members[x] for x in expected)
+        assert readChecksum(outfile) == md5(data)
+        assert gzip.decompress(data).count(b"\n") == 4 * 600
+
+        # the members can be cut out of the output again
+        with open(outfile + ".members") as inf:
+            next(inf)
+            ranges = [line.split("\t") for line in inf]
+        assert [name for name, offset, size in ranges] == expected
+        for name, offset, size in ranges:
+            assert data[int(offset):int(offset) + int(size)] == \
+                members[name]
+
+    assert not os.path.exists(str(tmpdir.join("fastqs.tar")))
+
+
+def test_tar_members_md5_mismatch(server, tmpdir):
+    tar, members = makeTar(lanes=1)
+    server.files["/fastqs.tar"] = tar
+    outfile = str(tmpdir.join("sample.fastq.1.gz"))
+
+    with pytest.raises(ValueError, match="md5 checksum"):
+        download.downloadTarMembers(
+            server.url + "/fastqs.tar", [("*_R1_001.fastq.gz", outfile)],
+            stream=True, md5="0" * 32)
+
+    for suffix in ("", ".md5", ".members"):
+        assert not os.path.exists(outfile + suffix)
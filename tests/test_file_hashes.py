@@ -0,0 +1,42 @@
+'''tests for file_hashes.py'''
+
+import os
+import subprocess
+import sys
+
+import file_hashes
+
+
+def test_hashes(tmpdir):
+    infile = str(tmpdir.join("sample.fastq"))
+    with open(infile, "w") as outf:
+        outf.write("@r1\nACGT\n+\nIIII\n")
+    hash_file = str(tmpdir.join("file_hashes.tsv"))
+
+    digest = file_hashes.FileHashes(hash_file).get(infile)
+    assert digest.startswith("blake2b:")
+
+    # re-read from the hash file, and kept once the file is zapped
+    hashes = file_hashes.FileHashes(hash_file)
+    assert hashes.get(infile) == digest
+    hashes.zap(infile)
+    assert os.path.getsize(infile) == 0
+    assert file_hashes.FileHashes(hash_file).get(infile) == digest
+
+    # a newer md5 checksum is used rather than reading the file
+    other = str(tmpdir.join("other.fastq"))
+    with open(other, "w") as outf:
+        outf.write("@r2\nTTTT\n+\nIIII\n")
+    with open(other + ".md5", "w") as outf:
+        outf.write("0123456789abcdef0123456789abcdef  other.fastq\n")
+    assert file_hashes.FileHashes(hash_file).get(other) == \
+        "md5:0123456789abcdef0123456789abcdef"
+
+
+def test_no_ruffus():
+    '''extract_barcodes.py reads the hashes without importing ruffus'''
+
+    code = ("import sys; sys.modules['ruffus'] = None; "
+            "import extract_barcodes")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.check_call([sys.executable, "-c", code], env=env)
@@ -0,0 +1,42 @@
+'''tests for knee_detection.py on simulated barcode counts'''
+
+import numpy as np
+import pytest
+
+import knee_detection
+
+
+def simulateCounts(n_cells, seed, background_per_cell=20):
+    '''counts for `n_cells` cells and `background_per_cell` times as
+    many background barcodes, each log-normally distributed'''
+
+    rng = np.random.default_rng(seed)
+    cells = 10 ** rng.normal(3.3, 0.2, n_cells)
+    background = 10 ** rng.normal(1.0, 0.4, n_cells * background_per_cell)
+    return np.round(np.concatenate([cells, background])).astype(np.int64)
+
+
+@pytest.mark.parametrize("n_cells", [100, 1000, 5000])
+@pytest.mark.parametrize("background_per_cell", [5, 20, 100])
+@pytest.mark.parametrize("method", ["knee", "inflection", "density"])
+def test_bimodal_cell_number(n_cells, background_per_cell, method):
+    counts = simulateCounts(n_cells, n_cells, background_per_cell)
+    threshold = knee_detection.estimateThresholds(counts)[method]
+
+    assert threshold is not None
+    assert abs(threshold.n_cells - n_cells) <= 0.05 * n_cells
+    assert threshold.lower <= threshold.count <= threshold.upper
+
+
+def test_flat_counts():
+    thresholds = knee_detection.estimateThresholds(
+        np.full(1000, 50), min_count=1)
+    assert thresholds["knee"] is None
+    assert thresholds["inflection"] is None
+    assert thresholds["density"] is None
+
+
+def test_unimodal_density():
+    counts = np.round(10 ** np.random.default_rng(0).normal(
+        2.5, 0.3, 2000)).astype(np.int64)
+    assert knee_detection.estimateThresholds(counts)["density"] is None
@@ -0,0 +1,74 @@
+'''tests for whitelist_index.py against the notebooks' fuzzy regex'''
+
+import itertools
+
+import numpy as np
+import pytest
+
+import whitelist_index
+
+regex = pytest.importorskip("regex")
+
+
+def regexErrors(barcode, whitelist):
+    '''``checkError`` from the notebooks, without stopping at the
+    second match'''
+
+    comp_regex = regex.compile("(%s){e<=1}" % barcode)
+    return set(x for x in whitelist
+               if x != barcode and comp_regex.match(x))
+
+
+@pytest.fixture(scope="module")
+def whitelist():
+    rng = np.random.default_rng(0)
+    barcodes = set("".join(x) for x in rng.choice(list("ACGT"), (400, 6)))
+    return sorted(barcodes)
+
+
+def test_check_error(whitelist):
+    '''every 6-mer has the same neighbours as with the regex'''
+
+    index = whitelist_index.WhitelistIndex(whitelist)
+
+    for barcode in ["TAATAC", "CTACTC"] + [
+            "".join(x) for x in itertools.product("ACGT", repeat=6)]:
+        assert index.checkError(barcode) == \
+            regexErrors(barcode, whitelist), barcode
+
+
+def test_check_error_examples():
+    whitelist = ["TTAATA", "CTACAT", "TACTCG", "TCTACT"]
+    index = whitelist_index.WhitelistIndex(whitelist)
+
+    assert index.checkError("TAATAC") == set()
+    assert index.checkError("CTACTC") == {"TACTCG"}
+
+
+@pytest.mark.parametrize("indels", [False, True])
+def test_correct(whitelist, indels):
+    '''queries are corrected to the whitelisted barcode the regex
+    matches, if only one'''
+
+    index = whitelist_index.WhitelistIndex(whitelist, indels=indels)
+    queries = ["".join(x) for x in itertools.product("ACGT", repeat=6)]
+    corrected, status = index.correct(queries)
+
+    for query, true_barcode, code in zip(queries, corrected, status):
+        if query in whitelist:
+            assert code == whitelist_index.EXACT
+            assert true_barcode == query
+            continue
+
+        matches = regexErrors(query, whitelist)
+        if not indels:
+            matches = set(x for x in matches if sum(
+                a != b for a, b in zip(x, query)) == 1)
+
+        if len(matches) == 1:
+            assert code == whitelist_index.CORRECTED, query
+            assert true_barcode == matches.pop()
+        else:
+            assert code == (whitelist_index.AMBIGUOUS if matches else
+                            whitelist_index.NO_MATCH), query
+            assert true_barcode is None